@@ -1,29 +1,146 @@
 from __future__ import annotations
 
+import base64
+import copy
 import datetime
+import hashlib
 import itertools
 import json
+import random
+import threading
+import time
 import uuid
 from collections import Counter
+from typing import Any, Callable, Iterable, Iterator
 
+import bson
 import celery
 import celery.states
+from bson.errors import InvalidDocument
 from celery import Task
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from sca_rhythm.admission import AdmissionController
+from sca_rhythm.limits import DEFERRED_COLLECTION, DEFERRED_INDEXES, ConcurrencyLimiter
+from sca_rhythm.payload import PayloadStore, is_ref
+from sca_rhythm.priority import PriorityPolicy, clamp_priority
 
 
 def duplicates(items):
     return list((Counter(items) - Counter(set(items))).keys())
 
 
+# steps of the shared workflow definitions by definition id, see Workflow.SHARE_DEFINITIONS
+# a definition id is the hash of its steps, so a cached definition never goes stale
+_definitions = {}
+
+
+# collections that the finished workflows are moved to by sca_rhythm.archive
+ARCHIVE_COLLECTION = 'workflow_meta_archive'
+TASKMETA_ARCHIVE_COLLECTION = 'celery_taskmeta_archive'
+TASK_RUNS_ARCHIVE_COLLECTION = 'workflow_task_runs_archive'
+
+# outputs of the tasks of the chunks of the map steps, by task_id, see Workflow.on_step_success
+CHUNK_OUTPUTS_COLLECTION = 'workflow_chunk_outputs'
+# a map step passes {CHUNK_OUTPUTS_KEY: step_idx} to its dependents instead of the list of the outputs of its chunks,
+# the list is gathered from CHUNK_OUTPUTS_COLLECTION when the dependent runs (see Workflow.gather_chunk_outputs)
+CHUNK_OUTPUTS_KEY = '__rhythm_chunk_outputs__'
+
+# status of the workflows whose start is waiting for admission, see Workflow.ADMISSION_CONTROLLER
+SCHEDULED = 'SCHEDULED'
+
+
+def _definition_id(steps_json: str) -> str:
+    return hashlib.sha256(steps_json.encode()).hexdigest()
+
+
+def _get_path(doc: dict, path: str):
+    """
+    Navigate a dotted mongo field path (ex: "steps.0.task_runs") in a (nested) dict / list document.
+    """
+    node = doc
+    for key in path.split('.'):
+        node = node[int(key)] if isinstance(node, list) else node[key]
+    return node
+
+
+def _set_path(doc: dict, path: str, value) -> None:
+    parent_path, _, key = path.rpartition('.')
+    parent = _get_path(doc, parent_path) if parent_path else doc
+    if isinstance(parent, list):
+        parent[int(key)] = value
+    else:
+        parent[key] = value
+
+
+def _covers(path: str, other: str) -> bool:
+    """
+    True if the field path "path" is the same as or an ancestor of the field path "other".
+    """
+    return other == path or other.startswith(path + '.')
+
+
+def _diff(old, new, path: str = '') -> Iterator[tuple[str, Any]]:
+    """
+    yields (field path, new value) of the fields that differ between two versions of a document,
+    descending into the dicts and into the lists of the same length. Removed fields have the value _REMOVED.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in new:
+            sub_path = f'{path}.{key}' if path else key
+            if key not in old:
+                yield sub_path, new[key]
+            elif old[key] != new[key]:
+                yield from _diff(old[key], new[key], sub_path)
+        for key in old:
+            if key not in new:
+                yield (f'{path}.{key}' if path else key), _REMOVED
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new) and path:
+        for i, (old_item, new_item) in enumerate(zip(old, new)):
+            if old_item != new_item:
+                yield from _diff(old_item, new_item, f'{path}.{i}')
+    else:
+        yield path, new
+
+
+_REMOVED = object()
+
+
+def _is_chunk_outputs_ref(value) -> bool:
+    return isinstance(value, dict) and CHUNK_OUTPUTS_KEY in value
+
+
+def _parse_date_done(date_done: str | datetime.datetime) -> datetime.datetime:
+    """
+    returns the date_done of a celery task meta as a naive UTC datetime.
+    The mongo result backend stores it as an ISO string, or as a datetime without its format_date option.
+    """
+    if isinstance(date_done, str):
+        date_done = datetime.datetime.fromisoformat(date_done)
+    if date_done.tzinfo is not None:
+        date_done = date_done.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date_done
+
+
 class WFNotFound(Exception):
     pass
 
 
+class WFConflict(Exception):
+    pass
+
+
 class NonRetryableException(Exception):
     pass
 
 
 def _validate_args(steps, name, app_id):
+    _validate_steps(steps)
+    _validate_name(name, app_id)
+
+
+def _validate_steps(steps):
     assert len(steps) > 0, 'steps is empty'
     for i, step in enumerate(steps):
         attrs = ['name', 'task']
@@ -35,111 +152,768 @@ def _validate_args(steps, name, app_id):
             attr = 'queue'
             assert isinstance(attr, str), f'step[{i}]["{attr}"] is not a string'
             assert len(step[attr]) > 0, f'step[{i}]["{attr}"] is an empty string'
+        if 'fuse' in step:
+            assert isinstance(step['fuse'], bool), f'step[{i}]["fuse"] is not a boolean'
+        if 'map' in step:
+            chunk_size = step['map'].get('chunk_size') if isinstance(step['map'], dict) else None
+            assert isinstance(chunk_size, int) and chunk_size > 0, \
+                f'step[{i}]["map"]["chunk_size"] is not a positive integer'
+        if 'depends_on' in step:
+            assert isinstance(step['depends_on'], list), f'step[{i}]["depends_on"] is not a list'
+            earlier_names = {s['name'] for s in steps[:i]}
+            for dep in step['depends_on']:
+                assert dep in earlier_names, \
+                    f'step[{i}]["depends_on"] has "{dep}" that is not the name of a step listed before it'
         # assert step['task'] in self.app.tasks, \
         #     f' step - {i} Task {step["task"]} is not registered in the celery application'
     names = [step['name'] for step in steps]
     duplicate_names = duplicates(names)
     assert len(duplicate_names) == 0, f'Steps with duplicate names: {duplicate_names}'
 
+
+def _step_dependencies(steps: list[dict]) -> list[list[int]]:
+    """
+    returns the indexes of the steps that each step depends on.
+    A step without "depends_on" depends on the step listed before it, so without "depends_on" the steps run in order.
+    """
+    step_idx = {step['name']: i for i, step in enumerate(steps)}
+    return [
+        [step_idx[name] for name in step['depends_on']] if 'depends_on' in step else ([i - 1] if i > 0 else [])
+        for i, step in enumerate(steps)
+    ]
+
+
+# number of fused steps (see Workflow.MAX_FUSED_STEPS) running in the current thread
+_fusion = threading.local()
+
+
+def _validate_name(name, app_id):
     assert name, 'name cannot be empty'
     assert app_id, 'app_id cannot be empty'
 
 
 class Workflow:
     RESUME_LOCK_ATTR = 'resume_lock'
+    # incremented by every write, a transition is written only if the version it read is still current
+    VERSION_ATTR = 'version'
+    MAX_TRANSITION_ATTEMPTS = 10
+    # wait between the attempts of a transition: a random time up to TRANSITION_BACKOFF_SEC, doubled after every
+    # attempt up to TRANSITION_BACKOFF_MAX_SEC, so that the concurrent writers spread out
+    TRANSITION_BACKOFF_SEC = 0.01
+    TRANSITION_BACKOFF_MAX_SEC = 1
+    # the transitions of the task hooks (on_step_success, ...) keep being attempted for this long instead of
+    # MAX_TRANSITION_ATTEMPTS times, so that their updates are not lost when many tasks of a workflow end together
+    HOOK_TRANSITION_TIMEOUT_SEC = 60
+    # create the indexes (see ensure_indexes) the first time a database is used in this process
+    ENSURE_INDEXES = False
+    # number of workflows inserted per insert_many by create_many()
+    CREATE_BATCH_SIZE = 1000
+    # store the steps of new workflows once per distinct definition in the workflow_definitions collection,
+    # a workflow document then only has the definition_id and the per run state of its steps
+    SHARE_DEFINITIONS = False
+    # maximum number of task runs kept in a step of the workflow document, the older runs are moved to
+    # the workflow_task_runs collection. None keeps all the task runs in the workflow document.
+    MAX_INLINE_TASK_RUNS = None
+    # number of task runs fetched per query when reading the moved task runs
+    TASK_RUNS_PAGE_SIZE = 100
+    # normalized storage layout: every task run has its own document in the workflow_task_runs collection
+    # with its task, timing and status. Only the latest task run of a step is kept in the workflow document.
+    # Convert the existing workflows with: python -m sca_rhythm.migrate
+    NORMALIZE_TASK_RUNS = False
+    # set on the workflow documents in the normalized layout, created with NORMALIZE_TASK_RUNS or converted
+    NORMALIZED_ATTR = 'task_runs_normalized'
+    # transactional outbox: the next step's task message is written to the workflow's "outbox" in the same update
+    # as the step's SUCCESS status, and published from there (see flush_outbox and sca_rhythm.outbox)
+    USE_OUTBOX = False
+    # publish the outbox right after the update, in the worker. False leaves the publishing to the outbox relay.
+    OUTBOX_INLINE_PUBLISH = True
+    # maximum number of consecutive fused steps (steps with "fuse": True) run by a worker without a broker hop,
+    # the next step is sent through the broker after that
+    MAX_FUSED_STEPS = 10
+    # store for the large values passed between the steps (see sca_rhythm.payload), ex: GridFSPayloadStore(db).
+    # The values larger than PAYLOAD_THRESHOLD_BYTES (JSON encoded) are passed by reference.
+    # Without a store, the task args larger than PAYLOAD_THRESHOLD_BYTES are not recorded in the steps' dispatch.
+    PAYLOAD_STORE: PayloadStore | None = None
+    PAYLOAD_THRESHOLD_BYTES = 256 * 1024
+    # delete the payloads of a workflow when it succeeds. The references in the result backend of its tasks
+    # no longer resolve after that, False keeps the payloads until the workflow is archived.
+    DELETE_PAYLOADS_ON_SUCCESS = True
+    # global concurrency limits of the tasks (see sca_rhythm.limits), ex: ConcurrencyLimiter(db, [...]).
+    # A task that does not get a slot is deferred and sent when a slot frees up.
+    CONCURRENCY_LIMITER: ConcurrencyLimiter | None = None
+    # rate limits of the workflow starts per app_id (see sca_rhythm.admission), ex: AdmissionController(db, {...}).
+    # A start that is not admitted is SCHEDULED and started later by start_scheduled().
+    ADMISSION_CONTROLLER: AdmissionController | None = None
+    # computes the priority of the tasks of the steps without "priority" (see sca_rhythm.priority),
+    # ex: NormalizedPositionPriority(). None uses the step's position.
+    PRIORITY_POLICY: PriorityPolicy | None = None
 
     def __init__(self, celery_app, workflow_id=None, steps=None, name=None, app_id=None, description=None):
-        self.app = celery_app
-        db = self.app.backend.database
-        self.wf_col = db.get_collection('workflow_meta')
+        self._bind(celery_app)
 
         assert workflow_id is not None or steps is not None, 'Either workflow_id or steps should not be None'
 
         if workflow_id is not None:
             # load from db
-            res = self.wf_col.find_one({'_id': workflow_id})
-            if res:
-                self.workflow = res
-            else:
-                raise WFNotFound(f'Workflow with id {workflow_id} is not found')
+            self._load(self._find_doc(workflow_id))
         else:  # steps is not None:
             # create workflow object and save to db
             _validate_args(steps, name, app_id)
-            self.workflow = {
-                '_id': str(uuid.uuid4()),
-                'created_at': datetime.datetime.utcnow(),
-                'steps': steps,
-                'name': name,
-                'app_id': app_id,
-                'description': description,
-                '_status': celery.states.PENDING
-            }
-            self.wf_col.insert_one(self.workflow)
+            # the run state is written to the steps, the caller's list (ex: a constant shared by the workflows) is kept
+            steps = copy.deepcopy(steps)
+            definition_id = None
+            if self.SHARE_DEFINITIONS:
+                definition_id = _definition_id(json.dumps(steps, sort_keys=True, default=str))
+                self._store_definition(celery_app, definition_id, steps)
+            doc = self._new_doc(steps, name, app_id, description, definition_id)
+            self.wf_col.insert_one(doc)
+            self._load(doc)
+
+    @classmethod
+    def from_doc(cls, celery_app, doc: dict) -> Workflow:
+        """
+        Create a Workflow object from a workflow document that is already fetched, without querying mongo db.
+        """
+        wf = cls.__new__(cls)
+        wf._bind(celery_app)
+        wf._load(doc)
+        return wf
+
+    def _bind(self, celery_app) -> None:
+        self.app = celery_app
+        db = self.app.backend.database
+        self.wf_col = db.get_collection('workflow_meta')
+        # task_id -> (workflow_id, step_idx, run_idx) of every task run, see from_task_id()
+        self.task_index_col = db.get_collection('workflow_task_index')
+        self.definitions_col = db.get_collection('workflow_definitions')
+        # task runs moved out of the workflow documents, see MAX_INLINE_TASK_RUNS
+        self.task_runs_col = db.get_collection('workflow_task_runs')
+        self.chunk_outputs_col = db.get_collection(CHUNK_OUTPUTS_COLLECTION)
+        self.taskmeta_col = self.app.backend.collection
+        # task_id -> args of the dispatches whose args are too large to be recorded, see _dispatch_record()
+        self._unrecorded_args = {}
+        # loaded from the archive, see sca_rhythm.archive
+        self.archived = False
+        if self.ENSURE_INDEXES:
+            _ensure_indexes_once(celery_app)
+
+    def _find_doc(self, workflow_id: str) -> dict:
+        """
+        Fetches the workflow document, falling back to the archive for the workflows that were archived.
+        The task instances and task runs of an archived workflow are read from the archive as well.
+        """
+        res = self.wf_col.find_one({'_id': workflow_id})
+        if res:
+            return res
+        db = self.app.backend.database
+        res = db.get_collection(ARCHIVE_COLLECTION).find_one({'_id': workflow_id})
+        if res:
+            self.archived = True
+            self.taskmeta_col = db.get_collection(TASKMETA_ARCHIVE_COLLECTION)
+            self.task_runs_col = db.get_collection(TASK_RUNS_ARCHIVE_COLLECTION)
+            return res
+        raise WFNotFound(f'Workflow with id {workflow_id} is not found')
+
+    def _load(self, doc: dict) -> None:
+        if 'definition_id' in doc:
+            # the workflow object has the complete steps, the definition's fields merged with the per run state
+            definition = self._get_definition(doc['definition_id'])
+            doc['steps'] = [{**def_step, **step} for def_step, step in zip(definition, doc['steps'])]
+        self.workflow = doc
+        self._changes = {}
+        # the workflow as it was loaded, to find the changes made to the workflow dict directly, see update()
+        try:
+            self._snapshot = bson.encode(doc)
+        except (InvalidDocument, TypeError):
+            self._snapshot = None
+
+    @classmethod
+    def _new_doc(cls, steps, name, app_id, description, definition_id=None) -> dict:
+        doc = {
+            '_id': str(uuid.uuid4()),
+            'created_at': datetime.datetime.utcnow(),
+            'steps': steps,
+            'name': name,
+            'app_id': app_id,
+            'description': description,
+            '_status': celery.states.PENDING,
+            cls.VERSION_ATTR: 0
+        }
+        if cls.NORMALIZE_TASK_RUNS:
+            doc[cls.NORMALIZED_ATTR] = True
+        if definition_id is not None:
+            doc['definition_id'] = definition_id
+            doc['steps'] = [{'name': step['name']} for step in steps]
+        return doc
+
+    @staticmethod
+    def _store_definition(celery_app, definition_id: str, steps: list[dict]) -> None:
+        if definition_id not in _definitions:
+            col = celery_app.backend.database.get_collection('workflow_definitions')
+            col.update_one(
+                {'_id': definition_id},
+                {'$setOnInsert': {'steps': steps, 'created_at': datetime.datetime.utcnow()}},
+                upsert=True
+            )
+            _definitions[definition_id] = copy.deepcopy(steps)
+
+    def _get_definition(self, definition_id: str) -> list[dict]:
+        if definition_id not in _definitions:
+            res = self.definitions_col.find_one({'_id': definition_id})
+            if res is None:
+                raise WFNotFound(f'Workflow definition with id {definition_id} is not found')
+            _definitions[definition_id] = res['steps']
+        return _definitions[definition_id]
+
+    def _stored_doc(self) -> dict:
+        """
+        returns the workflow object as it is stored in mongo db, without the fields of the shared definition
+        """
+        if 'definition_id' not in self.workflow:
+            return self.workflow
+        definition = self._get_definition(self.workflow['definition_id'])
+        return {
+            **self.workflow,
+            'steps': [
+                {k: v for k, v in step.items() if k == 'name' or k not in def_step}
+                for def_step, step in zip(definition, self.workflow['steps'])
+            ]
+        }
+
+    @classmethod
+    def create_many(cls, celery_app, specs: Iterable[dict]) -> list[Workflow]:
+        """
+        Creates many workflows with batched inserts (CREATE_BATCH_SIZE workflows per insert_many).
+
+        The steps of each distinct workflow definition are validated once, no matter how many workflows use it.
+
+        :param celery_app: celery app whose result backend stores the workflows
+        :param specs: dicts with the keys "steps", "name", "app_id" and optionally "description",
+                      same as the arguments of the constructor
+        :return: list of the created Workflow objects, in the order of specs
+        """
+        validated_steps = set()
+        docs = []
+        for spec in specs:
+            steps = spec['steps']
+            steps_key = json.dumps(steps, sort_keys=True, default=str)
+            if steps_key not in validated_steps:
+                _validate_steps(steps)
+                validated_steps.add(steps_key)
+                if cls.SHARE_DEFINITIONS:
+                    cls._store_definition(celery_app, _definition_id(steps_key), steps)
+            _validate_name(spec['name'], spec['app_id'])
+            # specs may share the steps list, each workflow gets its own copy to record its task runs in
+            doc = cls._new_doc(copy.deepcopy(steps), spec['name'], spec['app_id'], spec.get('description'),
+                               _definition_id(steps_key) if cls.SHARE_DEFINITIONS else None)
+            docs.append(doc)
+
+        wf_col = celery_app.backend.database.get_collection('workflow_meta')
+        for i in range(0, len(docs), cls.CREATE_BATCH_SIZE):
+            wf_col.insert_many(docs[i:i + cls.CREATE_BATCH_SIZE], ordered=False)
+        return [cls.from_doc(celery_app, doc) for doc in docs]
 
     def wf_send_task(self, step: dict, step_position: int, task_args: list | tuple = None, task_kwargs: dict = None,
-                     **kwargs):
-        task_name = step['task']
-        task_queue = step.get('queue', None)
-        _task_priority = step.get('priority', step_position)
-        task_priority = max(0, min(_task_priority, 9))  # between 0 and 9
+                     record: bool = True, **kwargs):
+        """
+        Sends the task of a step. The task id, args and kwargs are first recorded in the step's "dispatch" field,
+        so that resume() can resend the task without reading the result backend, even if the task never started.
+        With CONCURRENCY_LIMITER, a task that does not get a slot is deferred instead of sent.
+
+        :param record: record the dispatch in the workflow document, False if the caller has already recorded it
+        """
+        if record:
+            step_idx = self.get_step_idx(step['name'])
+            self._dispatch(step_idx, task_args, task_kwargs, task_id=kwargs.pop('task_id', None))
+            self._write()
+            self._send_dispatched(step_idx, **kwargs)
+            return
+
+        # print(f'sending task with priority: {task_priority}')
+        task_id = kwargs.pop('task_id', None) or str(uuid.uuid4())
+        self.publish(self.app, self._task_message(step, step_position, task_args, task_kwargs, task_id), **kwargs)
+
+    def _dispatch(self, step_idx: int, task_args: list | tuple = None, task_kwargs: dict = None,
+                  task_id: str = None) -> dict:
+        """
+        Records the dispatch of a step's task, to be written by the caller's update and then sent with
+        _send_dispatched(). The input list of a map step is split in chunks, one task per chunk.
+        """
+        dispatch = self._dispatch_record(task_id or str(uuid.uuid4()), task_args, task_kwargs)
+        self.set_field(f'steps.{step_idx}.dispatch', dispatch)
+        step = self.workflow['steps'][step_idx]
+        if 'map' in step:
+            items = self._map_input(task_args)
+            chunk_size = step['map']['chunk_size']
+            # an empty input is still a chunk, so that the step runs and completes
+            starts = range(0, len(items), chunk_size) if items else [0]
+            chunks = [
+                {'task_id': str(uuid.uuid4()), 'start': start, 'end': min(start + chunk_size, len(items))}
+                for start in starts
+            ]
+            if self.PAYLOAD_STORE is not None:
+                # the chunks' inputs are offloaded once, here, and their messages carry the references.
+                # All the chunks of an input passed by reference get one, so the input is not read again.
+                by_ref = task_args and (is_ref(task_args[0]) or _is_chunk_outputs_ref(task_args[0]))
+                threshold = 0 if by_ref else None
+                for chunk in chunks:
+                    chunk_input = self._offload(items[chunk['start']:chunk['end']], threshold)
+                    if is_ref(chunk_input):
+                        chunk['input'] = chunk_input
+            self.set_field(f'steps.{step_idx}.chunks', chunks)
+        return dispatch
+
+    def _redispatch_chunks(self, step_idx: int, chunk_idxs: list[int]) -> None:
+        chunks = self.workflow['steps'][step_idx]['chunks']
+        for k in chunk_idxs:
+            self.set_field(f'steps.{step_idx}.chunks.{k}', {
+                'task_id': str(uuid.uuid4()),
+                **{key: chunks[k][key] for key in ('start', 'end', 'input') if key in chunks[k]}
+            })
+
+    def _map_input(self, task_args: list | tuple | None) -> list:
+        items = self.gather_chunk_outputs(task_args[0]) if task_args else []
+        if self.PAYLOAD_STORE is not None:
+            items = self.PAYLOAD_STORE.resolve(items)
+        assert isinstance(items, list), 'the input of a map step (its first arg) is not a list'
+        return items
+
+    def gather_chunk_outputs(self, value):
+        """
+        returns the list of the outputs of the chunks of a map step, in order, if value is a reference to them
+        (see on_step_success), otherwise value itself. The references in a list (ex: the joined outputs passed to
+        a fan-in step) are replaced as well. The outputs that were offloaded are resolved (see PAYLOAD_STORE).
+        """
+        if isinstance(value, list) and any(_is_chunk_outputs_ref(item) for item in value):
+            return [self.gather_chunk_outputs(item) for item in value]
+        if not _is_chunk_outputs_ref(value):
+            return value
+        task_ids = [chunk['task_id'] for chunk in self.workflow['steps'][value[CHUNK_OUTPUTS_KEY]]['chunks']]
+        outputs = {doc['_id']: doc['output'] for doc in self.chunk_outputs_col.find({'_id': {'$in': task_ids}})}
+        missing = [task_id for task_id in task_ids if task_id not in outputs]
+        if missing:
+            raise WFNotFound(f'Outputs of the tasks {missing} of workflow {self.workflow["_id"]} are not found')
+        gathered = [outputs[task_id] for task_id in task_ids]
+        if self.PAYLOAD_STORE is not None:
+            gathered = self.PAYLOAD_STORE.resolve(gathered)
+        return gathered
+
+    def _dispatch_messages(self, step_idx: int, chunk_idxs: list[int] = None) -> list[dict]:
+        """
+        returns the task messages (arguments of app.send_task()) of the recorded dispatch of a step,
+        one per chunk of a map step, only the chunks in chunk_idxs if given.
+        """
+        step = self.workflow['steps'][step_idx]
+        dispatch = step['dispatch']
+        if 'map' not in step:
+            return [self._task_message(step, step_idx + 1, self._dispatch_args(step_idx), dispatch['kwargs'],
+                                       dispatch['task_id'])]
+        items = None
+        messages = []
+        for k, chunk in enumerate(step['chunks']):
+            if chunk_idxs is not None and k not in chunk_idxs:
+                continue
+            if 'input' in chunk:
+                # offloaded by _dispatch
+                chunk_input = chunk['input']
+            else:
+                if items is None:
+                    items = self._map_input(self._dispatch_args(step_idx))
+                chunk_input = items[chunk['start']:chunk['end']]
+            messages.append(self._task_message(step, step_idx + 1, [chunk_input], {**dispatch['kwargs'], 'chunk': k},
+                                               chunk['task_id']))
+        return messages
+
+    def _dispatch_args(self, step_idx: int) -> list:
+        """
+        returns the args of the recorded dispatch of a step. The args that were too large to be recorded
+        (see _dispatch_record) are the ones kept by this object when it dispatched the task, or for a map step whose
+        chunks are restarted by another process, the results of the steps it depends on.
+        """
+        dispatch = self.workflow['steps'][step_idx]['dispatch']
+        if 'args' in dispatch:
+            return dispatch['args']
+        if dispatch['task_id'] in self._unrecorded_args:
+            return self._unrecorded_args[dispatch['task_id']]
+        task_args = self._dependency_args(step_idx)
+        if task_args is None:
+            raise WFNotFound(f'The args of the task {dispatch["task_id"]} of workflow {self.workflow["_id"]} '
+                             f'were not recorded and the results of the steps it depends on are not found')
+        return task_args
+
+    def _send_dispatched(self, step_idx: int, chunk_idxs: list[int] = None, **kwargs) -> None:
+        """
+        Sends the tasks of the recorded dispatch of a step, see _dispatch().
+        The tasks of the chunks of a map step are published through a single producer.
+        """
+        messages = self._dispatch_messages(step_idx, chunk_idxs)
+        if len(messages) == 1 or 'producer' in kwargs:
+            for message in messages:
+                self.publish(self.app, message, **kwargs)
+            return
+        with self.app.producer_or_acquire() as producer:
+            for message in messages:
+                self.publish(self.app, message, producer=producer, **kwargs)
+
+    @classmethod
+    def publish(cls, celery_app, message: dict, **kwargs) -> bool:
+        """
+        Sends a task message (arguments of app.send_task()), through CONCURRENCY_LIMITER if it is set.
+
+        :return: True if the task was sent, False if it was deferred
+        """
+        if cls.CONCURRENCY_LIMITER is None:
+            celery_app.send_task(**message, **kwargs)
+            return True
+        return cls.CONCURRENCY_LIMITER.submit(celery_app, message, **kwargs)
+
+    def _limited(self, step: dict) -> bool:
+        """
+        returns True if the tasks of the step are subject to a concurrency limit
+        """
+        return self.CONCURRENCY_LIMITER is not None and bool(self.CONCURRENCY_LIMITER.semaphores(
+            app_id=self.workflow.get('app_id'), step=step['name'], task=step['task'], queue=step.get('queue')
+        ))
+
+    def _release_slots(self, step_name: str, task_ids: list[str]) -> None:
+        """
+        Gives back the concurrency limit slots of the tasks, and sends the deferred tasks that get them
+        """
+        task_ids = [task_id for task_id in task_ids if task_id is not None]
+        if self.CONCURRENCY_LIMITER is None or not task_ids:
+            return
+        step = self.get_step(step_name) if step_name is not None else None
+        if step is None or self._limited(step):
+            self.CONCURRENCY_LIMITER.release(self.app, task_ids)
+
+    def _task_message(self, step: dict, step_position: int, task_args: list | tuple, task_kwargs: dict | None,
+                      task_id: str) -> dict:
+        """
+        returns the arguments of app.send_task() for the task of a step
+        """
+        if 'priority' in step:
+            _task_priority = step['priority']
+        elif self.PRIORITY_POLICY is not None:
+            _task_priority = self.PRIORITY_POLICY.priority(self.workflow, step, step_position)
+        else:
+            _task_priority = step_position
+        task_priority = clamp_priority(_task_priority)  # between 0 and 9
 
         # kwargs precedence: 'workflow_id', 'step', 'wf_app_id' > keys in task_kwargs > keys in step['kwargs']
-        _task_kwargs = step.get('kwargs', {}) or {}
+        _task_kwargs = dict(step.get('kwargs', {}) or {})
         _task_kwargs.update(task_kwargs or {})
         _task_kwargs['workflow_id'] = self.workflow['_id']
         _task_kwargs['step'] = step['name']
         _task_kwargs['app_id'] = self.workflow['app_id']
 
-        # print(f'sending task with priority: {task_priority}')
-        self.app.send_task(name=task_name, args=task_args, kwargs=_task_kwargs,
-                           queue=task_queue, priority=task_priority, **kwargs)
+        return {
+            'name': step['task'],
+            'args': list(task_args) if task_args is not None else None,
+            'kwargs': _task_kwargs,
+            'queue': step.get('queue', None),
+            'priority': task_priority,
+            'task_id': task_id,
+        }
+
+    def _dispatch_record(self, task_id: str, task_args: list | tuple = None, task_kwargs: dict = None) -> dict:
+        """
+        returns the dispatch of a task, recorded in its step. The args larger than PAYLOAD_THRESHOLD_BYTES
+        (JSON encoded, ex: without PAYLOAD_STORE) are left out, so that the workflow document does not carry them.
+        They are kept by this object to send the task, and resume() reads them from the result backend.
+        """
+        task_args = list(task_args or [])
+        dispatch = {
+            'task_id': task_id,
+            'args': task_args,
+            'kwargs': dict(task_kwargs or {}),
+            'dispatched_at': datetime.datetime.utcnow()
+        }
+        if len(json.dumps(task_args, default=str)) > self.PAYLOAD_THRESHOLD_BYTES:
+            del dispatch['args']
+            self._unrecorded_args[task_id] = task_args
+        return dispatch
 
     def start(self, *args, **kwargs):
         """
-        Launches the task of the first step in this workflow.
+        Launches the task of the first step in this workflow,
+        or the tasks of all the steps without dependencies (depends_on: []).
 
         The task is called with given args and kwargs
         along with additional keyword args "workflow_id" and "step"
 
+        With ADMISSION_CONTROLLER, a start that is not admitted is recorded with the args and kwargs,
+        and the workflow is SCHEDULED to be started by start_scheduled().
+
         :return: None
         """
-        first_step = self.workflow['steps'][0]
-        self.wf_send_task(first_step, step_position=1, task_args=args, task_kwargs=kwargs)
+        if not self._admit():
+            self._schedule(args, kwargs)
+            self._write()
+            return
+        roots = self.get_root_step_idxs()
+        for i in roots:
+            self._dispatch(i, args, kwargs)
+        self._write()
+        if len(roots) == 1:
+            self._send_dispatched(roots[0])
+            return
+        with self.app.producer_or_acquire() as producer:
+            for i in roots:
+                self._send_dispatched(i, producer=producer)
+
+    def _admit(self) -> bool:
+        """
+        returns True if the workflow can be started now: its app_id is not rate limited,
+        or no workflow of the app is scheduled ahead of it and it got a token.
+        With fair share, the workflows of the limited app_ids are always scheduled.
+        """
+        controller = self.ADMISSION_CONTROLLER
+        app_id = self.workflow.get('app_id')
+        if controller is None or controller.limit_of(app_id) is None:
+            return True
+        if controller.fair_share:
+            return False
+        if self.wf_col.find_one({'_status': SCHEDULED, 'app_id': app_id}, {'_id': 1}) is not None:
+            return False
+        return controller.take(app_id) == 1
+
+    def _schedule(self, args: list | tuple, kwargs: dict) -> None:
+        self.set_field('_status', SCHEDULED)
+        self.set_field('scheduled', {
+            'args': list(args or []),
+            'kwargs': dict(kwargs or {}),
+            'scheduled_at': datetime.datetime.utcnow()
+        })
+
+    @classmethod
+    def start_scheduled(cls, celery_app, batch_size: int = 100) -> int:
+        """
+        Starts the SCHEDULED workflows that are admitted by ADMISSION_CONTROLLER,
+        up to batch_size workflows per app_id, in the order they were scheduled.
+        With fair share, batch_size workflows in total are shared between the app_ids (see AdmissionController.allocate).
+        Run by the dispatcher, see sca_rhythm.admission.
+
+        :param celery_app: celery app whose result backend stores the workflows
+        :param batch_size: maximum number of workflows started per app_id, or in total with fair share
+        :return: number of workflows started
+        """
+        wf_col = celery_app.backend.database.get_collection('workflow_meta')
+        controller = cls.ADMISSION_CONTROLLER
+        app_ids = wf_col.distinct('app_id', {'_status': SCHEDULED})
+        if controller is not None and controller.fair_share:
+            quotas = cls._fair_quotas(wf_col, controller, app_ids, batch_size)
+        else:
+            quotas = {app_id: batch_size for app_id in app_ids}
+
+        started = 0
+        for app_id, quota in quotas.items():
+            if quota == 0:
+                continue
+            docs = list(wf_col.find({'_status': SCHEDULED, 'app_id': app_id})
+                        .sort([('scheduled.scheduled_at', ASCENDING), ('_id', ASCENDING)])
+                        .limit(quota))
+            if controller is None or controller.queues_short(celery_app, app_id):
+                n, taken = len(docs), 0
+            else:
+                n = taken = controller.take(app_id, len(docs))
+            if n == 0:
+                continue
+            app_started = 0
+            try:
+                with celery_app.producer_or_acquire() as producer:
+                    for doc in docs[:n]:
+                        app_started += cls.from_doc(celery_app, doc)._start_scheduled(producer=producer)
+            finally:
+                started += app_started
+                # the tokens of the workflows that were started or cancelled by another process in between
+                if taken > app_started:
+                    controller.give_back(app_id, taken - app_started)
+        return started
+
+    @staticmethod
+    def _fair_quotas(wf_col, controller: AdmissionController, app_ids: list[str], batch_size: int) -> dict[str, int]:
+        """
+        returns the number of workflows to start per app_id, from their backlogs and their workflows in flight
+        """
+        # the workflows started by the dispatcher that have not finished. The workflows that were created but never
+        # started are PENDING as well, they are not in flight.
+        active = {
+            '_status': {'$in': [celery.states.PENDING, celery.states.STARTED]},
+            'scheduled.admitted_at': {'$exists': True}
+        }
+        if controller.inflight_stale_sec is not None:
+            active['updated_at'] = {
+                '$gte': datetime.datetime.utcnow() - datetime.timedelta(seconds=controller.inflight_stale_sec)
+            }
+        if controller.max_inflight is not None:
+            total_inflight = wf_col.count_documents(active)
+            batch_size = min(batch_size, max(controller.max_inflight - total_inflight, 0))
+            if batch_size == 0:
+                return {}
+        backlogs = {
+            app_id: wf_col.count_documents({'_status': SCHEDULED, 'app_id': app_id}, limit=batch_size)
+            for app_id in app_ids
+        }
+        inflight = {app_id: wf_col.count_documents({**active, 'app_id': app_id}) for app_id in app_ids}
+        return controller.allocate(backlogs, inflight, batch_size)
+
+    def _start_scheduled(self, producer=None) -> bool:
+        """
+        Starts the workflow with the args and kwargs of its scheduled start.
+
+        :return: False if the workflow is no longer SCHEDULED (ex: started by another dispatcher)
+        """
+        roots = self.get_root_step_idxs()
+
+        def admit():
+            if self.workflow.get('_status') != SCHEDULED:
+                return False
+            scheduled = self.workflow['scheduled']
+            for i in roots:
+                self._dispatch(i, scheduled['args'], scheduled['kwargs'])
+            self.set_field('_status', celery.states.PENDING)
+            self.set_field('scheduled.admitted_at', datetime.datetime.utcnow())
+            return True
+
+        if not self.transition(admit):
+            return False
+        for i in roots:
+            self._send_dispatched(i, producer=producer)
+        return True
+
+    def is_dag(self) -> bool:
+        """
+        returns True if the steps declare their dependencies ("depends_on") instead of running in order
+        """
+        return any('depends_on' in step for step in self.workflow['steps'])
+
+    def get_root_step_idxs(self) -> list[int]:
+        """
+        returns the indexes of the steps that do not depend on other steps, the steps started by start()
+        """
+        return [i for i, deps in enumerate(_step_dependencies(self.workflow['steps'])) if not deps]
+
+    @staticmethod
+    def start_many(workflows: list[Workflow], args: list[list | tuple] = None, kwargs: list[dict] = None) -> None:
+        """
+        Same as calling start() on each of the workflows, publishing all the messages through
+        a single producer (broker connection) acquired once from the celery app's producer pool.
+        With ADMISSION_CONTROLLER, the tokens of each app_id are taken at once, the workflows that do not get one
+        are SCHEDULED.
+
+        :param workflows: workflows to start
+        :param args: args of the first task of each workflow, in the order of workflows
+        :param kwargs: kwargs of the first task of each workflow, in the order of workflows
+        :return: None
+        """
+        if not workflows:
+            return
+        args = args or [()] * len(workflows)
+        kwargs = kwargs or [{}] * len(workflows)
+        assert len(args) == len(workflows) and len(kwargs) == len(workflows), \
+            'args and kwargs should have one item per workflow'
+
+        admitted = [True] * len(workflows)
+        controller = workflows[0].ADMISSION_CONTROLLER
+        if controller is not None:
+            app_idxs = {}
+            for k, wf in enumerate(workflows):
+                app_idxs.setdefault(wf.workflow.get('app_id'), []).append(k)
+            for app_id, idxs in app_idxs.items():
+                if controller.limit_of(app_id) is None:
+                    continue
+                scheduled_ahead = controller.fair_share or \
+                    workflows[0].wf_col.find_one({'_status': SCHEDULED, 'app_id': app_id}, {'_id': 1}) is not None
+                n = 0 if scheduled_ahead else controller.take(app_id, len(idxs))
+                for k in idxs[n:]:
+                    admitted[k] = False
+
+        # record the dispatch of all the first tasks with a single bulk write
+        now = datetime.datetime.utcnow()
+        updates = []
+        for wf, task_args, task_kwargs, wf_admitted in zip(workflows, args, kwargs, admitted):
+            if wf_admitted:
+                for i in wf.get_root_step_idxs():
+                    wf._dispatch(i, task_args, task_kwargs)
+            else:
+                wf._schedule(task_args, task_kwargs)
+            wf.set_field('updated_at', now)
+            updates.append(UpdateOne({'_id': wf.workflow['_id']}, wf._pop_changes()))
+            wf.workflow[wf.VERSION_ATTR] = wf.workflow.get(wf.VERSION_ATTR, 0) + 1
+        workflows[0].wf_col.bulk_write(updates, ordered=False)
+
+        with workflows[0].app.producer_or_acquire() as producer:
+            for wf in itertools.compress(workflows, admitted):
+                for i in wf.get_root_step_idxs():
+                    wf._send_dispatched(i, producer=producer)
 
     def pause(self, refresh=True):
         """
-        Revoke the current running task.
+        Revoke the current running task, or the running tasks of all the frontier steps (see get_frontier_steps).
+        The tasks of these steps that were deferred by CONCURRENCY_LIMITER are revoked as well.
 
-        :return: status of the pause operation and the revoked step if successful
-        - dict { "paused": bool, "revoked_step": dict }
+        :return: status of the pause operation and the revoked steps if successful
+        - dict { "paused": bool, "revoked_step": dict, "revoked_steps": list[dict] }
         """
-        # find running task
-        # revoke it
+        # find running tasks
+        # revoke them
 
         if refresh:
             self.refresh()
-
-        first_step_not_succeeded = self.get_pending_step()
-        if first_step_not_succeeded:
-            i, status = first_step_not_succeeded
-            if status not in [celery.states.SUCCESS, celery.states.FAILURE]:
-                step = self.workflow['steps'][i]
-                task_runs = step.get('task_runs', [])
-                if task_runs is not None and len(task_runs) > 0:
-                    task_id = task_runs[-1]['task_id']
-                    # https://docs.celeryq.dev/en/stable/userguide/workers.html#revoke-revoking-tasks
-                    self.app.control.revoke(task_id, terminate=True)
-                    # print(f' revoked task: {task_id} in step-{i + 1} {step["name"]}')
-                    self.workflow['_status'] = celery.states.REVOKED
-                    self.update()
-                    return {
-                        'paused': True,
-                        'revoked_step': {
-                            'task_id': task_id,
+        # the tasks waiting for a concurrency limit slot are revoked as well
+        deferred = set() if self.CONCURRENCY_LIMITER is None else \
+            self.CONCURRENCY_LIMITER.deferred_task_ids(self.workflow['_id'])
+
+        def mark_revoked():
+            revoked_steps = []
+            for i, status in self.get_frontier_steps():
+                if status not in [celery.states.SUCCESS, celery.states.FAILURE]:
+                    step = self.workflow['steps'][i]
+                    task_runs = step.get('task_runs', [])
+                    if 'chunks' in step:
+                        # map step, revoke the tasks of all the chunks that have not finished
+                        task_ids = []
+                        for k, chunk in enumerate(step['chunks']):
+                            if chunk.get('status') not in [celery.states.SUCCESS, celery.states.FAILURE]:
+                                self.set_field(f'steps.{i}.chunks.{k}.status', celery.states.REVOKED)
+                                task_ids.append(chunk['task_id'])
+                        if task_ids:
+                            self.set_field(f'steps.{i}.status', celery.states.REVOKED)
+                            revoked_steps.append({
+                                'task_id': task_ids[0],
+                                'task_ids': task_ids,
+                                'task': step['task'],
+                                'name': step['name']
+                            })
+                    elif (task_runs is not None and len(task_runs) > 0) or \
+                            step.get('dispatch', {}).get('task_id') in deferred:
+                        self.set_field(f'steps.{i}.status', celery.states.REVOKED)
+                        revoked_steps.append({
+                            'task_id': task_runs[-1]['task_id'] if task_runs else step['dispatch']['task_id'],
                             'task': step['task'],
                             'name': step['name']
-                        }
-                    }
+                        })
+            if revoked_steps:
+                self.set_field('_status', celery.states.REVOKED)
+            return revoked_steps
+
+        revoked_steps = self.transition(mark_revoked)
+        if revoked_steps:
+            # https://docs.celeryq.dev/en/stable/userguide/workers.html#revoke-revoking-tasks
+            for revoked_step in revoked_steps:
+                self.app.control.revoke(revoked_step.get('task_ids', revoked_step['task_id']), terminate=True)
+            if self.CONCURRENCY_LIMITER is not None:
+                # revoked tasks do not run the hooks that give back their slots
+                self.CONCURRENCY_LIMITER.release(self.app, [
+                    task_id for revoked_step in revoked_steps
+                    for task_id in revoked_step.get('task_ids', [revoked_step['task_id']])
+                ])
+            # print(f' revoked task: {revoked_step["task_id"]} in step {revoked_step["name"]}')
+            return {
+                'paused': True,
+                'revoked_step': revoked_steps[0],
+                'revoked_steps': revoked_steps
+            }
         return {
             'paused': False
         }
@@ -147,124 +921,816 @@ class Workflow:
     def resume(self, force: bool = False, args: list = None, refresh=True) -> dict:
         """
         Submit a new task in the step that has FAILED / REVOKED before and continue the workflow.
+        In a workflow with parallel steps, every frontier step (see get_frontier_steps) that has FAILED / REVOKED
+        is restarted.
+
+        The task is resent with the args and kwargs recorded when the step's task was last dispatched.
+        For the workflows created before the dispatches were recorded, the args are read from the last task instance.
+        If the step never ran, it is called with the results of the steps it depends on (same as on_step_success),
+        unless "args" are given. Only the FAILED / REVOKED chunks of a map step are restarted.
+        A map step whose chunks have all succeeded but that was not completed (ex: the worker of its last chunk
+        stopped in between) is completed instead, and the steps that depend on it are called.
 
         :param force: submit the next task even if its status is not FAILED / REVOKED
-        :param args: if the workflow stopped before creating a task instance then its args are not stored.
+        :param args: if the step's task was never dispatched then its args are not stored.
                      The new task will be triggered with given "args"
         :return: status of the resume operation and the restart if successful
-        - dict { "resumed": bool, "restarted_step": dict }
+        - dict { "resumed": bool, "restarted_step": dict, "restarted_steps": list[dict] }
         """
-        # find failed / revoked task
-        # submit a new task with arguments
-        # TODO: if the pending step is not the first step, and it has never run before,
-        #  then get the args from the previous step
-        # cannot resume the step automatically, that has never started, provide args
 
         if refresh:
             self.refresh()
 
-        if not self.is_resume_locked():
-            first_step_not_succeeded = self.get_pending_step()
-            if first_step_not_succeeded:
-                i, status = first_step_not_succeeded
-                if (status in [celery.states.FAILURE, celery.states.REVOKED]) or force:
-                    step = self.workflow['steps'][i]
-
-                    # failed / revoked task instance
-                    task_inst = self.get_last_run_task_instance(step)
-                    assert not (
-                            task_inst is None and args is None), 'no args are provided and there is no last run task'
-                    task_args = task_inst['args'] if task_inst is not None else args
+        called = []
+        for i, step in enumerate(self.workflow['steps']):
+            if 'chunks' in step and step.get('status') != celery.states.SUCCESS and \
+                    all(chunk.get('status') == celery.states.SUCCESS for chunk in step['chunks']):
+                called.extend(self._complete_step(i, {CHUNK_OUTPUTS_KEY: i}))
+        if called:
+            restarted_steps = [
+                {'name': self.workflow['steps'][i]['name'], 'task': self.workflow['steps'][i]['task']} for i in called
+            ]
+            return {
+                'resumed': True,
+                'restarted_step': restarted_steps[0],
+                'restarted_steps': restarted_steps
+            }
 
-                    self.wf_send_task(step, step_position=i + 1, task_args=task_args)
+        def lock_frontier_steps():
+            # a SCHEDULED workflow is started by start_scheduled()
+            if not self.is_resume_locked() and self.workflow.get('_status') != SCHEDULED:
+                restart_idxs = [
+                    i for i, status in self.get_frontier_steps()
+                    if (status in [celery.states.FAILURE, celery.states.REVOKED]) or force
+                ]
+                restarts = {}
+                for i in restart_idxs:
+                    step = self.workflow['steps'][i]
+                    dispatch = step.get('dispatch')
+                    if 'chunks' in step:
+                        # map step, restart the chunks that did not succeed
+                        chunk_idxs = [
+                            k for k, chunk in enumerate(step['chunks'])
+                            if chunk.get('status') in [celery.states.FAILURE, celery.states.REVOKED]
+                            or (force and chunk.get('status') != celery.states.SUCCESS)
+                        ]
+                        if chunk_idxs:
+                            self._redispatch_chunks(i, chunk_idxs)
+                            restarts[i] = chunk_idxs
+                        continue
+                    if dispatch is not None and 'args' in dispatch:
+                        task_args, task_kwargs = dispatch['args'], dispatch['kwargs']
+                    else:
+                        # failed / revoked task instance, the args were not recorded (see _dispatch_record)
+                        task_inst = self.get_last_run_task_instance(step)
+                        task_args = task_inst['args'] if task_inst is not None else args
+                        task_kwargs = dispatch['kwargs'] if dispatch is not None else None
+                        if task_args is None:
+                            # never ran, the steps it depends on succeeded
+                            task_args = self._dependency_args(i)
+                        assert task_args is not None, \
+                            'no args are provided and there is no last run task or previous step result'
+                    # the new dispatches are recorded with the lock, in the same update
+                    self._dispatch(i, task_args, task_kwargs)
+                    restarts[i] = None
+                if restarts:
                     self.lock_resume()
-                    self.update()
-
+                return restarts
+
+        # the lock is taken before sending the tasks, only one of the concurrent resume calls can succeed
+        restarts = self.transition(lock_frontier_steps)
+        if restarts:
+            restarted_steps = []
+            try:
+                for i, chunk_idxs in restarts.items():
+                    step = self.workflow['steps'][i]
+                    self._send_dispatched(i, chunk_idxs)
                     # print(f' resuming step {step["name"]}')
-                    return {
-                        'resumed': True,
-                        'restarted_step': {
-                            'name': step['name'],
-                            'task': step['task']
-                        }
+                    restarted_step = {
+                        'name': step['name'],
+                        'task': step['task']
                     }
+                    if chunk_idxs is not None:
+                        restarted_step['chunks'] = chunk_idxs
+                    restarted_steps.append(restarted_step)
+            except Exception:
+                self.transition(lambda: self.unlock_resume() or True)
+                raise
+
+            return {
+                'resumed': True,
+                'restarted_step': restarted_steps[0],
+                'restarted_steps': restarted_steps
+            }
         return {
             'resumed': False
         }
 
-    def on_step_start(self, step_name: str, task_id: str) -> None:
+    def _dependency_args(self, step_idx: int) -> list | None:
+        """
+        returns the args that on_step_success calls a step with, from the results of the steps it depends on:
+        the first element of the result of its dependency, or the list of these of its dependencies (fan-in).
+        None if a result is not available.
+        """
+        outputs = []
+        for dep in _step_dependencies(self.workflow['steps'])[step_idx]:
+            dep_step = self.workflow['steps'][dep]
+            if 'output' in dep_step:
+                outputs.append(dep_step['output'])
+                continue
+            result = self.get_step_result(dep_step)
+            if not result:
+                return None
+            outputs.append(result[0])
+        if not outputs:
+            return None
+        return [outputs[0]] if len(outputs) == 1 else [outputs]
+
+    def on_step_start(self, step_name: str, task_id: str, chunk: int = None) -> None:
         """
         Called by an instance of WorkflowTask before it starts work.
-        Updates the workflow object's step with the task_id and date_start.
+        Updates the workflow object's step with the task_id and date_start and marks the step as STARTED.
 
         If the task is resubmitted with the old task_id, task_runs will not be updated.
+        The task is also recorded in the task_id reverse index (see from_task_id).
+        If the step has more than MAX_INLINE_TASK_RUNS task runs, the older ones are moved out of the workflow document.
+
+        With NORMALIZE_TASK_RUNS, the task run is inserted in the workflow_task_runs collection and replaces the
+        previous run in the workflow document, which only keeps the step's latest run. The previous run already has
+        its document, inserted when it started. A workflow that is not converted yet (see normalize_task_runs)
+        gets the task run appended and its older runs moved out.
+
+        The workflow document is updated with a single atomic update that does not need the workflow object to be
+        loaded beforehand, the workflow object is replaced with the updated document.
 
         :param step_name: name of the step that the task is running
         :param task_id: id of the task
+        :param chunk: index of the chunk that the task is running, for the tasks of a map step
         :return: None
         """
-        step = self.get_step(step_name)
-        step['task_runs'] = step.get('task_runs', [])
+        now = datetime.datetime.utcnow()
+        task_run = {'date_start': now, 'task_id': task_id}
+        updates = {
+            'steps.$[step].status': celery.states.STARTED,
+            '_status': celery.states.STARTED,
+            self.RESUME_LOCK_ATTR: None,
+            'updated_at': now
+        }
+        # a step whose task_runs already has this task_id is not matched and the run is not added again
+        new_run_filter = {'new_run_step.name': step_name, 'new_run_step.task_runs.task_id': {'$ne': task_id}}
+        array_filters = [{'step.name': step_name}, new_run_filter]
+        if chunk is not None:
+            task_run['chunk'] = chunk
+            updates['steps.$[step].chunks.$[chunk].status'] = celery.states.STARTED
+            array_filters.append({'chunk.task_id': task_id})
+
+        doc = None
+        if self.NORMALIZE_TASK_RUNS:
+            # the run replaces the previous one, which is counted as moved out
+            doc = self.wf_col.find_one_and_update(
+                {'_id': self.workflow['_id'], self.NORMALIZED_ATTR: True},
+                {
+                    '$set': {**updates, 'steps.$[new_run_step].task_runs': [task_run]},
+                    '$inc': {self.VERSION_ATTR: 1, 'steps.$[prev_run_step].spilled_task_runs': 1}
+                },
+                array_filters=[
+                    *array_filters,
+                    {**{k.replace('new_run_step', 'prev_run_step'): v for k, v in new_run_filter.items()},
+                     'prev_run_step.task_runs.0': {'$exists': True}}
+                ],
+                return_document=ReturnDocument.AFTER
+            )
+        normalized = doc is not None
+        if not normalized:
+            doc = self.wf_col.find_one_and_update(
+                {'_id': self.workflow['_id']},
+                {
+                    '$push': {'steps.$[new_run_step].task_runs': task_run},
+                    '$set': updates,
+                    '$inc': {self.VERSION_ATTR: 1}
+                },
+                array_filters=array_filters,
+                return_document=ReturnDocument.AFTER
+            )
+        if doc is None:
+            raise WFNotFound(f'Workflow with id {self.workflow["_id"]} is not found')
+        self._load(doc)
+
+        step_idx = self.get_step_idx(step_name)
+        task_runs = self.workflow['steps'][step_idx].get('task_runs', [])
+        task_run_idx = next(i for i, task_run in enumerate(task_runs) if task_run['task_id'] == task_id)
+        task_run_doc = self._task_run_doc(step_idx, task_run_idx)
+        if self.NORMALIZE_TASK_RUNS:
+            # the task run's document also serves as its entry in the task_id reverse index
+            self.task_runs_col.update_one({'_id': task_id}, {'$set': task_run_doc}, upsert=True)
+        else:
+            self.task_index_col.update_one(
+                {'_id': task_id},
+                {'$set': {k: task_run_doc[k] for k in ('workflow_id', 'step_idx', 'run_idx')}},
+                upsert=True
+            )
 
-        prev_task_ids_set = set(task_run.get('task_id', '') for task_run in step['task_runs'])
-        if task_id not in prev_task_ids_set:
-            step['task_runs'].append({
-                'date_start': datetime.datetime.utcnow(),
-                'task_id': task_id
-            })
+        if self._limited(self.workflow['steps'][step_idx]):
+            # the lease of the task's concurrency limit slot runs from its start
+            self.CONCURRENCY_LIMITER.renew(task_id)
 
-            # print(f' starting {step_name} with task id: {task_id}')
-        # else:
-        #     print(f' on_step_start {step_name} {task_id} already in prev task runs. not adding.')
-        self.workflow['_status'] = celery.states.STARTED
-        self.unlock_resume()
-        self.update()
+        keep = 1 if self.NORMALIZE_TASK_RUNS else self.MAX_INLINE_TASK_RUNS
+        if not normalized and keep is not None and len(task_runs) > keep:
+            self._spill_task_runs(step_idx, keep)
+
+    def _task_run_doc(self, step_idx: int, task_run_idx: int) -> dict:
+        """
+        returns the document of the step's task run in the workflow_task_runs collection, without its _id (task_id)
+        """
+        step = self.workflow['steps'][step_idx]
+        return {
+            **step['task_runs'][task_run_idx],
+            'workflow_id': self.workflow['_id'],
+            'step': step['name'],
+            'step_idx': step_idx,
+            'task': step['task'],
+            'run_idx': step.get('spilled_task_runs', 0) + task_run_idx
+        }
+
+    def _spill_task_runs(self, step_idx: int, keep: int) -> None:
+        """
+        Moves the task runs of the step except the latest "keep" runs to the workflow_task_runs collection.
+        The number of moved runs is counted in the step's "spilled_task_runs".
+        """
+
+        def spill():
+            step = self.workflow['steps'][step_idx]
+            task_runs = step.get('task_runs', [])
+            if len(task_runs) <= keep:
+                return False
+            n_overflow = len(task_runs) - keep
+            docs = [{**self._task_run_doc(step_idx, i), '_id': task_runs[i]['task_id']} for i in range(n_overflow)]
+            try:
+                self.task_runs_col.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # runs inserted when they started (NORMALIZE_TASK_RUNS)
+                # or by an earlier attempt that did not get to trim the workflow document
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+            # the runs are removed from the workflow document only if it has not changed since they were read
+            self.set_field(f'steps.{step_idx}.spilled_task_runs', step.get('spilled_task_runs', 0) + n_overflow)
+            self.set_field(f'steps.{step_idx}.task_runs', task_runs[n_overflow:])
+            return True
+
+        self.transition(spill)
+
+    def normalize_task_runs(self, backfill: bool = True) -> None:
+        """
+        Converts this workflow to the normalized storage layout (see NORMALIZE_TASK_RUNS):
+        inserts all the task runs in the workflow_task_runs collection, keeps only the latest task run
+        of each step in the workflow document and marks the document as normalized.
+        Safe to run while the workflow is running and to run again.
 
-    def on_step_success(self, retval: tuple, step_name: str) -> None:
+        :param backfill: fill in the status, date_done and duration_sec of the finished task runs from their
+            celery taskmeta (see backfill_task_runs)
+        """
+        for _ in range(self.MAX_TRANSITION_ATTEMPTS):
+            for step_idx, step in enumerate(self.workflow['steps']):
+                task_runs = step.get('task_runs', [])
+                if len(task_runs) > 0:
+                    # the latest task run is not moved out, it is inserted here
+                    latest = self._task_run_doc(step_idx, len(task_runs) - 1)
+                    self.task_runs_col.update_one({'_id': task_runs[-1]['task_id']}, {'$setOnInsert': latest},
+                                                  upsert=True)
+                    self._spill_task_runs(step_idx, keep=1)
+
+            appended = []
+
+            def mark_normalized():
+                # a task that started since the runs were moved out appended its run, it is moved out first
+                appended[:] = [step['name'] for step in self.workflow['steps'] if len(step.get('task_runs', [])) > 1]
+                if appended or self.workflow.get(self.NORMALIZED_ATTR):
+                    return False
+                self.set_field(self.NORMALIZED_ATTR, True)
+                return True
+
+            self.transition(mark_normalized)
+            if not appended:
+                break
+        else:
+            raise WFConflict(f'Workflow with id {self.workflow["_id"]} could not be normalized, it kept changing')
+        if backfill:
+            self.backfill_task_runs(self.app, [self.workflow['_id']])
+
+    @classmethod
+    def backfill_task_runs(cls, celery_app, workflow_ids: list[str]) -> int:
+        """
+        Fills in the status, date_done and duration_sec of the task runs of the workflows that were moved out
+        without them (ex: by MAX_INLINE_TASK_RUNS), from the celery taskmeta of the tasks that finished.
+
+        :return: number of task runs updated
+        """
+        db = celery_app.backend.database
+        task_runs_col = db.get_collection('workflow_task_runs')
+        runs = list(task_runs_col.find(
+            {'workflow_id': {'$in': list(workflow_ids)}, 'date_done': {'$exists': False}},
+            {'date_start': 1}
+        ))
+        if not runs:
+            return 0
+        taskmetas = {
+            meta['_id']: meta
+            for meta in celery_app.backend.collection.find(
+                {'_id': {'$in': [run['_id'] for run in runs]}, 'status': {'$in': list(celery.states.READY_STATES)}},
+                {'status': 1, 'date_done': 1}
+            )
+        }
+        ops = []
+        for run in runs:
+            meta = taskmetas.get(run['_id'])
+            if meta is None or meta.get('date_done') is None:
+                continue
+            try:
+                date_done = _parse_date_done(meta['date_done'])
+            except (TypeError, ValueError):
+                continue
+            fields = {'status': meta['status'], 'date_done': date_done}
+            if run.get('date_start') is not None:
+                fields['duration_sec'] = (date_done - run['date_start']).total_seconds()
+            # a run that ended in between was recorded by its worker, it is not overwritten
+            ops.append(UpdateOne({'_id': run['_id'], 'date_done': {'$exists': False}}, {'$set': fields}))
+        if not ops:
+            return 0
+        return task_runs_col.bulk_write(ops, ordered=False).modified_count
+
+    def _record_task_run_end(self, task_id: str, status: celery.states.state) -> None:
+        if self.NORMALIZE_TASK_RUNS and task_id is not None:
+            now = datetime.datetime.utcnow()
+            self.task_runs_col.update_one({'_id': task_id}, [{'$set': {
+                'date_done': now,
+                'status': status,
+                'duration_sec': {'$divide': [{'$subtract': [now, '$date_start']}, 1000]}
+            }}])
+
+    def on_step_success(self, retval: tuple, step_name: str, task_id: str = None, queue: str = None,
+                        chunk: int = None) -> None:
         """
         Called by an instance of WorkflowTask after it completes work.
         calls the next step (if there is one) with the first element of the retval as an argument.
 
-        :param retval: the return value of the task of tuple type. the first element is sent to the next step as an arg
+        With "depends_on", every step that depends on this step and whose dependencies have all succeeded is called.
+        A step that depends on more than one step (fan-in) is called with the list of the first elements of the
+        retvals of its dependencies, in the order of its "depends_on".
+
+        If the next step has "fuse": True and runs on the same queue as this task, its task is run in this process
+        instead of being sent through the broker (see _run_fused).
+
+        The task of a chunk of a map step stores its output in the workflow_chunk_outputs collection and marks its
+        chunk as SUCCESS, with an update of the chunk alone, so the chunks that end together do not contend for the
+        workflow document. The task that finds all the chunks succeeded completes the step (see _complete_step): its
+        output is a reference to the outputs of the chunks, gathered in order when a dependent step runs
+        (see gather_chunk_outputs).
+
+        The task's concurrency limit slot is given back first (see CONCURRENCY_LIMITER).
+        When the workflow succeeds, its payloads are deleted (see DELETE_PAYLOADS_ON_SUCCESS).
+
+        :param retval: the return value of the task of tuple type. the first element is sent to the next step as an arg.
+            The return value of the last step is not used, it can be anything, ex: None
         :param step_name: name of the step that the task is running
+        :param task_id: id of the task
+        :param queue: queue that the task was consumed from
+        :param chunk: index of the chunk that the task ran, for the tasks of a map step
         :return:
         """
+        self._record_task_run_end(task_id, celery.states.SUCCESS)
+        self._release_slots(step_name, [task_id])
+        step_idx = self.get_step_idx(step_name)
+        task_output = None
+        if self.output_used(step_name, chunk) and retval:
+            task_output = self._offload(retval[0])
+
+        if chunk is None:
+            self._complete_step(step_idx, task_output, queue)
+            return
+
+        # the output is written first, it is only read once the chunk is marked as SUCCESS
+        self.chunk_outputs_col.replace_one({'_id': task_id}, {
+            'workflow_id': self.workflow['_id'],
+            'step_idx': step_idx,
+            'chunk': chunk,
+            'output': task_output,
+            'created_at': datetime.datetime.utcnow()
+        }, upsert=True)
+        if not self._update_chunk(step_idx, chunk, task_id,
+                                  {f'steps.{step_idx}.chunks.{chunk}.status': celery.states.SUCCESS}):
+            self.chunk_outputs_col.delete_one({'_id': task_id})
+            return
+        step = self.workflow['steps'][step_idx]
+        status = self._map_status(step['chunks'])
+        if status == celery.states.SUCCESS:
+            self._complete_step(step_idx, {CHUNK_OUTPUTS_KEY: step_idx}, queue)
+        elif status in [celery.states.FAILURE, celery.states.REVOKED] and step.get('status') != status:
+            # a chunk that started after another one failed marked the step as STARTED again
+            self._update_chunk(step_idx, chunk, None, {f'steps.{step_idx}.status': status, '_status': status})
+
+    def output_used(self, step_name: str, chunk: int = None) -> bool:
+        """
+        returns True if the output of a task of the step (the first element of its return value) is used:
+        by the steps that depend on the step, or to gather the outputs of the chunks of a map step.
+        The outputs that are not used are neither recorded nor offloaded (see PAYLOAD_STORE).
+        """
+        if chunk is not None:
+            return True
+        step_idx = self.get_step_idx(step_name)
+        return any(step_idx in deps for deps in _step_dependencies(self.workflow['steps']))
 
-        next_step_idx = self.get_next_step_idx(step_name)
+    def _complete_step(self, step_idx: int, output, queue: str = None) -> list[int]:
+        """
+        Marks the step as SUCCESS, and the workflow if it was the last step, and calls the steps that depend on it
+        with its output (see on_step_success). A map step is completed only once, when all of its chunks
+        have succeeded. The steps that get ready after the step was revoked by pause() are recorded as REVOKED
+        and not called.
+
+        :param output: output of the step, passed to the steps that depend on it
+        :param queue: queue that the step's task was consumed from, to run the next step fused
+        :return: indexes of the steps that were called
+        """
+        dependencies = _step_dependencies(self.workflow['steps'])
+        dependents = [i for i, deps in enumerate(dependencies) if step_idx in deps]
+        ready = {}
+
+        def mark_success():
+            steps = self.workflow['steps']
+            ready.clear()
+            if 'chunks' in steps[step_idx] and (
+                    steps[step_idx].get('status') == celery.states.SUCCESS
+                    or any(c.get('status') != celery.states.SUCCESS for c in steps[step_idx]['chunks'])):
+                # completed by the task of another chunk
+                return None
+            # the step was revoked by pause() while its task ran, ex: a fused task, that revoke cannot terminate.
+            # The steps that get ready are recorded as REVOKED instead of being sent, resume() sends them.
+            paused = steps[step_idx].get('status') == celery.states.REVOKED
+
+            self.set_field(f'steps.{step_idx}.status', celery.states.SUCCESS)
+            if any(len(dependencies[i]) > 1 for i in dependents):
+                # kept for the fan-in steps, that are called with the outputs of all of their dependencies
+                self.set_field(f'steps.{step_idx}.output', output)
+            if all(step.get('status') == celery.states.SUCCESS for step in steps) if self.is_dag() else not dependents:
+                # this is the last step and it succeeded
+                self.set_field('_status', celery.states.SUCCESS)
+
+            # the steps whose dependencies have all succeeded and that have not been called yet
+            for i in dependents:
+                if 'status' not in steps[i] and 'dispatch' not in steps[i] and \
+                        all(steps[dep].get('status') == celery.states.SUCCESS for dep in dependencies[i]):
+                    ready[i] = [output] if len(dependencies[i]) == 1 else [[
+                        output if dep == step_idx else steps[dep].get('output') for dep in dependencies[i]
+                    ]]
+            fuse = not paused and len(ready) == 1 and 'map' not in steps[next(iter(ready))] and \
+                self._can_fuse(steps[next(iter(ready))], queue)
+
+            for i, task_args in ready.items():
+                # the next task's dispatch is recorded with the status, in the same update
+                dispatch = self._dispatch(i, task_args)
+                if paused:
+                    self.set_field(f'steps.{i}.status', celery.states.REVOKED)
+                    for k in range(len(steps[i].get('chunks', []))):
+                        self.set_field(f'steps.{i}.chunks.{k}.status', celery.states.REVOKED)
+                    self.set_field('_status', celery.states.REVOKED)
+                # the messages whose args are not recorded are not written to the outbox either, they are sent
+                elif self.USE_OUTBOX and not fuse and 'args' in dispatch:
+                    for message in self._dispatch_messages(i):
+                        self.push_field('outbox', {
+                            'task_id': message['task_id'],
+                            'message': message,
+                            'created_at': dispatch['dispatched_at']
+                        })
+            return {'fuse': fuse, 'paused': paused}
+
+        result = self.transition(mark_success, timeout_sec=self.HOOK_TRANSITION_TIMEOUT_SEC)
+        if not result:
+            return []
+        if self.workflow['_status'] == celery.states.SUCCESS and self.DELETE_PAYLOADS_ON_SUCCESS and \
+                self.PAYLOAD_STORE is not None:
+            self.PAYLOAD_STORE.delete_workflows([self.workflow['_id']])
+        if result['paused']:
+            return []
+
+        if result['fuse']:
+            self._run_fused(next(iter(ready)))
+            return list(ready)
+
+        if self.USE_OUTBOX:
+            if self.OUTBOX_INLINE_PUBLISH:
+                self.flush_outbox()
+            for i in ready:
+                if 'args' not in self.workflow['steps'][i]['dispatch']:
+                    self._send_dispatched(i)
+            return list(ready)
+
+        # apply next tasks with retval
+        for i in ready:
+            self._send_dispatched(i)
+            # print(f' starting next step {self.workflow["steps"][i]["name"]}')
+        return list(ready)
+
+    @staticmethod
+    def _map_status(chunks: list[dict]) -> celery.states.state:
+        """
+        returns the status of a map step from the statuses of its chunks
+        """
+        statuses = [chunk.get('status', celery.states.PENDING) for chunk in chunks]
+        for status in [celery.states.FAILURE, celery.states.REVOKED]:
+            if status in statuses:
+                return status
+        if all(status == celery.states.SUCCESS for status in statuses):
+            return celery.states.SUCCESS
+        return celery.states.STARTED
+
+    def _offload(self, value, threshold: int = None):
+        if self.PAYLOAD_STORE is None:
+            return value
+        if threshold is None:
+            threshold = self.PAYLOAD_THRESHOLD_BYTES
+        return self.PAYLOAD_STORE.offload(value, threshold, self.workflow['_id'])
+
+    def _can_fuse(self, step: dict, queue: str | None) -> bool:
+        return (
+                step.get('fuse', False)
+                and queue is not None
+                and (step.get('queue') or self.app.conf.task_default_queue) == queue
+                and step['task'] in self.app.tasks
+                and getattr(_fusion, 'depth', 0) < self.MAX_FUSED_STEPS
+                # a fused task would run without taking a slot
+                and not self._limited(step)
+        )
+
+    def _run_fused(self, step_idx: int) -> None:
+        """
+        Runs the task of a step in this process, as recorded in the step's dispatch, instead of sending it.
+        The task goes through the same hooks as a task received from the broker (on_step_start, on_step_success, ...),
+        so it is recorded as its own task run, and its result is stored in the result backend.
+        Retries of a fused task are run right away, in this process.
+        """
+        message = self._dispatch_messages(step_idx)[0]
+        task = self.app.tasks[message['name']]
 
+        _fusion.depth = getattr(_fusion, 'depth', 0) + 1
         try:
-            # apply next task with retval
-            if next_step_idx is not None:
-                next_step = self.workflow['steps'][next_step_idx]
-                self.wf_send_task(next_step, step_position=next_step_idx + 1, task_args=(retval[0],))
-                # print(f' starting next step {next_step["name"]}')
-            else:
-                # this is the last step and it succeeded
-                self.workflow['_status'] = celery.states.SUCCESS
+            result = task.apply(args=message['args'], kwargs=message['kwargs'], task_id=message['task_id'],
+                                throw=False, routing_key=message['queue'] or self.app.conf.task_default_queue,
+                                priority=message['priority'])
         finally:
-            self.update()
+            _fusion.depth -= 1
+        if not task.store_eager_result and not task.ignore_result:
+            self.app.backend.store_result(result.id, result.result, result.state, traceback=result.traceback)
 
-    def on_step_failure(self):
-        self.workflow['_status'] = celery.states.FAILURE
-        self.update()
+    def flush_outbox(self) -> int:
+        """
+        Publishes the task messages in the workflow's outbox and removes them from the outbox.
+
+        A message is removed only after it has been published, so a message can be published more than once
+        (ex: when the process stops in between), never lost. The published tasks keep the task ids
+        that were recorded in the outbox.
 
-    def update(self):
+        :return: number of published messages
+        """
+        entries = self.workflow.get('outbox') or []
+        if not entries:
+            return 0
+        with self.app.producer_or_acquire() as producer:
+            for entry in entries:
+                self.publish(self.app, entry['message'], producer=producer)
+        doc = self.wf_col.find_one_and_update(
+            {'_id': self.workflow['_id']},
+            {
+                '$pull': {'outbox': {'task_id': {'$in': [entry['task_id'] for entry in entries]}}},
+                '$inc': {self.VERSION_ATTR: 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is not None:
+            self._load(doc)
+        return len(entries)
+
+    def on_step_failure(self, step_name: str = None, task_id: str = None, chunk: int = None) -> None:
         """
-        Update the workflow object in mongo db
+        Called by an instance of WorkflowTask when it fails. Marks the step and the workflow as FAILED
+        and gives back the task's concurrency limit slot.
+
+        :param step_name: name of the step that the task is running
+        :param task_id: id of the task
+        :param chunk: index of the chunk that the task ran, for the tasks of a map step
         :return: None
         """
-        self.workflow['updated_at'] = datetime.datetime.utcnow()
-        self.wf_col.update_one({'_id': self.workflow['_id']}, {'$set': self.workflow})
+        self._record_task_run_end(task_id, celery.states.FAILURE)
+        self._release_slots(step_name, [task_id])
+
+        if chunk is not None:
+            step_idx = self.get_step_idx(step_name)
+            self._update_chunk(step_idx, chunk, task_id, {
+                f'steps.{step_idx}.chunks.{chunk}.status': celery.states.FAILURE,
+                f'steps.{step_idx}.status': celery.states.FAILURE,
+                '_status': celery.states.FAILURE
+            })
+            return
+
+        def mark_failure():
+            if step_name is not None:
+                self.set_field(f'steps.{self.get_step_idx(step_name)}.status', celery.states.FAILURE)
+            self.set_field('_status', celery.states.FAILURE)
+            return True
+
+        self.transition(mark_failure, timeout_sec=self.HOOK_TRANSITION_TIMEOUT_SEC)
+
+    def on_step_retry(self, step_name: str, chunk: int = None, task_id: str = None) -> None:
+        """
+        Called by an instance of WorkflowTask when it is going to be retried. Marks the step as RETRY,
+        or the chunk for the tasks of a map step.
+
+        :param step_name: name of the step that the task is running
+        :param chunk: index of the chunk that the task runs, for the tasks of a map step
+        :param task_id: id of the task
+        :return: None
+        """
+        step_idx = self.get_step_idx(step_name)
+        if chunk is not None:
+            self._update_chunk(step_idx, chunk, task_id,
+                               {f'steps.{step_idx}.chunks.{chunk}.status': celery.states.RETRY})
+            return
+
+        def mark_retry():
+            self.set_field(f'steps.{step_idx}.status', celery.states.RETRY)
+            return True
+
+        self.transition(mark_retry, timeout_sec=self.HOOK_TRANSITION_TIMEOUT_SEC)
+
+    def _update_chunk(self, step_idx: int, chunk: int, task_id: str | None, updates: dict) -> bool:
+        """
+        Updates the workflow with a single atomic update, if the chunk of the map step is still run by the task.
+        The chunks of a step are updated without the version check of transition(), as their tasks end concurrently.
+
+        :param task_id: id of the chunk's task, None to update the chunk whichever task runs it
+        :return: False if the chunk has been restarted since, with a new task
+        """
+        query = {'_id': self.workflow['_id']}
+        if task_id is not None:
+            query[f'steps.{step_idx}.chunks.{chunk}.task_id'] = task_id
+        doc = self.wf_col.find_one_and_update(
+            query,
+            {'$set': {**updates, 'updated_at': datetime.datetime.utcnow()}, '$inc': {self.VERSION_ATTR: 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            return False
+        self._load(doc)
+        return True
+
+    def transition(self, mutate: Callable[[], Any], timeout_sec: float = None) -> Any:
+        """
+        Apply a state transition to the workflow atomically.
+
+        "mutate" makes its changes to the workflow object with set_field / push_field and returns a truthy value,
+        or returns a falsy value to abandon the transition.
+        The changes are written with a single find_one_and_update that only matches if the workflow's version
+        has not changed since it was read. If another writer got in between, the workflow is reloaded
+        and "mutate" is applied again to the latest state, so concurrent updates are never lost.
+        The attempts are spaced by a random exponential backoff (see TRANSITION_BACKOFF_SEC).
+
+        :param mutate: function that decides and makes the changes, called once per attempt
+        :param timeout_sec: keep attempting for this long instead of MAX_TRANSITION_ATTEMPTS times
+        :return: the value returned by the last call of "mutate", a falsy value if nothing was written
+        """
+        deadline = None if timeout_sec is None else time.monotonic() + timeout_sec
+        attempt = 0
+        while True:
+            try:
+                result = mutate()
+            except Exception:
+                self._changes = {}
+                raise
+            if not result:
+                self._changes = {}
+                return result
+            if self._write({self.VERSION_ATTR: self.workflow.get(self.VERSION_ATTR)}):
+                return result
+            attempt += 1
+            if attempt >= self.MAX_TRANSITION_ATTEMPTS if deadline is None else time.monotonic() >= deadline:
+                raise WFConflict(f'Workflow with id {self.workflow["_id"]} is being updated concurrently, '
+                                 f'gave up after {attempt} attempts')
+            time.sleep(random.uniform(0, min(self.TRANSITION_BACKOFF_SEC * 2 ** attempt,
+                                             self.TRANSITION_BACKOFF_MAX_SEC)))
+            self.refresh()
+
+    def _write(self, condition: dict = None) -> bool:
+        """
+        Write the pending changes and bump the version, replacing the workflow object with the updated document.
+
+        :param condition: additional filter the workflow document has to match
+        :return: False if the workflow document did not match the condition
+        """
+        if self.archived:
+            raise WFNotFound(f'Workflow with id {self.workflow["_id"]} is archived and cannot be updated')
+        self.set_field('updated_at', datetime.datetime.utcnow())
+        doc = self.wf_col.find_one_and_update({'_id': self.workflow['_id'], **(condition or {})}, self._pop_changes(),
+                                              return_document=ReturnDocument.AFTER)
+        if doc is None:
+            return False
+        self._load(doc)
+        return True
+
+    def _pop_changes(self) -> dict:
+        """
+        returns the update operators of the pending changes, with the version bump, and clears the pending changes.
+        The operators whose changes were all superseded are dropped, MongoDB < 5.0 rejects empty operators.
+        """
+        changes = {op: fields for op, fields in self._changes.items() if fields}
+        self._changes = {}
+        changes['$inc'] = {self.VERSION_ATTR: 1}
+        return changes
+
+    def set_field(self, path: str, value) -> None:
+        """
+        Set a field of the workflow object and record the change to be written by the next update().
+
+        :param path: dotted mongo field path, ex: "_status", "steps.0.status"
+        :param value: new value of the field
+        :return: None
+        """
+        _set_path(self.workflow, path, value)
+        changes = self._changes
+
+        if path in changes.get('$set', {}):
+            changes['$set'][path] = value
+            return
+        # a pending $set of an ancestor field already carries this change (its value is the mutated object)
+        if any(_covers(p, path) for p in changes.get('$set', {})):
+            return
+        # this $set supersedes the pending changes to the descendant fields
+        for op in ('$set', '$push', '$unset'):
+            for p in [p for p in changes.get(op, {}) if _covers(path, p)]:
+                del changes[op][p]
+        changes.setdefault('$set', {})[path] = value
+
+    def push_field(self, path: str, value) -> None:
+        """
+        Append a value to an array field of the workflow object (creating it if needed)
+        and record the change to be written by the next update().
+
+        :param path: dotted mongo field path of the array, ex: "steps.0.task_runs"
+        :param value: item to append
+        :return: None
+        """
+        parent_path, _, key = path.rpartition('.')
+        parent = _get_path(self.workflow, parent_path) if parent_path else self.workflow
+        if parent.get(key) is None:
+            parent[key] = []
+        parent[key].append(value)
+
+        changes = self._changes
+        if any(_covers(p, path) for p in changes.get('$set', {})):
+            return
+        changes.setdefault('$push', {}).setdefault(path, {'$each': []})['$each'].append(value)
+
+    def update(self, full: bool = False):
+        """
+        Write the changes made to the workflow object to mongo db, through set_field / push_field
+        or directly to the workflow dict. Only the changed fields are sent, not the whole workflow object.
+        The direct changes are found by comparing the workflow dict with the workflow as it was loaded.
+
+        Unlike transition(), this write is unconditional. It still bumps the version
+        so that concurrent transitions notice it.
+
+        :param full: overwrite the whole workflow object instead
+        :return: None
+        """
+        if full:
+            self._changes = {'$set': {k: v for k, v in self._stored_doc().items() if k != self.VERSION_ATTR}}
+        else:
+            self._track_direct_changes()
+        if not self._write():
+            raise WFNotFound(f'Workflow with id {self.workflow["_id"]} is not found')
+
+    def _track_direct_changes(self) -> None:
+        """
+        records the changes made to the workflow dict without set_field / push_field, see update()
+        """
+        if self._snapshot is None:
+            return
+        loaded = bson.decode(self._snapshot)
+        pending = [p for op in ('$set', '$push') for p in self._changes.get(op, {})]
+        for path, value in list(_diff(loaded, self.workflow)):
+            if path in ('updated_at', self.VERSION_ATTR) or any(_covers(p, path) for p in pending):
+                continue
+            if value is _REMOVED:
+                self._changes.setdefault('$unset', {})[path] = ''
+            else:
+                self.set_field(path, value)
 
     def lock_resume(self):
-        self.workflow[self.RESUME_LOCK_ATTR] = datetime.datetime.utcnow()
+        self.set_field(self.RESUME_LOCK_ATTR, datetime.datetime.utcnow())
 
     def is_resume_locked(self):
         return bool(self.workflow.get(self.RESUME_LOCK_ATTR, None))
 
     def unlock_resume(self):
         if self.RESUME_LOCK_ATTR in self.workflow:
-            self.workflow[self.RESUME_LOCK_ATTR] = None
+            self.set_field(self.RESUME_LOCK_ATTR, None)
 
     # def update_step_end_time(self, step_name):
     #     step = self.get_step(step_name)
@@ -274,7 +1740,7 @@ class Workflow:
     #         last_task_run['end_time'] = datetime.datetime.utcnow()
     #     self.update()
 
-    def get_step_status(self, step: dict) -> celery.states.state:
+    def get_step_status(self, step: dict, reconcile: bool = False) -> celery.states.state:
         """
         If there are any tasks run for this step, return the status of the last task run, else, return PENDING
 
@@ -285,7 +1751,12 @@ class Workflow:
         celery.states.STARTED
         celery.states.SUCCESS
 
+        The status is read from the step's "status" field that is maintained by the WorkflowTask hooks.
+        The result backend is queried only for steps without this field (workflows created by older versions)
+        or when reconcile is True.
         """
+        if not reconcile and 'status' in step:
+            return step['status']
         task_runs = step.get('task_runs', [])
         if len(task_runs) > 0:
             task_id = task_runs[-1]['task_id']
@@ -294,45 +1765,138 @@ class Workflow:
         else:
             return celery.states.PENDING
 
-    def get_pending_step(self) -> tuple[int, celery.states.state] | None:
+    def get_task_statuses(self, task_ids: list[str]) -> dict[str, celery.states.state]:
+        """
+        Fetches the status of the given tasks from the result backend with a single query.
+        Tasks that are not found in the result backend are PENDING, same as backend.get_status().
+
+        :return: dict {task_id: status}
+        """
+        if not task_ids:
+            return {}
+        col = self.taskmeta_col
+        found = {task['_id']: task['status'] for task in col.find({'_id': {'$in': list(task_ids)}}, {'status': 1})}
+        return {task_id: found.get(task_id, celery.states.PENDING) for task_id in task_ids}
+
+    def get_step_statuses(self, steps: list[dict] = None, reconcile: bool = False) -> list[celery.states.state]:
+        """
+        Same as get_step_status() for each of the steps, with at most one query to the result backend.
+
+        :param steps: steps to get the status of, defaults to all steps of the workflow
+        :param reconcile: query the result backend instead of using the steps' stored status
+        :return: list of statuses in the order of steps
+        """
+        steps = self.workflow['steps'] if steps is None else steps
+        statuses = [None if reconcile or 'status' not in step else step['status'] for step in steps]
+        last_task_ids = [
+            step['task_runs'][-1]['task_id'] if status is None and step.get('task_runs') else None
+            for step, status in zip(steps, statuses)
+        ]
+        task_statuses = self.get_task_statuses([task_id for task_id in last_task_ids if task_id is not None])
+        return [
+            status if status is not None else task_statuses.get(task_id, celery.states.PENDING)
+            for status, task_id in zip(statuses, last_task_ids)
+        ]
+
+    def reconcile(self) -> list[celery.states.state]:
+        """
+        Re-derive the status of each step from the result backend and store the ones that differ.
+        Use this to repair the stored statuses when a task did not run its hooks (ex: a worker was killed).
+
+        :return: list of step statuses in the order of steps
+        """
+
+        reconciled = {}
+
+        def store_statuses():
+            reconciled['statuses'] = statuses = self.get_step_statuses(reconcile=True)
+            changed = False
+            for i, (step, status) in enumerate(zip(self.workflow['steps'], statuses)):
+                if step.get('task_runs') and step.get('status') != status:
+                    self.set_field(f'steps.{i}.status', status)
+                    changed = True
+            return changed
+
+        self.transition(store_statuses)
+        return reconciled['statuses']
+
+    def get_pending_step(self, reconcile: bool = False) -> tuple[int, celery.states.state] | None:
         """
         finds the index of the first step whose status is not celery.states.SUCCESS
+        (the first frontier step in a workflow with parallel steps)
         if all steps have succeeded, it returns None
         :return: tuple (index:int, status:CELERY.states.STATE)
         """
-        statuses = [(i, self.get_step_status(step)) for i, step in enumerate(self.workflow['steps'])]
-        return next((s for s in statuses if s[1] != celery.states.SUCCESS), None)
+        return next(iter(self.get_frontier_steps(reconcile=reconcile)), None)
 
-    def get_workflow_status(self) -> celery.states.state:
+    def get_frontier_steps(self, reconcile: bool = False) -> list[tuple[int, celery.states.state]]:
+        """
+        finds the steps whose status is not celery.states.SUCCESS and whose dependencies have all succeeded,
+        the steps that are running or that the workflow is waiting on.
+        Without "depends_on", this is the first step that has not succeeded (the pending step).
+        if all steps have succeeded, it returns an empty list
+        :return: list of tuples (index:int, status:CELERY.states.STATE)
+        """
+        steps = self.workflow['steps']
+        return self._frontier(self.get_step_statuses(steps, reconcile=reconcile), _step_dependencies(steps))
+
+    @staticmethod
+    def _frontier(statuses: list[celery.states.state],
+                  dependencies: list[list[int]]) -> list[tuple[int, celery.states.state]]:
+        return [
+            (i, status) for i, status in enumerate(statuses)
+            if status != celery.states.SUCCESS and all(statuses[dep] == celery.states.SUCCESS for dep in dependencies[i])
+        ]
+
+    def get_workflow_status(self, reconcile: bool = False) -> celery.states.state:
         """
         The workflow status is a summative status that is determined by the
         status of the initial step that is not marked as "SUCCESS"
         which is referred to as a "pending step".
+        With parallel steps, it is determined by the statuses of all the frontier steps (see get_frontier_steps).
 
         - PENDING - the pending step is the first step in the workflow and its status is pending.
         - STARTED - the status of the pending step is one of STARTED, RETRY, PENDING.
         - REVOKED - the pending step was revoked, the workflow can be resumed.
         - FAILURE - the pending step was failed, the workflow can be resumed.
         - SUCCESS - all steps have succeeded.
+        - SCHEDULED - the workflow's start is waiting for admission (see ADMISSION_CONTROLLER).
+
+        A failed frontier step takes precedence over a revoked one, which takes precedence over running ones.
 
+        :param reconcile: derive the step statuses from the result backend instead of the workflow document
         :return: celery.states.state
         """
-        pending_step = self.get_pending_step()
-        if pending_step:
-            step_idx, task_status = pending_step
-            if step_idx == 0 and task_status == celery.states.PENDING:
-                return celery.states.PENDING
-            if task_status in [celery.states.STARTED, celery.states.RETRY, celery.states.PENDING]:
-                return celery.states.STARTED
-            else:
-                return task_status
-        else:
+        if self.workflow.get('_status') == SCHEDULED:
+            return SCHEDULED
+        return self._summarize_status(self.get_frontier_steps(reconcile=reconcile),
+                                      _step_dependencies(self.workflow['steps']))
+
+    @staticmethod
+    def _summarize_status(frontier: list[tuple[int, celery.states.state]],
+                          dependencies: list[list[int]]) -> celery.states.state:
+        if not frontier:
             return celery.states.SUCCESS
+        statuses = [task_status for _, task_status in frontier]
+        if all(task_status == celery.states.PENDING and not dependencies[i] for i, task_status in frontier):
+            # none of the first steps has started
+            return celery.states.PENDING
+        for task_status in [celery.states.FAILURE, celery.states.REVOKED]:
+            if task_status in statuses:
+                return task_status
+        if all(task_status in [celery.states.STARTED, celery.states.RETRY, celery.states.PENDING]
+               for task_status in statuses):
+            return celery.states.STARTED
+        return next(task_status for task_status in statuses
+                    if task_status not in [celery.states.STARTED, celery.states.RETRY, celery.states.PENDING])
 
     def get_step(self, step_name):
         it = itertools.dropwhile(lambda step: step['name'] != step_name, self.workflow['steps'])
         return next(it, None)
 
+    def get_step_idx(self, step_name: str) -> int | None:
+        return next((i for i, step in enumerate(self.workflow['steps']) if step['name'] == step_name), None)
+
     def get_next_step_idx(self, step_name: str) -> int | None:
         # it = itertools.dropwhile(lambda step: step['name'] != step_name, self.workflow['steps'])
         # skip_one_it = itertools.islice(it, 1, None)
@@ -348,23 +1912,47 @@ class Workflow:
         return None
 
     def get_task_instance(self, task_id, date_start=None):
-        col = self.app.backend.collection
+        col = self.taskmeta_col
         task = col.find_one({'_id': task_id})
         if task is not None:
+            self._decode_task_instance(task)
             task['date_start'] = date_start
-            if 'result' in task and task['result'] is not None:
-                try:
-                    task['result'] = json.loads(task['result'])
-                except Exception as e:
-                    print('unable to parse result json', e, task['_id'], task['result'])
-            if 'date_done' in task:
-                try:
-                    task['date_done'] = datetime.datetime.strptime(task['date_done'], "%Y-%m-%dT%H:%M:%S.%f")
-                except Exception as e:
-                    print('unable to convert date_done date string into date object', e, task['_id'], task['date_done'])
+        return task
 
+    def get_task_instances(self, task_ids: list[str]) -> dict[str, dict]:
+        """
+        Fetches and decodes the task instances (task objects) of the given task ids with a single query.
+
+        :return: dict {task_id: task instance}, tasks that are not found in the result backend are left out
+        """
+        if not task_ids:
+            return {}
+        col = self.taskmeta_col
+        return {task['_id']: self._decode_task_instance(task) for task in col.find({'_id': {'$in': list(task_ids)}})}
+
+    @staticmethod
+    def _decode_task_instance(task: dict) -> dict:
+        if 'result' in task and task['result'] is not None:
+            try:
+                task['result'] = json.loads(task['result'])
+            except Exception as e:
+                print('unable to parse result json', e, task['_id'], task['result'])
+        if 'date_done' in task:
+            try:
+                task['date_done'] = _parse_date_done(task['date_done'])
+            except Exception as e:
+                print('unable to convert date_done date string into date object', e, task['_id'], task['date_done'])
         return task
 
+    @staticmethod
+    def _task_run_instance(task_instances: dict[str, dict], task_run: dict) -> dict | None:
+        """
+        returns the task instance of a task run from the prefetched task instances
+        """
+        task = task_instances.get(task_run['task_id'])
+        if task is not None:
+            return {**task, 'date_start': task_run.get('date_start', None)}
+
     def get_last_run_task_instance(self, step):
         """
         returns the latest task instance (task object) from the step object
@@ -375,45 +1963,166 @@ class Workflow:
             date_start = task_runs[-1].get('date_start', None)
             return self.get_task_instance(task_id, date_start)
 
+    def get_step_result(self, step: dict) -> Any:
+        """
+        returns the decoded result (return value) of the latest task run of the step, None if there is none.
+        This is a single lookup by task id that only fetches the result field.
+        """
+        task_runs = step.get('task_runs') or []
+        if not task_runs:
+            return None
+        task = self.taskmeta_col.find_one({'_id': task_runs[-1]['task_id']}, {'result': 1})
+        if task is None or task.get('result') is None:
+            return None
+        return self._decode_task_instance(task)['result']
+
     def refresh(self):
-        workflow_id = self.workflow['_id']
-        res = self.wf_col.find_one({'_id': workflow_id})
-        if res:
-            self.workflow = res
-        else:
-            raise WFNotFound(f'Workflow with id {workflow_id} is not found')
+        self._load(self._find_doc(self.workflow['_id']))
 
-    def get_embellished_workflow(self, last_task_run=True, prev_task_runs=False, refresh=True):
+    def get_embellished_workflow(self, last_task_run=True, prev_task_runs=False, refresh=True,
+                                 inline_prev_task_runs=False):
         """
 
         @param last_task_run: include last run task for each step: boolean
-        @param prev_task_runs: include previous task runs for each step: boolean
+        @param prev_task_runs: include previous task runs for each step: boolean.
+            The runs that were moved out of the workflow document (see MAX_INLINE_TASK_RUNS) are fetched
+            TASK_RUNS_PAGE_SIZE at a time, as "prev_task_runs" is iterated.
         @param refresh: fetch latest workflow state from db
+        @param inline_prev_task_runs: with prev_task_runs, only include the runs in the workflow document, as a list,
+            and the number of older runs that were moved out in "spilled_task_runs", so that no query depends on
+            the history of the steps
         :return:
 
         """
         if refresh:
             self.refresh()
-        status = self.get_workflow_status()
-        pending_step_idx, _ = self.get_pending_step() or (None, None)
-        steps = []
+        # fetch the task instances of all the steps at once
+        task_instances = self.get_task_instances(self._embellish_task_ids(last_task_run, prev_task_runs))
+        return self._embellish(task_instances, last_task_run, prev_task_runs, inline_prev_task_runs)
+
+    @classmethod
+    def embellish_many(cls, celery_app, workflow_ids: list[str], last_task_run=True, prev_task_runs=False,
+                       inline_prev_task_runs=False) -> list[dict]:
+        """
+        Same as get_embellished_workflow() for many workflows, with two queries in total irrespective of
+        the number of workflows: one to fetch the workflows and one to fetch the task instances of all of them.
+
+        @param celery_app: celery app whose result backend stores the workflows
+        @param workflow_ids: ids of the workflows to embellish
+        @param last_task_run: include last run task for each step: boolean
+        @param prev_task_runs: include previous task runs for each step: boolean
+        @param inline_prev_task_runs: with prev_task_runs, only include the runs in the workflow documents,
+            see get_embellished_workflow()
+        :return: list of embellished workflows in the order of workflow_ids, workflows that are not found are left out
+        """
+        wf_col = celery_app.backend.database.get_collection('workflow_meta')
+        docs = {doc['_id']: doc for doc in wf_col.find({'_id': {'$in': list(workflow_ids)}})}
+        workflows = [cls.from_doc(celery_app, docs[workflow_id]) for workflow_id in workflow_ids if workflow_id in docs]
+        if not workflows:
+            return []
+
+        task_ids = [task_id for wf in workflows for task_id in wf._embellish_task_ids(last_task_run, prev_task_runs)]
+        task_instances = workflows[0].get_task_instances(task_ids)
+        return [wf._embellish(task_instances, last_task_run, prev_task_runs, inline_prev_task_runs) for wf in workflows]
+
+    def _embellish_task_ids(self, last_task_run: bool, prev_task_runs: bool) -> list[str]:
+        """
+        returns the ids of the task instances needed to embellish this workflow
+        """
+        task_ids = []
         for step in self.workflow['steps']:
+            task_runs = step.get('task_runs', [])
+            # the last task instance also provides the status of a step without a stored status
+            if len(task_runs) > 0 and (last_task_run or 'status' not in step):
+                task_ids.append(task_runs[-1]['task_id'])
+            if prev_task_runs:
+                task_ids.extend(t['task_id'] for t in task_runs[:-1])
+        return task_ids
+
+    def iter_spilled_task_runs(self, step: dict) -> Iterator[dict]:
+        """
+        yields the task runs of the step that were moved out of the workflow document (see MAX_INLINE_TASK_RUNS),
+        oldest first. The task runs are fetched TASK_RUNS_PAGE_SIZE at a time, as the iteration proceeds.
+        """
+        spilled = step.get('spilled_task_runs', 0)
+        if spilled > 0:
+            # with NORMALIZE_TASK_RUNS, the collection also has the task runs still in the workflow document
+            query = {'workflow_id': self.workflow['_id'], 'step': step['name'], 'run_idx': {'$lt': spilled}}
+            cursor = self.task_runs_col \
+                .find(query) \
+                .sort('run_idx', ASCENDING) \
+                .batch_size(self.TASK_RUNS_PAGE_SIZE)
+            yield from cursor
+
+    def iter_task_runs(self, step: dict) -> Iterator[dict]:
+        """
+        yields all the task runs of the step, oldest first, including the ones moved out of the workflow document
+        """
+        yield from self.iter_spilled_task_runs(step)
+        yield from step.get('task_runs', [])
+
+    def iter_task_run_instances(self, task_runs: Iterable[dict]) -> Iterator[dict | None]:
+        """
+        yields the task instances of the task runs, fetched with one query per TASK_RUNS_PAGE_SIZE task runs
+        """
+        task_runs = iter(task_runs)
+        while page := list(itertools.islice(task_runs, self.TASK_RUNS_PAGE_SIZE)):
+            task_instances = self.get_task_instances([t['task_id'] for t in page])
+            for task_run in page:
+                yield self._task_run_instance(task_instances, task_run)
+
+    def _iter_prev_task_run_instances(self, step: dict, task_instances: dict[str, dict]) -> Iterator[dict | None]:
+        """
+        yields the task instances of the step's task runs but the last, oldest first. The instances of the runs
+        in the workflow document are taken from the prefetched task instances, the ones of the runs that were
+        moved out are fetched as the iteration proceeds.
+        """
+        yield from self.iter_task_run_instances(self.iter_spilled_task_runs(step))
+        for task_run in step.get('task_runs', [])[:-1]:
+            yield self._task_run_instance(task_instances, task_run)
+
+    def _embellish(self, task_instances: dict[str, dict], last_task_run: bool, prev_task_runs: bool,
+                   inline_prev_task_runs: bool = False) -> dict:
+        """
+        builds the embellished workflow from the prefetched task instances, see get_embellished_workflow()
+        """
+        dependencies = _step_dependencies(self.workflow['steps'])
+        step_statuses = []
+        for step in self.workflow['steps']:
+            task_runs = step.get('task_runs', [])
+            if 'status' in step:
+                step_statuses.append(step['status'])
+            elif len(task_runs) > 0 and task_runs[-1]['task_id'] in task_instances:
+                step_statuses.append(task_instances[task_runs[-1]['task_id']]['status'])
+            else:
+                step_statuses.append(celery.states.PENDING)
+        status = SCHEDULED if self.workflow.get('_status') == SCHEDULED else \
+            self._summarize_status(self._frontier(step_statuses, dependencies), dependencies)
+        steps = []
+        for step, step_status in zip(self.workflow['steps'], step_statuses):
             emb_step = {
                 'name': step['name'],
                 'task': step['task'],
-                'status': self.get_step_status(step)
+                'status': step_status
             }
-            if last_task_run:
-                emb_step['last_task_run'] = self.get_last_run_task_instance(step)
-            if prev_task_runs:
-                emb_step['prev_task_runs'] = [
-                    self.get_task_instance(t['task_id'], t.get('date_start', None)) for t in
-                    step.get('task_runs', [])[:-1]
+            if 'depends_on' in step:
+                emb_step['depends_on'] = step['depends_on']
+            if 'chunks' in step:
+                emb_step['chunks'] = [
+                    {'task_id': chunk['task_id'], 'status': chunk.get('status', celery.states.PENDING)}
+                    for chunk in step['chunks']
                 ]
+            task_runs = step.get('task_runs', [])
+            if last_task_run:
+                emb_step['last_task_run'] = \
+                    self._task_run_instance(task_instances, task_runs[-1]) if len(task_runs) > 0 else None
+            if prev_task_runs and inline_prev_task_runs:
+                emb_step['prev_task_runs'] = [self._task_run_instance(task_instances, t) for t in task_runs[:-1]]
+                emb_step['spilled_task_runs'] = step.get('spilled_task_runs', 0)
+            elif prev_task_runs:
+                emb_step['prev_task_runs'] = self._iter_prev_task_run_instances(step, task_instances)
             steps.append(emb_step)
 
-        # number of steps done is same of index of the pending step
-        # if all steps are complete pending_step_idx is None, then steps_done is len(steps)
         return {
             'id': self.workflow['_id'],
             'name': self.workflow.get('name', None),
@@ -422,12 +2131,181 @@ class Workflow:
             'created_at': self.workflow.get('created_at', None),
             'updated_at': self.workflow.get('updated_at', None),
             'status': status,
-            'steps_done': pending_step_idx if pending_step_idx is not None else len(steps),
+            'steps_done': sum(1 for step_status in step_statuses if step_status == celery.states.SUCCESS),
             'total_steps': len(steps),
             'steps': steps,
             self.RESUME_LOCK_ATTR: self.workflow.get(self.RESUME_LOCK_ATTR, None)
         }
 
+    @classmethod
+    def find(cls, celery_app, app_id: str = None, status: str | list[str] = None,
+             created_between: tuple[datetime.datetime | None, datetime.datetime | None] = None,
+             name: str = None, limit: int = None, after: str = None) -> Iterator[Workflow]:
+        """
+        Lists the workflows that match all the given filters, newest first.
+        The workflows are streamed from mongo db as the result is iterated.
+
+        Paginate with keyset cursors: pass the cursor() of the last workflow of a page as "after" to get the next page.
+        Unlike skip / limit, every page is an index range scan (see ensure_indexes) no matter how deep it is.
+
+        :param celery_app: celery app whose result backend stores the workflows
+        :param app_id: app_id of the workflows
+        :param status: stored workflow status ("_status") or a list of them
+        :param created_between: (start, end) the workflows created at or after start and before end, either can be None
+        :param name: name of the workflows
+        :param limit: maximum number of workflows to return
+        :param after: cursor of the workflow after which to start listing
+        :return: iterator of Workflow objects
+        """
+        query = {}
+        if app_id is not None:
+            query['app_id'] = app_id
+        if status is not None:
+            query['_status'] = status if isinstance(status, str) else {'$in': list(status)}
+        if name is not None:
+            query['name'] = name
+        if created_between is not None:
+            start, end = created_between
+            if start is not None:
+                query.setdefault('created_at', {})['$gte'] = start
+            if end is not None:
+                query.setdefault('created_at', {})['$lt'] = end
+        if after is not None:
+            created_at, workflow_id = cls._decode_cursor(after)
+            query['$or'] = [
+                {'created_at': {'$lt': created_at}},
+                {'created_at': created_at, '_id': {'$lt': workflow_id}}
+            ]
+
+        wf_col = celery_app.backend.database.get_collection('workflow_meta')
+        cursor = wf_col.find(query).sort([('created_at', DESCENDING), ('_id', DESCENDING)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        for doc in cursor:
+            yield cls.from_doc(celery_app, doc)
+
+    @classmethod
+    def locate_task(cls, celery_app, task_id: str) -> dict | None:
+        """
+        Finds the workflow step and the run of a task with a point lookup in the task_id reverse index.
+
+        :return: dict { "workflow_id": str, "step_idx": int, "run_idx": int } or None if the task is not found
+        """
+        db = celery_app.backend.database
+        entry = db.get_collection('workflow_task_index').find_one({'_id': task_id})
+        if entry is None:
+            # tasks of the normalized storage layout and the task runs moved out of the workflow documents
+            entry = db.get_collection('workflow_task_runs').find_one({'_id': task_id})
+        if entry is None:
+            # tasks that started before the reverse index existed
+            doc = db.get_collection('workflow_meta').find_one({'steps.task_runs.task_id': task_id}, {'steps': 1})
+            if doc is None:
+                return None
+            for step_idx, step in enumerate(doc['steps']):
+                for run_idx, task_run in enumerate(step.get('task_runs', [])):
+                    if task_run['task_id'] == task_id:
+                        entry = {'workflow_id': doc['_id'], 'step_idx': step_idx, 'run_idx': run_idx}
+        return {
+            'workflow_id': entry['workflow_id'],
+            'step_idx': entry['step_idx'],
+            'run_idx': entry['run_idx']
+        }
+
+    @classmethod
+    def from_task_id(cls, celery_app, task_id: str) -> Workflow:
+        """
+        Loads the workflow that ran the task with the given id.
+        """
+        location = cls.locate_task(celery_app, task_id)
+        if location is None:
+            raise WFNotFound(f'Workflow of the task with id {task_id} is not found')
+        return cls(celery_app, location['workflow_id'])
+
+    def cursor(self) -> str:
+        """
+        returns an opaque cursor that marks the position of this workflow in the results of find()
+        """
+        created_at = self.workflow['created_at']
+        # mongo db stores dates with millisecond precision
+        created_at = created_at.replace(microsecond=created_at.microsecond // 1000 * 1000)
+        key = [created_at.isoformat(), self.workflow['_id']]
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> tuple[datetime.datetime, str]:
+        try:
+            created_at, workflow_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.datetime.fromisoformat(created_at), workflow_id
+        except ValueError as e:
+            raise ValueError(f'invalid cursor: {cursor}') from e
+
+
+# indexes of the workflow_meta collection
+# the ones that serve the queries of Workflow.find() end with its sort keys (created_at, _id)
+WORKFLOW_INDEXES = [
+    IndexModel([('created_at', DESCENDING), ('_id', DESCENDING)], name='created_at'),
+    IndexModel([('app_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='app_id_created_at'),
+    IndexModel([('app_id', ASCENDING), ('_status', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+               name='app_id_status_created_at'),
+    IndexModel([('_status', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='status_created_at'),
+    IndexModel([('name', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='name_created_at'),
+    # recently updated / stale workflows
+    IndexModel([('updated_at', DESCENDING)], name='updated_at'),
+    # finished workflows to archive, see sca_rhythm.archive
+    IndexModel([('app_id', ASCENDING), ('_status', ASCENDING), ('updated_at', ASCENDING)],
+               name='app_id_status_updated_at'),
+    # task messages waiting in the outbox, see sca_rhythm.outbox
+    IndexModel([('outbox.created_at', ASCENDING)], name='outbox_created_at'),
+    # scheduled workflows in the order they are started, see Workflow.start_scheduled
+    IndexModel([('_status', ASCENDING), ('app_id', ASCENDING), ('scheduled.scheduled_at', ASCENDING)],
+               name='scheduled', partialFilterExpression={'_status': SCHEDULED}),
+    # the workflow that ran a task, for the tasks that are not in the workflow_task_index collection
+    IndexModel([('steps.task_runs.task_id', ASCENDING)], name='task_id'),
+]
+
+# indexes of the workflow_task_runs collection
+TASK_RUN_INDEXES = [
+    IndexModel([('workflow_id', ASCENDING), ('step', ASCENDING), ('run_idx', ASCENDING)], name='workflow_step_run'),
+    # ex: the runs of a task that took longer than an hour
+    IndexModel([('task', ASCENDING), ('duration_sec', DESCENDING)], name='task_duration'),
+]
+
+# indexes of the workflow_chunk_outputs collection
+CHUNK_OUTPUT_INDEXES = [
+    IndexModel([('workflow_id', ASCENDING)], name='workflow_id'),
+]
+
+# databases whose indexes have been ensured by this process, see Workflow.ENSURE_INDEXES
+_indexed_databases = set()
+
+
+def ensure_indexes(celery_app) -> list[str]:
+    """
+    Creates the indexes of the workflow_meta collection (WORKFLOW_INDEXES), the workflow_task_runs collection
+    (TASK_RUN_INDEXES), the workflow_chunk_outputs collection (CHUNK_OUTPUT_INDEXES), the workflow_deferred collection
+    (DEFERRED_INDEXES, see sca_rhythm.limits) and those of Workflow.PAYLOAD_STORE.
+    Indexes that already exist are left as they are, so this can be called on every deployment.
+
+    :param celery_app: celery app whose result backend stores the workflows
+    :return: names of the indexes
+    """
+    db = celery_app.backend.database
+    return [
+        *db.get_collection('workflow_meta').create_indexes(WORKFLOW_INDEXES),
+        *db.get_collection('workflow_task_runs').create_indexes(TASK_RUN_INDEXES),
+        *db.get_collection(CHUNK_OUTPUTS_COLLECTION).create_indexes(CHUNK_OUTPUT_INDEXES),
+        *db.get_collection(DEFERRED_COLLECTION).create_indexes(DEFERRED_INDEXES),
+        *(Workflow.PAYLOAD_STORE.ensure_indexes() if Workflow.PAYLOAD_STORE is not None else []),
+    ]
+
+
+def _ensure_indexes_once(celery_app) -> None:
+    db = celery_app.backend.database
+    key = (id(db.client), db.name)
+    if key not in _indexed_databases:
+        ensure_indexes(celery_app)
+        _indexed_databases.add(key)
+
 
 class WorkflowTask(Task):  # noqa
     # trail = True
@@ -438,6 +2316,27 @@ class WorkflowTask(Task):  # noqa
         self.workflow_id = None
         self.step = None
 
+    def __call__(self, *args, **kwargs):
+        # a direct call, or a run outside of a workflow, is a plain call of the task body
+        in_workflow = not self.request.called_directly and self.workflow is not None and 'step' in kwargs and \
+            self.workflow.workflow['_id'] == kwargs.get('workflow_id')
+        if not in_workflow:
+            return super().__call__(*args, **kwargs)
+        # the outputs of the chunks of a map step are passed to the next step by reference
+        args = [self.workflow.gather_chunk_outputs(arg) for arg in args]
+        # the large values passed between the steps are resolved before and offloaded after the task body runs,
+        # so that neither the task messages nor the result backend carry them (see Workflow.PAYLOAD_STORE).
+        # The output of a step that is not used (ex: the last step's) is returned as it is.
+        store = Workflow.PAYLOAD_STORE
+        if store is None:
+            return super().__call__(*args, **kwargs)
+        retval = super().__call__(*[store.resolve(arg) for arg in args], **kwargs)
+        if isinstance(retval, (tuple, list)) and len(retval) > 0 and \
+                self.workflow.output_used(kwargs['step'], kwargs.get('chunk')):
+            retval = (store.offload(retval[0], Workflow.PAYLOAD_THRESHOLD_BYTES, kwargs['workflow_id']),
+                      *retval[1:])
+        return retval
+
     def before_start(self, task_id, args, kwargs):
         # print(f' before_start, task_id:{task_id}, kwargs:{kwargs} name:{self.name}')
 
@@ -455,20 +2354,26 @@ class WorkflowTask(Task):  # noqa
             step = kwargs['step']
             self.workflow_id = workflow_id
             self.step = step
-            self.workflow = Workflow(self.app, workflow_id)
-            self.workflow.on_step_start(step, task_id)
+            # on_step_start fetches the workflow document as part of its update, no need to load it first
+            self.workflow = Workflow.from_doc(self.app, {'_id': workflow_id})
+            self.workflow.on_step_start(step, task_id, chunk=kwargs.get('chunk'))
 
     def on_success(self, retval, task_id, args, kwargs):
         # print(f' on_success, task_id: {task_id}, kwargs: {kwargs}')
 
         if self.workflow is not None:
-            self.workflow.on_step_success(retval, kwargs['step'])
+            delivery_info = self.request.delivery_info or {}
+            self.workflow.on_step_success(retval, kwargs['step'], task_id, queue=delivery_info.get('routing_key'),
+                                          chunk=kwargs.get('chunk'))
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         # print('in on_failure', exc, task_id, args, kwargs, einfo)
         if self.workflow is not None:
-            # self.workflow.on_step_failure(exc, kwargs['step'])
-            self.workflow.on_step_failure()
+            self.workflow.on_step_failure(kwargs['step'], task_id, chunk=kwargs.get('chunk'))
+
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        if self.workflow is not None:
+            self.workflow.on_step_retry(kwargs['step'], chunk=kwargs.get('chunk'), task_id=task_id)
 
     def update_progress(self, progress_obj):
         # called_directly: This flag is set to true if the task was not executed by the worker.
@@ -0,0 +1,208 @@
+"""
+Admission control of the workflow starts (see Workflow.ADMISSION_CONTROLLER).
+
+The starts of an app_id are rate limited with a token bucket: a start takes a token, the bucket is refilled with "rate"
+tokens per second up to "burst" tokens. A workflow that does not get a token is not started, it is stored with the
+SCHEDULED status and the args of its start. The dispatcher starts the scheduled workflows, in the order they were
+scheduled, as the tokens are refilled, or without waiting for tokens while the broker queues of the app are short.
+
+With fair_share, all the starts of the limited app_ids go through the dispatcher, which shares the starts between the
+app_ids by weight: every round, the next start goes to the app_id with the fewest in flight workflows per weight,
+so an app_id with a large backlog does not starve the others.
+
+The buckets are stored in the workflow_admission collection, so the rate is shared by all the processes that start
+workflows. Run a dispatcher per database:
+
+usage: python -m sca_rhythm.admission -A proj.celery:app [--interval 1] [--batch-size 100]
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import heapq
+import time
+
+from celery.utils.imports import symbol_by_name
+from pymongo.errors import DuplicateKeyError
+
+BUCKETS_COLLECTION = 'workflow_admission'
+
+
+class AdmissionController:
+    """
+    Rate limits the workflow starts per app_id.
+
+    A limit is a dict with the sustained rate "rate" (starts per second) and the number of starts "burst" that can be
+    admitted at once after an idle period. With "queues" and "low_queue_depth", the dispatcher also admits the
+    scheduled workflows of the app without tokens while the total number of messages in these broker queues is below
+    low_queue_depth, ex: {'rate': 5, 'burst': 50, 'queues': ['celery'], 'low_queue_depth': 100}.
+    The "weight" of a limit (default: 1) is the app's share of the starts with fair_share.
+
+    :param database: mongo database that stores the token buckets, ex: the result backend's
+    :param limits: limit per app_id
+    :param default: limit of the app_ids that are not in limits, each app_id has its own bucket.
+        None to not limit these app_ids.
+    :param fair_share: schedule all the starts of the limited app_ids, the dispatcher starts them in proportion to
+        the weights of the app_ids, favoring the app_ids with the fewest workflows in flight
+    :param max_inflight: with fair_share, maximum number of workflows in flight, the dispatcher only starts workflows
+        while there are fewer. None to only limit the starts by their rates.
+        The workflows in flight are the ones that the dispatcher started and that have not finished.
+    :param inflight_stale_sec: the workflows in flight that were not updated for this long (ex: their worker was
+        killed) are not counted, longer than the longest step. None to count them until they finish.
+    """
+
+    MAX_ATTEMPTS = 10
+
+    def __init__(self, database, limits: dict[str, dict] = None, default: dict = None, fair_share: bool = False,
+                 max_inflight: int = None, inflight_stale_sec: float = None):
+        self.limits = limits or {}
+        self.default = default
+        self.fair_share = fair_share
+        self.max_inflight = max_inflight
+        self.inflight_stale_sec = inflight_stale_sec
+        for app_id, limit in [*self.limits.items(), ('default', default)]:
+            if limit is None:
+                continue
+            assert limit.get('rate', 0) > 0 and limit.get('burst', 0) >= 1, \
+                f'the limit of {app_id} should have a positive rate and a burst of at least 1'
+            assert ('queues' in limit) == ('low_queue_depth' in limit), \
+                f'the limit of {app_id} should have both or none of queues and low_queue_depth'
+            assert limit.get('weight', 1) > 0, f'the weight of {app_id} should be positive'
+        self.buckets_col = database.get_collection(BUCKETS_COLLECTION)
+
+    def limit_of(self, app_id: str) -> dict | None:
+        return self.limits.get(app_id, self.default)
+
+    def weight_of(self, app_id: str) -> float:
+        return (self.limit_of(app_id) or {}).get('weight', 1)
+
+    def allocate(self, backlogs: dict[str, int], inflight: dict[str, int], n: int) -> dict[str, int]:
+        """
+        Shares n starts between the app_ids, one at a time, each to the app_id with the fewest workflows in flight
+        per weight (counting the starts already given to it), so the app_ids with few workflows in flight are served
+        first and then the starts alternate in proportion to the weights.
+
+        :param backlogs: number of scheduled workflows per app_id, an app_id gets at most its backlog
+        :param inflight: number of workflows in flight per app_id
+        :param n: number of starts to share
+        :return: number of starts per app_id
+        """
+        allocation = {app_id: 0 for app_id in backlogs}
+        heap = [(inflight.get(app_id, 0) / self.weight_of(app_id), app_id)
+                for app_id, backlog in backlogs.items() if backlog > 0]
+        heapq.heapify(heap)
+        while n > 0 and heap:
+            _, app_id = heapq.heappop(heap)
+            allocation[app_id] += 1
+            n -= 1
+            if allocation[app_id] < backlogs[app_id]:
+                heapq.heappush(heap, ((inflight.get(app_id, 0) + allocation[app_id]) / self.weight_of(app_id), app_id))
+        return allocation
+
+    def take(self, app_id: str, n: int = 1) -> int:
+        """
+        Takes up to n tokens from the bucket of the app_id.
+
+        :return: number of tokens taken, n if the app_id is not limited
+        """
+        limit = self.limit_of(app_id)
+        if limit is None:
+            return n
+        for _ in range(self.MAX_ATTEMPTS):
+            now = datetime.datetime.utcnow()
+            bucket = self.buckets_col.find_one({'_id': app_id})
+            if bucket is None:
+                granted = min(n, int(limit['burst']))
+                try:
+                    self.buckets_col.insert_one({'_id': app_id, 'tokens': limit['burst'] - granted, 'updated_at': now})
+                except DuplicateKeyError:
+                    continue
+                return granted
+            elapsed = max((now - bucket['updated_at']).total_seconds(), 0)
+            tokens = min(limit['burst'], bucket['tokens'] + elapsed * limit['rate'])
+            granted = min(n, int(tokens))
+            if granted == 0:
+                return 0
+            # the bucket is updated only if no other process took tokens since it was read
+            res = self.buckets_col.update_one({'_id': app_id, 'updated_at': bucket['updated_at']},
+                                              {'$set': {'tokens': tokens - granted, 'updated_at': now}})
+            if res.modified_count:
+                return granted
+        return 0
+
+    def give_back(self, app_id: str, n: int) -> None:
+        """
+        Puts back n tokens taken from the bucket of the app_id that were not used, ex: by the dispatcher for
+        scheduled workflows that another process started in between. The bucket does not exceed its burst.
+        """
+        limit = self.limit_of(app_id)
+        if limit is None or n <= 0:
+            return
+        for _ in range(self.MAX_ATTEMPTS):
+            now = datetime.datetime.utcnow()
+            bucket = self.buckets_col.find_one({'_id': app_id})
+            if bucket is None:
+                return
+            elapsed = max((now - bucket['updated_at']).total_seconds(), 0)
+            tokens = min(limit['burst'], bucket['tokens'] + elapsed * limit['rate'] + n)
+            res = self.buckets_col.update_one({'_id': app_id, 'updated_at': bucket['updated_at']},
+                                              {'$set': {'tokens': tokens, 'updated_at': now}})
+            if res.modified_count:
+                return
+
+    def queues_short(self, celery_app, app_id: str) -> bool:
+        """
+        returns True if the scheduled workflows of the app_id can be started without tokens:
+        its limit has "queues" and they have fewer than low_queue_depth messages
+        """
+        limit = self.limit_of(app_id)
+        return limit is not None and 'queues' in limit and \
+            queue_depth(celery_app, limit['queues']) < limit['low_queue_depth']
+
+
+def queue_depth(celery_app, queues: list[str]) -> int:
+    """
+    returns the total number of messages that are ready in the broker queues.
+    A queue that does not exist (yet) counts as empty.
+    """
+    depth = 0
+    with celery_app.connection_for_read() as conn:
+        for queue in queues:
+            # the broker closes the channel of a failed passive declare, every queue gets its own channel
+            channel = conn.channel()
+            try:
+                depth += channel.queue_declare(queue=queue, passive=True).message_count
+            except conn.channel_errors:
+                pass
+            finally:
+                channel.close()
+    return depth
+
+
+def run_dispatcher(celery_app, batch_size: int = 100, interval_sec: float = 1) -> None:
+    """
+    Starts the scheduled workflows that are admitted, every interval_sec, until interrupted.
+    """
+    from sca_rhythm import Workflow
+    while True:
+        if Workflow.start_scheduled(celery_app, batch_size=batch_size) == 0:
+            time.sleep(interval_sec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start the scheduled workflows at the rate of their app_id')
+    parser.add_argument('-A', '--app', required=True,
+                        help='celery app, ex: proj.celery:app. Importing it should set Workflow.ADMISSION_CONTROLLER')
+    parser.add_argument('--batch-size', type=int, default=100, help='maximum number of workflows started per app_id '
+                                                                     'per round')
+    parser.add_argument('--interval', type=float, default=1, help='seconds to wait when no workflow was started')
+    args = parser.parse_args()
+
+    celery_app = symbol_by_name(args.app)
+    from sca_rhythm import Workflow
+    assert Workflow.ADMISSION_CONTROLLER is not None, 'Workflow.ADMISSION_CONTROLLER is not set'
+    run_dispatcher(celery_app, batch_size=args.batch_size, interval_sec=args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Archival of the finished workflows.
+
+The workflows that finished (by default: SUCCESS) more than the retention period ago are moved out of the
+workflow_meta collection in batches, together with the celery taskmeta documents of their tasks and their documents
+in the workflow_task_runs collection. Their entries in the task_id reverse index (workflow_task_index) are deleted. They are moved either to the archive collections (workflow_meta_archive,
+celery_taskmeta_archive and workflow_task_runs_archive), where Workflow(app, workflow_id) still finds them, or to
+gzip compressed JSONL files.
+
+The payloads of the archived workflows (see Workflow.PAYLOAD_STORE) and the outputs of the chunks of their map steps
+are deleted, they are not archived.
+
+The documents are written to the archive before they are deleted, and a workflow is only deleted if it did not change
+since it was read, so an interrupted or concurrent archival does not lose workflows.
+
+usage: python -m sca_rhythm.archive -A proj.celery:app --retention-days 30 [--app-retention app1=7 ...] [--to-dir dir]
+"""
+import argparse
+import datetime
+import gzip
+import logging
+import os
+
+import celery.states
+from bson import json_util
+from celery.utils.imports import symbol_by_name
+from pymongo import ReplaceOne
+
+from sca_rhythm import (ARCHIVE_COLLECTION, CHUNK_OUTPUTS_COLLECTION, TASK_RUNS_ARCHIVE_COLLECTION,
+                        TASKMETA_ARCHIVE_COLLECTION, Workflow)
+
+logger = logging.getLogger(__name__)
+
+
+def archive_workflows(celery_app,
+                      retention_days: float = None,
+                      app_id_retention_days: dict[str, float] = None,
+                      statuses: tuple[str] = (celery.states.SUCCESS,),
+                      batch_size: int = 500,
+                      directory: str = None) -> int:
+    """
+    Archives the workflows in one of the given statuses that were last updated before their retention period.
+
+    :param celery_app: celery app whose result backend stores the workflows
+    :param retention_days: retention period of the workflows, None to only archive the apps in app_id_retention_days
+    :param app_id_retention_days: retention period per app_id, overrides retention_days for these apps
+    :param statuses: workflow statuses to archive
+    :param batch_size: number of workflows archived per batch
+    :param directory: write the archived documents to gzip compressed JSONL files in this directory instead of the
+        archive collections
+    :return: number of workflows archived
+    """
+    app_id_retention_days = app_id_retention_days or {}
+    wf_col = celery_app.backend.database.get_collection('workflow_meta')
+    now = datetime.datetime.utcnow()
+
+    queries = [
+        {'app_id': app_id, 'updated_at': {'$lt': now - datetime.timedelta(days=days)}}
+        for app_id, days in app_id_retention_days.items()
+    ]
+    if retention_days is not None:
+        queries.append({
+            'app_id': {'$nin': list(app_id_retention_days)},
+            'updated_at': {'$lt': now - datetime.timedelta(days=retention_days)}
+        })
+
+    archived = 0
+    for query in queries:
+        query['_status'] = {'$in': list(statuses)}
+        while True:
+            docs = list(wf_col.find(query).limit(batch_size))
+            if not docs:
+                break
+            count = _archive_batch(celery_app, docs, directory)
+            archived += count
+            logger.info('archived %d workflows', archived)
+            if count == 0:
+                # the whole batch changed while it was archived, it no longer matches or is picked up again
+                break
+    return archived
+
+
+def _archive_batch(celery_app, docs: list[dict], directory: str = None) -> int:
+    db = celery_app.backend.database
+    wf_col = db.get_collection('workflow_meta')
+    taskmeta_col = celery_app.backend.collection
+    task_runs_col = db.get_collection('workflow_task_runs')
+
+    workflow_ids = [doc['_id'] for doc in docs]
+    task_runs = list(task_runs_col.find({'workflow_id': {'$in': workflow_ids}}))
+    task_ids = [run['task_id'] for run in task_runs]
+    for doc in docs:
+        for step in doc.get('steps', []):
+            task_ids.extend(run['task_id'] for run in step.get('task_runs', []))
+    taskmetas = list(taskmeta_col.find({'_id': {'$in': task_ids}})) if task_ids else []
+
+    # write to the archive first, so that a failure leaves the workflows in workflow_meta
+    if directory is not None:
+        _write_bundle(directory, docs, taskmetas, task_runs)
+    else:
+        for name, batch in ((ARCHIVE_COLLECTION, docs),
+                            (TASKMETA_ARCHIVE_COLLECTION, taskmetas),
+                            (TASK_RUNS_ARCHIVE_COLLECTION, task_runs)):
+            if batch:
+                db.get_collection(name).bulk_write(
+                    [ReplaceOne({'_id': d['_id']}, d, upsert=True) for d in batch], ordered=False
+                )
+
+    # delete the workflows that did not change since they were read, and only their tasks
+    deleted_ids = set()
+    for doc in docs:
+        res = wf_col.delete_one({'_id': doc['_id'], 'version': doc.get('version')})
+        if res.deleted_count:
+            deleted_ids.add(doc['_id'])
+    if not deleted_ids:
+        return 0
+
+    deleted_task_ids = [
+        run['task_id'] for run in task_runs if run['workflow_id'] in deleted_ids
+    ] + [
+        run['task_id']
+        for doc in docs if doc['_id'] in deleted_ids
+        for step in doc.get('steps', [])
+        for run in step.get('task_runs', [])
+    ]
+    if deleted_task_ids:
+        taskmeta_col.delete_many({'_id': {'$in': deleted_task_ids}})
+        db.get_collection('workflow_task_index').delete_many({'_id': {'$in': deleted_task_ids}})
+    task_runs_col.delete_many({'workflow_id': {'$in': list(deleted_ids)}})
+    db.get_collection(CHUNK_OUTPUTS_COLLECTION).delete_many({'workflow_id': {'$in': list(deleted_ids)}})
+    if Workflow.PAYLOAD_STORE is not None:
+        Workflow.PAYLOAD_STORE.delete_workflows(list(deleted_ids))
+    return len(deleted_ids)
+
+
+def _write_bundle(directory: str, docs: list[dict], taskmetas: list[dict], task_runs: list[dict]) -> str:
+    """
+    Writes one gzip compressed JSONL file per batch. Each line is an extended JSON document with a "collection" field
+    naming the collection it came from.
+    """
+    os.makedirs(directory, exist_ok=True)
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(directory, f'workflows-{timestamp}.jsonl.gz')
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for name, batch in (('workflow_meta', docs), ('celery_taskmeta', taskmetas), ('workflow_task_runs', task_runs)):
+            for doc in batch:
+                f.write(json_util.dumps({'collection': name, 'document': doc}) + '\n')
+    return path
+
+
+def _parse_retention(value: str) -> tuple[str, float]:
+    app_id, _, days = value.rpartition('=')
+    if not app_id:
+        raise argparse.ArgumentTypeError(f'expected app_id=days, got {value}')
+    return app_id, float(days)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive the finished workflows')
+    parser.add_argument('-A', '--app', required=True, help='celery app, ex: proj.celery:app')
+    parser.add_argument('--retention-days', type=float, help='archive the workflows finished more than N days ago')
+    parser.add_argument('--app-retention', type=_parse_retention, action='append', default=[],
+                        help='retention period of an app_id, ex: app1=7, can be repeated')
+    parser.add_argument('--status', action='append', help='workflow status to archive, default: SUCCESS')
+    parser.add_argument('--batch-size', type=int, default=500, help='number of workflows archived per batch')
+    parser.add_argument('--to-dir', help='write gzip compressed JSONL files to this directory')
+    args = parser.parse_args()
+    if args.retention_days is None and not args.app_retention:
+        parser.error('one of --retention-days or --app-retention is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    celery_app = symbol_by_name(args.app)
+    archive_workflows(
+        celery_app,
+        retention_days=args.retention_days,
+        app_id_retention_days=dict(args.app_retention),
+        statuses=tuple(args.status or [celery.states.SUCCESS]),
+        batch_size=args.batch_size,
+        directory=args.to_dir,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+Global concurrency limits of the workflow tasks (see Workflow.CONCURRENCY_LIMITER).
+
+A limit caps the number of tasks that run at the same time across all the workers, ex: at most 20 "tasks.archive"
+tasks. Every limit is a mongo backed semaphore: a task takes a lease on the semaphores of the limits it matches before
+it is sent, and gives it back when it succeeds or fails (or when it is revoked by Workflow.pause()).
+A lease that is not given back (ex: the worker was killed) expires after lease_sec, it is renewed when the task starts.
+
+A task that does not get its leases is deferred: its message is kept in the workflow_deferred collection and it is
+sent when the slots free up, in the order the tasks were deferred. The tasks are released by the workers when their
+tasks finish, and by the releaser that picks up the slots of the expired leases. Run a releaser per database:
+
+usage: python -m sca_rhythm.limits -A proj.celery:app [--interval 10]
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import time
+
+from celery.utils.imports import symbol_by_name
+from pymongo import ASCENDING, IndexModel
+
+SEMAPHORES_COLLECTION = 'workflow_semaphores'
+DEFERRED_COLLECTION = 'workflow_deferred'
+
+# the task message fields that a limit can match, see ConcurrencyLimiter
+MATCH_FIELDS = ('app_id', 'step', 'task', 'queue')
+
+# indexes of the workflow_deferred collection
+DEFERRED_INDEXES = [
+    # the deferred tasks waiting on a semaphore, in FIFO order
+    IndexModel([('semaphores', ASCENDING), ('created_at', ASCENDING)], name='semaphores_created_at'),
+    IndexModel([('created_at', ASCENDING)], name='created_at'),
+    IndexModel([('workflow_id', ASCENDING)], name='workflow_id'),
+]
+
+
+class ConcurrencyLimiter:
+    """
+    Enforces the concurrency limits of the tasks sent by the workflows.
+
+    A limit is a dict with a unique "name", the maximum number of concurrent tasks "max_concurrent" and the message
+    fields it matches, any of "app_id", "step", "task" and "queue". A limit without these fields matches every task.
+    With "per": a list of the message fields, every distinct value of the fields has its own limit, ex:
+    {'name': 'per_app', 'max_concurrent': 100, 'per': ['app_id']}.
+    A task that matches several limits runs only when it gets a slot in all of them.
+
+    :param database: mongo database that stores the semaphores and the deferred tasks, ex: the result backend's
+    :param limits: the limits
+    :param lease_sec: duration of a lease, longer than the longest task
+    :param wait_sec: time to wait for a slot before deferring the task, 0 to defer right away.
+        Waiting blocks the process that sends the task (ex: the worker that ran the previous step).
+    :param poll_interval_sec: time between the attempts to get a slot while waiting
+    """
+
+    def __init__(self, database, limits: list[dict], lease_sec: float = 3600, wait_sec: float = 0,
+                 poll_interval_sec: float = 0.5):
+        names = [limit.get('name') for limit in limits]
+        assert all(isinstance(name, str) for name in names), 'every limit should have a name'
+        assert len(set(names)) == len(names), 'the names of the limits should be unique'
+        for limit in limits:
+            assert isinstance(limit.get('max_concurrent'), int) and limit['max_concurrent'] > 0, \
+                f'max_concurrent of limit {limit["name"]} should be a positive int'
+            assert set(limit.get('per', [])) <= set(MATCH_FIELDS), \
+                f'"per" of limit {limit["name"]} should be a list of {MATCH_FIELDS}'
+        self.limits = limits
+        self.lease_sec = lease_sec
+        self.wait_sec = wait_sec
+        self.poll_interval_sec = poll_interval_sec
+        self.semaphores_col = database.get_collection(SEMAPHORES_COLLECTION)
+        self.deferred_col = database.get_collection(DEFERRED_COLLECTION)
+
+    def semaphores(self, app_id: str = None, step: str = None, task: str = None,
+                   queue: str = None) -> dict[str, int]:
+        """
+        returns the semaphores (id -> maximum number of concurrent tasks) of the limits that a task matches
+        """
+        fields = {'app_id': app_id, 'step': step, 'task': task, 'queue': queue}
+        semaphores = {}
+        for limit in self.limits:
+            if all(fields[field] == limit[field] for field in MATCH_FIELDS if field in limit):
+                key = ':'.join([limit['name'], *(str(fields[field]) for field in limit.get('per', []))])
+                semaphores[key] = limit['max_concurrent']
+        return semaphores
+
+    def message_semaphores(self, message: dict) -> dict[str, int]:
+        """
+        returns the semaphores of a task message (arguments of app.send_task())
+        """
+        kwargs = message.get('kwargs') or {}
+        return self.semaphores(app_id=kwargs.get('app_id'), step=kwargs.get('step'), task=message['name'],
+                               queue=message.get('queue'))
+
+    def acquire(self, semaphores: dict[str, int], task_id: str) -> bool:
+        """
+        Takes a lease on all the semaphores for the task, or on none of them.
+        Taking a lease that the task already holds renews it.
+
+        :return: True if the task holds a lease on all the semaphores
+        """
+        now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds=self.lease_sec)
+        acquired = []
+        for key, max_concurrent in semaphores.items():
+            self.semaphores_col.update_one({'_id': key}, {'$pull': {'holders': {'expires_at': {'$lte': now}}}},
+                                           upsert=True)
+            res = self.semaphores_col.update_one(
+                # a free slot: the array of holders does not have a max_concurrent-th element
+                {'_id': key, 'holders.task_id': {'$ne': task_id}, f'holders.{max_concurrent - 1}': {'$exists': False}},
+                {'$push': {'holders': {'task_id': task_id, 'expires_at': expires_at}}}
+            )
+            if res.matched_count == 0 and not self.renew(task_id, key):
+                self._pull([task_id], acquired)
+                return False
+            acquired.append(key)
+        return True
+
+    def renew(self, task_id: str, key: str = None) -> bool:
+        """
+        Extends the task's leases, or its lease on the semaphore "key".
+
+        :return: True if the task holds a lease
+        """
+        query = {'holders.task_id': task_id}
+        if key is not None:
+            query['_id'] = key
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease_sec)
+        res = self.semaphores_col.update_many(query, {'$set': {'holders.$.expires_at': expires_at}})
+        return res.matched_count > 0
+
+    def submit(self, celery_app, message: dict, **kwargs) -> bool:
+        """
+        Sends the task if it gets a slot in all the limits it matches, otherwise defers it.
+        A task does not get a slot ahead of the tasks deferred before it.
+
+        :param message: arguments of app.send_task()
+        :param kwargs: additional arguments of app.send_task(), ex: producer
+        :return: True if the task was sent, False if it was deferred
+        """
+        semaphores = self.message_semaphores(message)
+        if not semaphores:
+            celery_app.send_task(**message, **kwargs)
+            return True
+
+        deadline = time.monotonic() + self.wait_sec
+        while not self._has_deferred(semaphores):
+            if self.acquire(semaphores, message['task_id']):
+                try:
+                    celery_app.send_task(**message, **kwargs)
+                except Exception:
+                    self._pull([message['task_id']])
+                    raise
+                return True
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_interval_sec)
+
+        self.deferred_col.insert_one({
+            '_id': message['task_id'],
+            'workflow_id': (message.get('kwargs') or {}).get('workflow_id'),
+            'semaphores': list(semaphores),
+            'max_concurrent': list(semaphores.values()),
+            'message': message,
+            'created_at': datetime.datetime.utcnow()
+        })
+        # the slots may have freed up in between, the queue is not left waiting for the next release
+        self.release_deferred(celery_app, list(semaphores))
+        return False
+
+    def release(self, celery_app, task_ids: list[str]) -> int:
+        """
+        Gives back the leases of the tasks and removes the tasks that are still deferred,
+        then sends the deferred tasks that get the freed slots.
+
+        :return: number of deferred tasks sent
+        """
+        if not task_ids:
+            return 0
+        self.deferred_col.delete_many({'_id': {'$in': list(task_ids)}})
+        keys = [doc['_id'] for doc in self.semaphores_col.find({'holders.task_id': {'$in': list(task_ids)}}, {'_id': 1})]
+        if not keys:
+            return 0
+        self._pull(task_ids, keys)
+        return self.release_deferred(celery_app, keys)
+
+    def release_deferred(self, celery_app, keys: list[str] = None, batch_size: int = 1000) -> int:
+        """
+        Sends the deferred tasks that get a slot, in the order they were deferred.
+        A task that does not get a slot holds back the tasks deferred after it on the same semaphores.
+
+        :param keys: only the tasks waiting on these semaphores, all the deferred tasks if None
+        :param batch_size: maximum number of deferred tasks examined
+        :return: number of deferred tasks sent
+        """
+        query = {} if keys is None else {'semaphores': {'$in': list(keys)}}
+        entries = list(self.deferred_col.find(query).sort([('created_at', ASCENDING), ('_id', ASCENDING)])
+                       .limit(batch_size))
+        if not entries:
+            return 0
+        blocked = set()
+        sent = 0
+        with celery_app.producer_or_acquire() as producer:
+            for entry in entries:
+                if blocked.intersection(entry['semaphores']):
+                    continue
+                semaphores = dict(zip(entry['semaphores'], entry['max_concurrent']))
+                if not self.acquire(semaphores, entry['_id']):
+                    blocked.update(entry['semaphores'])
+                    if keys is not None and blocked.issuperset(keys):
+                        break
+                    continue
+                # a concurrent releaser holds the same leases for the task, only the one that removes it sends it
+                if self.deferred_col.delete_one({'_id': entry['_id']}).deleted_count:
+                    celery_app.send_task(**entry['message'], producer=producer)
+                    sent += 1
+        return sent
+
+    def deferred_task_ids(self, workflow_id: str) -> set[str]:
+        """
+        returns the ids of the deferred tasks of a workflow
+        """
+        return {doc['_id'] for doc in self.deferred_col.find({'workflow_id': workflow_id}, {'_id': 1})}
+
+    def _has_deferred(self, semaphores: dict[str, int]) -> bool:
+        return self.deferred_col.find_one({'semaphores': {'$in': list(semaphores)}}, {'_id': 1}) is not None
+
+    def _pull(self, task_ids: list[str], keys: list[str] = None) -> None:
+        query = {'holders.task_id': {'$in': list(task_ids)}}
+        if keys is not None:
+            if not keys:
+                return
+            query['_id'] = {'$in': list(keys)}
+        self.semaphores_col.update_many(query, {'$pull': {'holders': {'task_id': {'$in': list(task_ids)}}}})
+
+
+def run_releaser(celery_app, limiter: ConcurrencyLimiter, interval_sec: float = 10) -> None:
+    """
+    Sends the deferred tasks that get the slots of the expired leases, every interval_sec, until interrupted.
+    """
+    while True:
+        limiter.release_deferred(celery_app)
+        time.sleep(interval_sec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send the deferred tasks whose concurrency limits have free slots')
+    parser.add_argument('-A', '--app', required=True,
+                        help='celery app, ex: proj.celery:app. Importing it should set Workflow.CONCURRENCY_LIMITER')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between the releases')
+    args = parser.parse_args()
+
+    celery_app = symbol_by_name(args.app)
+    from sca_rhythm import Workflow
+    assert Workflow.CONCURRENCY_LIMITER is not None, 'Workflow.CONCURRENCY_LIMITER is not set'
+    run_releaser(celery_app, Workflow.CONCURRENCY_LIMITER, interval_sec=args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Online migration of the workflows to the normalized task run storage layout (see Workflow.NORMALIZE_TASK_RUNS).
+
+The workflows are converted in batches, in the order of their ids. The id of the last converted workflow is saved
+in the workflow_migrations collection after every batch, so an interrupted migration continues where it stopped.
+Converting a workflow is safe while it is running, the workers do not need to be stopped.
+The status, date_done and duration_sec of the task runs that were moved out before are filled in from the celery
+taskmeta of their tasks.
+
+usage: python -m sca_rhythm.migrate -A proj.celery:app [--batch-size 500] [--restart]
+"""
+import argparse
+import datetime
+import logging
+
+from celery.utils.imports import symbol_by_name
+
+from sca_rhythm import Workflow
+
+MIGRATION_ID = 'normalize_task_runs'
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_task_runs(celery_app, batch_size: int = 500, restart: bool = False) -> int:
+    """
+    Converts the workflows to the normalized task run storage layout.
+
+    :param celery_app: celery app whose result backend stores the workflows
+    :param batch_size: number of workflows fetched and converted per batch
+    :param restart: start from the first workflow instead of continuing the previous run
+    :return: number of workflows converted by this call
+    """
+    db = celery_app.backend.database
+    wf_col = db.get_collection('workflow_meta')
+    migrations_col = db.get_collection('workflow_migrations')
+
+    state = None if restart else migrations_col.find_one({'_id': MIGRATION_ID})
+    last_id = state['last_id'] if state else None
+
+    converted = 0
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        docs = list(wf_col.find(query).sort('_id', 1).limit(batch_size))
+        if not docs:
+            break
+        for doc in docs:
+            Workflow.from_doc(celery_app, doc).normalize_task_runs(backfill=False)
+        Workflow.backfill_task_runs(celery_app, [doc['_id'] for doc in docs])
+        last_id = docs[-1]['_id']
+        converted += len(docs)
+        migrations_col.update_one(
+            {'_id': MIGRATION_ID},
+            {'$set': {'last_id': last_id, 'updated_at': datetime.datetime.utcnow()}},
+            upsert=True
+        )
+        logger.info('converted %d workflows, last workflow id: %s', converted, last_id)
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the workflows to the normalized task run storage layout')
+    parser.add_argument('-A', '--app', required=True, help='celery app, ex: proj.celery:app')
+    parser.add_argument('--batch-size', type=int, default=500, help='number of workflows converted per batch')
+    parser.add_argument('--restart', action='store_true', help='start over from the first workflow')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    celery_app = symbol_by_name(args.app)
+    normalize_task_runs(celery_app, batch_size=args.batch_size, restart=args.restart)
+
+
+if __name__ == '__main__':
+    main()
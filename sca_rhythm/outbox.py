@@ -0,0 +1,78 @@
+"""
+Relay of the workflow outboxes (see Workflow.USE_OUTBOX).
+
+With the outbox, a worker writes the next step's task message to the workflow document in the same update that marks
+the step as SUCCESS, so the workflow's state and its pending messages cannot get out of sync. The relay publishes the
+messages that are still in the outboxes, in batches through a single producer, and then removes them.
+
+With Workflow.OUTBOX_INLINE_PUBLISH, the workers publish their messages themselves and the relay only picks up
+the messages that are older than --min-age seconds (ex: the worker stopped before publishing).
+Without it, run the relay with --min-age 0. Run a single relay per database.
+
+usage: python -m sca_rhythm.outbox -A proj.celery:app [--min-age 60] [--batch-size 500] [--interval 1]
+"""
+import argparse
+import datetime
+import time
+
+from celery.utils.imports import symbol_by_name
+from pymongo import UpdateOne
+
+from sca_rhythm import Workflow
+
+
+def relay_outbox(celery_app, batch_size: int = 500, min_age_sec: float = 60) -> int:
+    """
+    Publishes the outbox messages of up to batch_size workflows and removes them from the outboxes.
+
+    :param celery_app: celery app whose result backend stores the workflows
+    :param batch_size: number of workflows whose outbox is relayed
+    :param min_age_sec: only relay the messages that were written at least this many seconds ago
+    :return: number of published messages
+    """
+    wf_col = celery_app.backend.database.get_collection('workflow_meta')
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=min_age_sec)
+
+    docs = list(wf_col.find({'outbox.created_at': {'$lte': cutoff}}, {'outbox': 1}).limit(batch_size))
+    if not docs:
+        return 0
+
+    published = {}
+    with celery_app.producer_or_acquire() as producer:
+        for doc in docs:
+            for entry in doc['outbox']:
+                if entry['created_at'] <= cutoff:
+                    Workflow.publish(celery_app, entry['message'], producer=producer)
+                    published.setdefault(doc['_id'], []).append(entry['task_id'])
+
+    wf_col.bulk_write([
+        UpdateOne({'_id': workflow_id},
+                  {'$pull': {'outbox': {'task_id': {'$in': task_ids}}}, '$inc': {Workflow.VERSION_ATTR: 1}})
+        for workflow_id, task_ids in published.items()
+    ], ordered=False)
+    return sum(len(task_ids) for task_ids in published.values())
+
+
+def run_relay(celery_app, batch_size: int = 500, min_age_sec: float = 60, interval_sec: float = 1) -> None:
+    """
+    Relays the outboxes until interrupted. Sleeps interval_sec when there is nothing to relay.
+    """
+    while True:
+        if relay_outbox(celery_app, batch_size=batch_size, min_age_sec=min_age_sec) == 0:
+            time.sleep(interval_sec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish the task messages in the workflow outboxes')
+    parser.add_argument('-A', '--app', required=True, help='celery app, ex: proj.celery:app')
+    parser.add_argument('--min-age', type=float, default=60, help='only relay messages older than N seconds')
+    parser.add_argument('--batch-size', type=int, default=500, help='number of workflows relayed per batch')
+    parser.add_argument('--interval', type=float, default=1, help='seconds to wait when there is nothing to relay')
+    args = parser.parse_args()
+
+    celery_app = symbol_by_name(args.app)
+    run_relay(celery_app, batch_size=args.batch_size, min_age_sec=args.min_age, interval_sec=args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Payload stores for the values passed between the steps of a workflow (see Workflow.PAYLOAD_STORE).
+
+A value whose JSON encoding is larger than the threshold is written to the store and replaced by a small reference,
+{"__rhythm_payload__": key, "size": size}, in the task messages and in the result backend.
+WorkflowTask resolves the references in the task's args before the task runs.
+
+The payloads are stored with the id of their workflow, and deleted with delete_workflows() when the workflow succeeds
+(see Workflow.DELETE_PAYLOADS_ON_SUCCESS) or is archived (see sca_rhythm.archive).
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import uuid
+
+import gridfs
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+
+# the key of a reference has no "$" prefix, so that the references can be stored in mongo documents
+# (ex: the dispatch of a step), field names starting with "$" are rejected by MongoDB < 5.0
+REF_KEY = '__rhythm_payload__'
+# the key of the references written by the previous versions, still resolved
+LEGACY_REF_KEY = '$rhythm_payload'
+
+
+class PayloadStore:
+    """
+    Stores payloads (bytes) by key. Subclasses implement put, get, delete and delete_workflows.
+    """
+
+    def put(self, data: bytes, workflow_id: str = None) -> str:
+        """
+        :param data: the payload
+        :param workflow_id: id of the workflow that the payload belongs to, for delete_workflows
+        :return: key of the payload
+        """
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def delete_workflows(self, workflow_ids: list[str]) -> None:
+        """
+        Deletes the payloads of the workflows.
+        """
+        raise NotImplementedError
+
+    def ensure_indexes(self) -> list[str]:
+        """
+        Creates the indexes that the store needs, called by sca_rhythm.ensure_indexes.
+
+        :return: names of the indexes
+        """
+        return []
+
+    def offload(self, value, threshold: int, workflow_id: str = None):
+        """
+        returns a reference to the value stored in this store if its JSON encoding is larger than threshold bytes,
+        otherwise the value itself. Values that are references already, or are not JSON serializable,
+        are returned as they are.
+        """
+        if is_ref(value):
+            return value
+        try:
+            data = json.dumps(value).encode('utf-8')
+        except (TypeError, ValueError):
+            return value
+        if len(data) <= threshold:
+            return value
+        return {REF_KEY: self.put(data, workflow_id), 'size': len(data)}
+
+    def resolve(self, value):
+        """
+        returns the value referenced by value if it is a reference, otherwise value itself.
+        The references in a list (ex: the joined outputs passed to a fan-in step) are resolved as well.
+        """
+        if isinstance(value, list) and any(is_ref(item) for item in value):
+            return [self.resolve(item) for item in value]
+        if not is_ref(value):
+            return value
+        return json.loads(self.get(ref_key(value)).decode('utf-8'))
+
+
+class GridFSPayloadStore(PayloadStore):
+    """
+    Stores the payloads in a GridFS bucket of a mongo database, ex: the result backend's database.
+    The id of a payload's workflow is stored in the metadata of its file.
+    """
+
+    def __init__(self, database, bucket: str = 'workflow_payloads'):
+        self.fs = gridfs.GridFS(database, collection=bucket)
+        self.files_col = database.get_collection(f'{bucket}.files')
+
+    def put(self, data: bytes, workflow_id: str = None) -> str:
+        return str(self.fs.put(data, metadata={'workflow_id': workflow_id}))
+
+    def get(self, key: str) -> bytes:
+        return self.fs.get(ObjectId(key)).read()
+
+    def delete(self, key: str) -> None:
+        self.fs.delete(ObjectId(key))
+
+    def delete_workflows(self, workflow_ids: list[str]) -> None:
+        for file in self.files_col.find({'metadata.workflow_id': {'$in': list(workflow_ids)}}, {'_id': 1}):
+            self.fs.delete(file['_id'])
+
+    def ensure_indexes(self) -> list[str]:
+        return self.files_col.create_indexes([
+            IndexModel([('metadata.workflow_id', ASCENDING)], name='metadata_workflow_id')
+        ])
+
+
+class LocalPayloadStore(PayloadStore):
+    """
+    Stores the payloads as files in a local directory, in a sub directory per workflow.
+    Meant for tests and single host deployments.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, *parts: str) -> str:
+        # the keys come from the task messages, they cannot point outside of the directory
+        for part in parts:
+            if part in ('', '.', '..') or os.path.basename(part) != part:
+                raise ValueError(f'invalid payload key: {"/".join(parts)}')
+        return os.path.join(self.directory, *parts)
+
+    def put(self, data: bytes, workflow_id: str = None) -> str:
+        key = str(uuid.uuid4())
+        if workflow_id is not None:
+            key = f'{workflow_id}/{key}'
+        path = self._path(*key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return key
+
+    def get(self, key: str) -> bytes:
+        with open(self._path(*key.split('/')), 'rb') as f:
+            return f.read()
+
+    def delete(self, key: str) -> None:
+        os.remove(self._path(*key.split('/')))
+
+    def delete_workflows(self, workflow_ids: list[str]) -> None:
+        for workflow_id in workflow_ids:
+            shutil.rmtree(self._path(workflow_id), ignore_errors=True)
+
+
+def is_ref(value) -> bool:
+    return isinstance(value, dict) and (REF_KEY in value or LEGACY_REF_KEY in value)
+
+
+def ref_key(ref: dict) -> str:
+    """
+    returns the key of the payload referenced by ref
+    """
+    return ref[REF_KEY] if REF_KEY in ref else ref[LEGACY_REF_KEY]
@@ -0,0 +1,219 @@
+"""
+Priority policies of the workflow tasks (see Workflow.PRIORITY_POLICY).
+
+A policy computes the priority of a step's task when the task is sent. The priority is rounded and clamped to the
+broker's range, 0 to 9, higher priorities are consumed first. A step's "priority" overrides the policy.
+
+Run the simulation benchmark to compare the tail completion latency of the workflows under the policies:
+
+usage: python -m sca_rhythm.priority [--workflows 5000] [--workers 8] [--load 0.9] [--seed 0]
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import heapq
+import random
+
+MAX_PRIORITY = 9
+
+
+def clamp_priority(value: float) -> int:
+    """
+    returns the priority rounded to an int between 0 and MAX_PRIORITY
+    """
+    return max(0, min(int(round(value)), MAX_PRIORITY))
+
+
+class PriorityPolicy:
+    """
+    Computes the priority of the task of a step. Subclasses implement priority.
+    """
+
+    def priority(self, workflow: dict, step: dict, step_position: int, now: datetime.datetime = None) -> float:
+        """
+        :param workflow: the workflow document
+        :param step: the step whose task is sent
+        :param step_position: 1-based position of the step in the workflow
+        :param now: time the task is sent, defaults to the current time
+        :return: priority of the task, rounded and clamped to 0..MAX_PRIORITY by the caller
+        """
+        raise NotImplementedError
+
+
+class PositionPriority(PriorityPolicy):
+    """
+    The step's position, the default without a policy: the later steps of the workflows run first, so the started
+    workflows complete before new ones start. The steps from the 9th on all have the highest priority.
+    """
+
+    def priority(self, workflow: dict, step: dict, step_position: int, now: datetime.datetime = None) -> float:
+        return step_position
+
+
+class NormalizedPositionPriority(PriorityPolicy):
+    """
+    The step's position relative to the number of steps, mapped to 0..MAX_PRIORITY,
+    so that workflows of any length are prioritized by how far along they are.
+    """
+
+    def priority(self, workflow: dict, step: dict, step_position: int, now: datetime.datetime = None) -> float:
+        return step_position / len(workflow['steps']) * MAX_PRIORITY
+
+
+class AgingPriority(PriorityPolicy):
+    """
+    The priority of the base policy plus one for every sec_per_level seconds since the workflow was created,
+    so that old workflows are not starved by new ones.
+    """
+
+    def __init__(self, base: PriorityPolicy = None, sec_per_level: float = 3600):
+        self.base = base or NormalizedPositionPriority()
+        self.sec_per_level = sec_per_level
+
+    def priority(self, workflow: dict, step: dict, step_position: int, now: datetime.datetime = None) -> float:
+        now = now or datetime.datetime.utcnow()
+        age_sec = (now - workflow['created_at']).total_seconds()
+        return self.base.priority(workflow, step, step_position, now) + max(age_sec, 0) / self.sec_per_level
+
+
+class DeadlinePriority(PriorityPolicy):
+    """
+    Raises the priority of the workflows as their deadline approaches: from the priority of the base policy when the
+    deadline is horizon_sec or more away, to MAX_PRIORITY at the deadline and past it.
+
+    The deadline is the workflow's "deadline" field (a UTC datetime, ex: wf.set_field('deadline', ...); wf.update()),
+    or deadline_sec after the workflow was created. deadline_sec is a number of seconds, or a dict of them per app_id.
+    The workflows without a deadline get the priority of the base policy.
+    """
+
+    def __init__(self, horizon_sec: float = 3600, deadline_sec: float | dict[str, float] = None,
+                 base: PriorityPolicy = None):
+        self.horizon_sec = horizon_sec
+        self.deadline_sec = deadline_sec
+        self.base = base or NormalizedPositionPriority()
+
+    def deadline(self, workflow: dict) -> datetime.datetime | None:
+        if workflow.get('deadline') is not None:
+            return workflow['deadline']
+        deadline_sec = self.deadline_sec
+        if isinstance(deadline_sec, dict):
+            deadline_sec = deadline_sec.get(workflow.get('app_id'))
+        if deadline_sec is None:
+            return None
+        return workflow['created_at'] + datetime.timedelta(seconds=deadline_sec)
+
+    def priority(self, workflow: dict, step: dict, step_position: int, now: datetime.datetime = None) -> float:
+        now = now or datetime.datetime.utcnow()
+        base = self.base.priority(workflow, step, step_position, now)
+        deadline = self.deadline(workflow)
+        if deadline is None:
+            return base
+        remaining_sec = (deadline - now).total_seconds()
+        urgency = MAX_PRIORITY * (1 - remaining_sec / self.horizon_sec)
+        return max(base, urgency)
+
+
+def simulate(policy: PriorityPolicy, n_workflows: int = 5000, n_workers: int = 8, load: float = 0.9,
+             seed: int = 0) -> dict[str, dict[str, float]]:
+    """
+    Simulates linear workflows sharing a priority queue consumed by n_workers workers, and measures the latency
+    from the creation to the completion of the workflows.
+
+    The mixed load: 80% short workflows (3 steps of 1s) with a deadline of 60s after their creation and 20% long
+    workflows (30 steps of 1s) with a deadline of 1h, created at random (Poisson) at the rate that keeps
+    the workers busy "load" of the time. A task's priority is computed when it is sent, the tasks of the same
+    priority are consumed in the order they were sent.
+
+    :return: latency percentiles (p50, p95, p99, max) in seconds, for "all", "short" and "long" workflows
+    """
+    rng = random.Random(seed)
+    classes = [('short', 0.8, 3, 60), ('long', 0.2, 30, 3600)]
+    mean_work_sec = sum(share * n_steps for _, share, n_steps, _ in classes)
+    arrival_rate = load * n_workers / mean_work_sec
+    epoch = datetime.datetime(2020, 1, 1)
+
+    # events: (time, seq, kind, payload)
+    events = []
+    seq = 0
+    t = 0.0
+    for _ in range(n_workflows):
+        t += rng.expovariate(arrival_rate)
+        name, _, n_steps, deadline_sec = rng.choices(classes, weights=[c[1] for c in classes])[0]
+        created_at = epoch + datetime.timedelta(seconds=t)
+        workflow = {
+            'created_at': created_at,
+            'deadline': created_at + datetime.timedelta(seconds=deadline_sec),
+            'steps': [{'name': f'step{i}'} for i in range(n_steps)],
+            'class': name
+        }
+        events.append((t, seq, 'create', workflow))
+        seq += 1
+    heapq.heapify(events)
+
+    queue = []
+    idle_workers = n_workers
+    latencies = {'short': [], 'long': []}
+
+    def send(workflow, step_idx, now):
+        nonlocal seq
+        step = workflow['steps'][step_idx]
+        priority = clamp_priority(policy.priority(workflow, step, step_idx + 1, epoch + datetime.timedelta(seconds=now)))
+        heapq.heappush(queue, (-priority, seq, workflow, step_idx))
+        seq += 1
+
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+        if kind == 'create':
+            send(payload, 0, now)
+        else:
+            workflow, step_idx = payload
+            idle_workers += 1
+            if step_idx + 1 < len(workflow['steps']):
+                send(workflow, step_idx + 1, now)
+            else:
+                latencies[workflow['class']].append(now - (workflow['created_at'] - epoch).total_seconds())
+        while idle_workers and queue:
+            _, _, workflow, step_idx = heapq.heappop(queue)
+            idle_workers -= 1
+            heapq.heappush(events, (now + 1.0, seq, 'done', (workflow, step_idx)))
+            seq += 1
+
+    latencies['all'] = latencies['short'] + latencies['long']
+    return {name: _percentiles(values) for name, values in latencies.items()}
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        **{f'p{p}': values[min(int(len(values) * p / 100), len(values) - 1)] for p in (50, 95, 99)},
+        'max': values[-1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the workflow completion latency under the priority policies')
+    parser.add_argument('--workflows', type=int, default=5000, help='number of simulated workflows')
+    parser.add_argument('--workers', type=int, default=8, help='number of workers')
+    parser.add_argument('--load', type=float, default=0.9, help='fraction of the time the workers are busy')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    policies = {
+        'position': PositionPriority(),
+        'normalized': NormalizedPositionPriority(),
+        'aging': AgingPriority(sec_per_level=60),
+        'deadline': DeadlinePriority(horizon_sec=600),
+    }
+    print(f'{"policy":<12}{"workflows":<11}{"p50":>9}{"p95":>9}{"p99":>9}{"max":>9}')
+    for policy_name, policy in policies.items():
+        results = simulate(policy, n_workflows=args.workflows, n_workers=args.workers, load=args.load, seed=args.seed)
+        for name in ('all', 'short', 'long'):
+            res = results[name]
+            print(f'{policy_name:<12}{name:<11}' + ''.join(f'{res[k]:>9.1f}' for k in ('p50', 'p95', 'p99', 'max')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+The benchmarks run against a real MongoDB (the query planner, arrayFilters and the concurrency of the writes are not
+emulated by mongomock), they are skipped unless SCA_RHYTHM_MONGO_URL is set:
+
+SCA_RHYTHM_MONGO_URL=mongodb://localhost:27017 python -m pytest -s tests/benchmarks
+"""
+import bson
+import pytest
+from pymongo import monitoring
+
+from tests.conftest import FakeApp, mongo_database
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """
+    pymongo command listener that keeps the commands sent to the server and their size in bytes.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append((event.command_name, event.command, len(bson.encode(event.command))))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def bytes_sent(self, command_names):
+        return sum(size for name, _, size in self.commands if name in command_names)
+
+    def clear(self):
+        self.commands = []
+
+
+@pytest.fixture
+def recorder():
+    return CommandRecorder()
+
+
+@pytest.fixture
+def mongo_app(recorder):
+    with mongo_database('rhythm_benchmark', event_listeners=[recorder]) as database:
+        yield FakeApp(database)
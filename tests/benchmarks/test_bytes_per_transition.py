@@ -0,0 +1,40 @@
+import bson
+
+from sca_rhythm import Workflow
+
+STEPS = [{'name': f'step{i}', 'task': f'tasks.step{i}'} for i in range(20)]
+WRITE_COMMANDS = {'insert', 'update', 'findAndModify', 'delete'}
+
+
+def test_bytes_per_transition(mongo_app, recorder):
+    """
+    The bytes of the write commands sent per transition, against the size of the update that rewrites the whole
+    workflow document ({'$set': workflow}), on a workflow whose steps fail and are resumed 10 times each.
+    """
+    wf = Workflow(mongo_app, steps=STEPS, name='benchmark', app_id='benchmark')
+    wf.start()
+    written = []
+    rewritten = []
+
+    def measure(hook, *args, **kwargs):
+        recorder.clear()
+        hook(*args, **kwargs)
+        written.append(recorder.bytes_sent(WRITE_COMMANDS))
+        rewritten.append(len(bson.encode({'$set': wf.workflow})))
+
+    for i, step in enumerate(STEPS):
+        for _ in range(10):
+            task_id = mongo_app.sent[-1]['task_id']
+            measure(wf.on_step_start, step['name'], task_id)
+            measure(wf.on_step_failure, step['name'], task_id)
+            measure(wf.resume)
+        task_id = mongo_app.sent[-1]['task_id']
+        measure(wf.on_step_start, step['name'], task_id)
+        measure(wf.on_step_success, (i,), step['name'], task_id)
+
+    print(f'\n{len(written)} transitions, bytes written per transition: '
+          f'mean {sum(written) / len(written):.0f}, max {max(written)}; '
+          f'whole document rewrite: mean {sum(rewritten) / len(rewritten):.0f}, max {max(rewritten)}')
+    assert sum(written) < sum(rewritten)
+    # the transitions do not grow with the document
+    assert max(written[-5:]) < 2 * max(written[:5])
@@ -0,0 +1,81 @@
+import itertools
+import threading
+import time
+
+import celery.states
+
+from sca_rhythm import CHUNK_OUTPUTS_KEY, Workflow
+
+
+def run_threads(target, n_threads):
+    errors = []
+
+    def run(k):
+        try:
+            target(k)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    return time.perf_counter() - start
+
+
+def test_concurrent_transitions_lose_no_update(mongo_app):
+    """
+    32 writers increment a counter of the same workflow, each with its own workflow object.
+    """
+    wf = Workflow(mongo_app, steps=[{'name': 'a', 'task': 'tasks.a'}], name='benchmark', app_id='benchmark')
+    n_threads, n_updates = 32, 20
+    attempts = itertools.count()
+
+    def increment(k):
+        writer = Workflow(mongo_app, wf.workflow['_id'])
+
+        def mutate():
+            next(attempts)
+            writer.set_field('counter', writer.workflow.get('counter', 0) + 1)
+            return True
+
+        for _ in range(n_updates):
+            writer.transition(mutate, timeout_sec=60)
+
+    elapsed = run_threads(increment, n_threads)
+    n_transitions = n_threads * n_updates
+    print(f'\n{n_transitions} transitions by {n_threads} writers in {elapsed:.2f}s: '
+          f'{n_transitions / elapsed:.0f} transitions/s, {next(attempts) / n_transitions:.2f} attempts per transition')
+    wf.refresh()
+    assert wf.workflow['counter'] == n_transitions
+
+
+def test_concurrent_chunk_hooks(mongo_app):
+    """
+    The 60 chunks of a map step start and succeed at the same time, each in its own worker.
+    """
+    steps = [
+        {'name': 'list', 'task': 'tasks.list'},
+        {'name': 'checksum', 'task': 'tasks.checksum', 'map': {'chunk_size': 2}},
+        {'name': 'report', 'task': 'tasks.report'},
+    ]
+    wf = Workflow(mongo_app, steps=steps, name='benchmark', app_id='benchmark')
+    wf.on_step_success((list(range(120)),), 'list', 'list-task')
+    chunks = wf.workflow['steps'][1]['chunks']
+
+    def run_chunk(k):
+        worker = Workflow(mongo_app, wf.workflow['_id'])
+        worker.on_step_start('checksum', chunks[k]['task_id'], chunk=k)
+        worker.on_step_success(([k],), 'checksum', chunks[k]['task_id'], chunk=k)
+
+    elapsed = run_threads(run_chunk, len(chunks))
+    print(f'\n{len(chunks)} chunks started and succeeded in {elapsed:.2f}s: {2 * len(chunks) / elapsed:.0f} hooks/s')
+    wf.refresh()
+    assert wf.workflow['steps'][1]['status'] == celery.states.SUCCESS
+    assert all(chunk['status'] == celery.states.SUCCESS for chunk in wf.workflow['steps'][1]['chunks'])
+    report = [m for m in mongo_app.sent if m['kwargs']['step'] == 'report']
+    assert len(report) == 1
+    assert report[0]['args'] == [{CHUNK_OUTPUTS_KEY: 1}]
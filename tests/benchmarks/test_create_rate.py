@@ -0,0 +1,28 @@
+import time
+
+from sca_rhythm import Workflow
+
+STEPS = [{'name': f'step{i}', 'task': f'tasks.step{i}'} for i in range(5)]
+
+
+def test_workflows_created_per_sec(mongo_app):
+    """
+    Workflows created and started per second with create_many / start_many, against one at a time.
+    The messages are not published to a broker, the rate is that of the writes to mongo db.
+    """
+    n = 5000
+    specs = [{'steps': STEPS, 'name': f'wf{k}', 'app_id': 'benchmark'} for k in range(n)]
+
+    start = time.perf_counter()
+    Workflow.start_many(Workflow.create_many(mongo_app, specs))
+    batched = n / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for spec in specs[:n // 10]:
+        Workflow(mongo_app, **spec).start()
+    one_by_one = n // 10 / (time.perf_counter() - start)
+
+    print(f'\nworkflows created and started per second: {batched:.0f} with create_many / start_many, '
+          f'{one_by_one:.0f} one at a time')
+    assert len(mongo_app.sent) == n + n // 10
+    assert batched > one_by_one
@@ -0,0 +1,72 @@
+import datetime
+
+import celery.states
+import pytest
+
+from sca_rhythm import Workflow, ensure_indexes
+
+STEPS = [{'name': 'a', 'task': 'tasks.a'}, {'name': 'b', 'task': 'tasks.b'}]
+
+
+def plan_stages(plan: dict) -> list[str]:
+    """
+    returns the stages of a query plan (the winningPlan of an explain), of all the plan's nodes
+    """
+    stages = [plan['stage']] if 'stage' in plan else []
+    for value in plan.values():
+        for child in value if isinstance(value, list) else [value]:
+            if isinstance(child, dict):
+                stages.extend(plan_stages(child))
+    return stages
+
+
+def explain(db, command: dict) -> list[str]:
+    res = db.command({
+        'explain': {key: command[key] for key in ('find', 'filter', 'sort', 'limit') if key in command},
+        'verbosity': 'queryPlanner'
+    })
+    return plan_stages(res['queryPlanner']['winningPlan'])
+
+
+@pytest.fixture
+def populated_app(mongo_app):
+    specs = [{'steps': STEPS, 'name': f'wf{k % 50}', 'app_id': f'app{k % 10}'} for k in range(2000)]
+    workflows = Workflow.create_many(mongo_app, specs)
+    col = mongo_app.backend.database.get_collection('workflow_meta')
+    col.update_many({'_id': {'$in': [wf.workflow['_id'] for wf in workflows[::7]]}},
+                    {'$set': {'_status': celery.states.FAILURE}})
+    Workflow.start_many(workflows[:100])
+    ensure_indexes(mongo_app)
+    return mongo_app
+
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'app_id': 'app3'},
+    {'status': celery.states.FAILURE},
+    {'status': [celery.states.FAILURE, celery.states.PENDING]},
+    {'app_id': 'app3', 'status': celery.states.FAILURE},
+    {'name': 'wf7'},
+    {'app_id': 'app3', 'created_between': (datetime.datetime(2020, 1, 1), None)},
+], ids=lambda filters: '-'.join(filters) or 'all')
+@pytest.mark.parametrize('page', [1, 2])
+def test_find_uses_an_index(populated_app, recorder, filters, page):
+    after = None
+    if page > 1:
+        after = list(Workflow.find(populated_app, limit=20, **filters))[-1].cursor()
+    recorder.clear()
+    assert list(Workflow.find(populated_app, limit=20, after=after, **filters))
+    [command] = [cmd for name, cmd, _ in recorder.commands if name == 'find' and cmd['find'] == 'workflow_meta']
+    stages = explain(populated_app.backend.database, command)
+    assert 'COLLSCAN' not in stages and any('IXSCAN' in stage for stage in stages), stages
+
+
+def test_task_id_lookups_use_an_index(populated_app):
+    wf = next(Workflow.find(populated_app, status=celery.states.PENDING, limit=1))
+    task_id = populated_app.sent[0]['task_id']
+    db = populated_app.backend.database
+    for col_name, query in [('workflow_meta', {'steps.task_runs.task_id': task_id}),
+                            ('workflow_meta', {'_id': wf.workflow['_id']}),
+                            ('workflow_task_index', {'_id': task_id})]:
+        stages = explain(db, {'find': col_name, 'filter': query})
+        assert 'COLLSCAN' not in stages, (col_name, query, stages)
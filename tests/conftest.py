@@ -0,0 +1,83 @@
+import contextlib
+import os
+import uuid
+
+import pytest
+from pymongo import MongoClient
+
+# the tests of the updates that mongomock does not emulate (ex: arrayFilters) and the benchmarks run against this
+# MongoDB server, they are skipped when it is not set
+MONGO_URL = os.environ.get('SCA_RHYTHM_MONGO_URL')
+
+
+class FakeBackend:
+    def __init__(self, database):
+        self.database = database
+        self.collection = database.get_collection('celery_taskmeta')
+
+
+class FakeConf:
+    task_default_queue = 'celery'
+
+    @staticmethod
+    def get(key, default=None):
+        return default
+
+
+class FakeControl:
+    def __init__(self):
+        self.revoked = []
+
+    def revoke(self, task_id, terminate=False):
+        self.revoked.append(task_id)
+
+
+class FakeApp:
+    """
+    The parts of a celery app that Workflow uses, backed by mongomock. The sent task messages are kept in "sent".
+    """
+    conf = FakeConf()
+
+    def __init__(self, database):
+        self.backend = FakeBackend(database)
+        self.tasks = {}
+        self.sent = []
+        self.control = FakeControl()
+
+    def send_task(self, **message):
+        self.sent.append(message)
+
+    @contextlib.contextmanager
+    def producer_or_acquire(self, producer=None):
+        yield producer
+
+
+@pytest.fixture
+def app():
+    mongomock = pytest.importorskip('mongomock')
+    # the mongomock clients share their databases, every test starts with an empty one
+    client = mongomock.MongoClient()
+    client.drop_database('rhythm_test')
+    return FakeApp(client.get_database('rhythm_test'))
+
+
+@contextlib.contextmanager
+def mongo_database(prefix: str, **client_kwargs):
+    """
+    yields a new database of the MongoDB server at SCA_RHYTHM_MONGO_URL, which is dropped afterwards
+    """
+    if not MONGO_URL:
+        pytest.skip('SCA_RHYTHM_MONGO_URL is not set')
+    client = MongoClient(MONGO_URL, **client_kwargs)
+    name = f'{prefix}_{uuid.uuid4().hex[:8]}'
+    try:
+        yield client.get_database(name)
+    finally:
+        client.drop_database(name)
+        client.close()
+
+
+@pytest.fixture
+def mongo_app():
+    with mongo_database('rhythm_test') as database:
+        yield FakeApp(database)
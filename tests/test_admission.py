@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+from sca_rhythm import SCHEDULED, Workflow
+from sca_rhythm.admission import AdmissionController
+
+
+@pytest.fixture
+def controller(app):
+    return AdmissionController(app.backend.database, {
+        'heavy': {'rate': 1, 'burst': 10, 'weight': 3},
+        'light': {'rate': 1, 'burst': 2},
+    })
+
+
+def test_allocate_favors_the_fewest_inflight_per_weight(controller):
+    assert controller.allocate({'heavy': 100, 'light': 100}, {'heavy': 0, 'light': 0}, 8) == {'heavy': 6, 'light': 2}
+    # light has fewer workflows in flight, it is served first
+    assert controller.allocate({'heavy': 100, 'light': 100}, {'heavy': 30, 'light': 0}, 8) == {'heavy': 0, 'light': 8}
+
+
+def test_allocate_caps_at_the_backlogs(controller):
+    assert controller.allocate({'heavy': 1, 'light': 2}, {}, 10) == {'heavy': 1, 'light': 2}
+    assert controller.allocate({'heavy': 0, 'light': 0}, {}, 10) == {'heavy': 0, 'light': 0}
+
+
+def test_take_is_limited_by_the_burst(controller):
+    assert controller.take('light', 5) == 2
+    assert controller.take('light') == 0
+    # an app_id without a limit is not rate limited
+    assert controller.take('other', 5) == 5
+
+
+def test_take_refills_at_the_rate(controller):
+    assert controller.take('light', 2) == 2
+    controller.buckets_col.update_one({'_id': 'light'}, {'$set': {
+        'updated_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=1.5)
+    }})
+    assert controller.take('light', 2) == 1
+
+
+def test_give_back(controller):
+    assert controller.take('light', 2) == 2
+    controller.give_back('light', 1)
+    assert controller.take('light', 2) == 1
+    # the bucket does not exceed its burst
+    controller.give_back('light', 100)
+    assert controller.take('light', 100) == 2
+
+
+def test_limits_are_validated(app):
+    with pytest.raises(AssertionError):
+        AdmissionController(app.backend.database, {'x': {'rate': 0, 'burst': 1}})
+    with pytest.raises(AssertionError):
+        AdmissionController(app.backend.database, {'x': {'rate': 1, 'burst': 1, 'queues': ['celery']}})
+
+
+def test_fair_quotas_count_the_admitted_workflows_in_flight(app):
+    now = datetime.datetime.utcnow()
+    wf_col = app.backend.database.get_collection('workflow_meta')
+    wf_col.insert_many(
+        [{'app_id': 'heavy', '_status': SCHEDULED, 'scheduled': {}} for _ in range(5)] +
+        # created but never started
+        [{'app_id': 'heavy', '_status': 'PENDING', 'updated_at': now} for _ in range(10)] +
+        [{'app_id': 'light', '_status': 'STARTED', 'scheduled': {'admitted_at': now}, 'updated_at': now}] +
+        # its worker was killed
+        [{'app_id': 'light', '_status': 'STARTED', 'scheduled': {'admitted_at': now},
+          'updated_at': now - datetime.timedelta(hours=2)}]
+    )
+    controller = AdmissionController(app.backend.database, {'heavy': {'rate': 1, 'burst': 10}}, fair_share=True,
+                                     max_inflight=4)
+    assert Workflow._fair_quotas(wf_col, controller, ['heavy', 'light'], 10) == {'heavy': 2, 'light': 0}
+
+    controller.inflight_stale_sec = 3600
+    assert Workflow._fair_quotas(wf_col, controller, ['heavy', 'light'], 10) == {'heavy': 3, 'light': 0}
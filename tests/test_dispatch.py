@@ -0,0 +1,84 @@
+import json
+
+import celery.states
+import pytest
+
+from sca_rhythm import Workflow
+
+STEPS = [{'name': 'a', 'task': 'tasks.a'}, {'name': 'b', 'task': 'tasks.b'}]
+LARGE = list(range(100))
+
+
+@pytest.fixture(autouse=True)
+def threshold(monkeypatch):
+    monkeypatch.setattr(Workflow, 'PAYLOAD_THRESHOLD_BYTES', len(json.dumps([LARGE])) - 1)
+
+
+def stored_step(wf, step_idx):
+    return wf.wf_col.find_one({'_id': wf.workflow['_id']})['steps'][step_idx]
+
+
+def fail_step(wf, step_idx, task_id):
+    # the task ran, its run and its failure are recorded
+    wf.wf_col.update_one({'_id': wf.workflow['_id']}, {'$set': {
+        f'steps.{step_idx}.task_runs': [{'task_id': task_id}],
+        f'steps.{step_idx}.status': celery.states.FAILURE,
+        '_status': celery.states.FAILURE,
+    }})
+    wf.refresh()
+
+
+def test_small_args_are_recorded(app):
+    wf = Workflow(app, steps=STEPS, name='test', app_id='app')
+    wf.on_step_success(([1, 2],), 'a', 'a-task')
+    assert stored_step(wf, 1)['dispatch']['args'] == [[1, 2]]
+    assert app.sent[-1]['args'] == [[1, 2]]
+
+
+def test_large_args_are_sent_but_not_recorded(app):
+    wf = Workflow(app, steps=STEPS, name='test', app_id='app')
+    wf.on_step_success((LARGE,), 'a', 'a-task')
+    assert 'args' not in stored_step(wf, 1)['dispatch']
+    assert app.sent[-1]['args'] == [LARGE]
+
+
+def test_resume_reads_the_args_that_were_not_recorded_from_the_result_backend(app):
+    wf = Workflow(app, steps=STEPS, name='test', app_id='app')
+    wf.on_step_success((LARGE,), 'a', 'a-task')
+    task_id = app.sent[-1]['task_id']
+    app.backend.collection.insert_one({'_id': task_id, 'status': celery.states.FAILURE, 'args': [LARGE]})
+    wf = Workflow(app, wf.workflow['_id'])
+    fail_step(wf, 1, task_id)
+
+    assert wf.resume()['restarted_step']['name'] == 'b'
+    assert app.sent[-1]['args'] == [LARGE]
+    assert app.sent[-1]['task_id'] != task_id
+    assert 'args' not in stored_step(wf, 1)['dispatch']
+
+
+def test_large_args_are_not_written_to_the_outbox(app, monkeypatch):
+    monkeypatch.setattr(Workflow, 'USE_OUTBOX', True)
+    monkeypatch.setattr(Workflow, 'OUTBOX_INLINE_PUBLISH', False)
+    wf = Workflow(app, steps=STEPS, name='test', app_id='app')
+    wf.on_step_success((LARGE,), 'a', 'a-task')
+    assert not wf.wf_col.find_one({'_id': wf.workflow['_id']}).get('outbox')
+    assert app.sent[-1]['args'] == [LARGE]
+
+
+def test_restarted_chunks_get_the_map_input_from_the_previous_step(app):
+    steps = [{'name': 'list', 'task': 'tasks.list'}, {'name': 'checksum', 'task': 'tasks.checksum',
+                                                      'map': {'chunk_size': 50}}]
+    wf = Workflow(app, steps=steps, name='test', app_id='app')
+    wf.wf_col.update_one({'_id': wf.workflow['_id']}, {'$set': {'steps.0.task_runs': [{'task_id': 'list-task'}]}})
+    app.backend.collection.insert_one({'_id': 'list-task', 'status': celery.states.SUCCESS,
+                                       'result': json.dumps([LARGE])})
+    wf.refresh()
+    wf.on_step_success((LARGE,), 'list', 'list-task')
+    assert 'args' not in stored_step(wf, 1)['dispatch']
+    chunks = wf.workflow['steps'][1]['chunks']
+
+    # another process restarts the failed chunk
+    wf = Workflow(app, wf.workflow['_id'])
+    wf.on_step_failure('checksum', chunks[1]['task_id'], chunk=1)
+    assert wf.resume()['restarted_step']['chunks'] == [1]
+    assert app.sent[-1]['args'] == [LARGE[50:]]
@@ -0,0 +1,103 @@
+from sca_rhythm import Workflow, _covers, _diff, _REMOVED
+
+
+def make_workflow(app, **fields):
+    wf = Workflow(app, steps=[{'name': 'a', 'task': 'tasks.a'}, {'name': 'b', 'task': 'tasks.b'}],
+                  name='test', app_id='app')
+    for path, value in fields.items():
+        wf.set_field(path, value)
+    wf.update()
+    return wf
+
+
+def stored(wf):
+    return wf.wf_col.find_one({'_id': wf.workflow['_id']})
+
+
+def test_covers():
+    assert _covers('steps', 'steps')
+    assert _covers('steps', 'steps.0.status')
+    assert _covers('steps.0', 'steps.0.task_runs')
+    assert not _covers('steps.0', 'steps.01')
+    assert not _covers('steps.0.status', 'steps.0')
+
+
+def test_diff():
+    old = {'a': 1, 'b': {'c': 2, 'd': 3}, 'l': [1, 2], 'm': [1]}
+    new = {'a': 1, 'b': {'c': 4}, 'l': [1, 5], 'm': [1, 2], 'e': 6}
+    assert dict(_diff(old, new)) == {'b.c': 4, 'b.d': _REMOVED, 'l.1': 5, 'm': [1, 2], 'e': 6}
+
+
+def test_set_field_sends_only_the_changed_fields(app):
+    wf = make_workflow(app)
+    wf.set_field('steps.0.status', 'STARTED')
+    assert wf._changes == {'$set': {'steps.0.status': 'STARTED'}}
+    wf.update()
+    assert stored(wf)['steps'][0]['status'] == 'STARTED'
+
+
+def test_set_field_repeated_keeps_the_last_value(app):
+    wf = make_workflow(app)
+    wf.set_field('note', 'first')
+    wf.set_field('note', 'second')
+    wf.update()
+    assert stored(wf)['note'] == 'second'
+
+
+def test_set_field_supersedes_the_descendant_changes(app):
+    wf = make_workflow(app)
+    wf.set_field('steps.0.status', 'STARTED')
+    wf.push_field('steps.0.task_runs', {'task_id': 't1'})
+    wf.set_field('steps.0', {'name': 'a', 'task': 'tasks.a', 'status': 'SUCCESS'})
+    changes = wf._pop_changes()
+    assert changes['$set'] == {'steps.0': {'name': 'a', 'task': 'tasks.a', 'status': 'SUCCESS'}}
+    assert '$push' not in changes
+
+
+def test_set_field_under_a_pending_ancestor(app):
+    wf = make_workflow(app)
+    wf.set_field('steps.0', {'name': 'a', 'task': 'tasks.a'})
+    wf.set_field('steps.0.status', 'STARTED')
+    assert list(wf._changes['$set']) == ['steps.0']
+    wf.update()
+    assert stored(wf)['steps'][0]['status'] == 'STARTED'
+
+
+def test_update_persists_the_direct_changes(app):
+    wf = make_workflow(app, note='x', extra=1)
+    wf.workflow['note'] = 'y'
+    wf.workflow['steps'][1]['status'] = 'PENDING'
+    del wf.workflow['extra']
+    wf.update()
+    doc = stored(wf)
+    assert doc['note'] == 'y'
+    assert doc['steps'][1]['status'] == 'PENDING'
+    assert 'extra' not in doc
+
+
+def test_update_does_not_overwrite_the_other_writers(app):
+    wf = make_workflow(app)
+    other = Workflow(app, wf.workflow['_id'])
+    other.set_field('steps.1.status', 'STARTED')
+    other.update()
+    wf.set_field('steps.0.status', 'SUCCESS')
+    wf.update()
+    doc = stored(wf)
+    assert doc['steps'][0]['status'] == 'SUCCESS'
+    assert doc['steps'][1]['status'] == 'STARTED'
+
+
+def test_transition_retries_on_a_concurrent_write(app):
+    wf = make_workflow(app)
+    other = Workflow(app, wf.workflow['_id'])
+    other.set_field('note', 'other')
+    other.update()
+
+    def mutate():
+        wf.set_field('count', wf.workflow.get('count', 0) + 1)
+        return True
+
+    wf.transition(mutate)
+    doc = stored(wf)
+    assert doc['count'] == 1
+    assert doc['note'] == 'other'
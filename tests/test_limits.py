@@ -0,0 +1,53 @@
+import pytest
+
+from sca_rhythm.limits import ConcurrencyLimiter
+
+LIMITS = [
+    {'name': 'archive', 'max_concurrent': 2, 'task': 'tasks.archive'},
+    {'name': 'per_app', 'max_concurrent': 5, 'per': ['app_id']},
+    {'name': 'slow_queue', 'max_concurrent': 3, 'queue': 'slow', 'step': 'stage'},
+]
+
+
+@pytest.fixture
+def limiter(app):
+    return ConcurrencyLimiter(app.backend.database, LIMITS)
+
+
+def test_semaphores(limiter):
+    assert limiter.semaphores(app_id='a', step='archive', task='tasks.archive') == {'archive': 2, 'per_app:a': 5}
+    assert limiter.semaphores(app_id='b', step='stage', task='tasks.stage', queue='slow') == {
+        'per_app:b': 5, 'slow_queue': 3
+    }
+    # all the fields of a limit have to match
+    assert limiter.semaphores(app_id='b', step='other', task='tasks.stage', queue='slow') == {'per_app:b': 5}
+
+
+def test_message_semaphores(limiter):
+    message = {'name': 'tasks.archive', 'kwargs': {'app_id': 'a', 'step': 'archive'}, 'queue': None}
+    assert limiter.message_semaphores(message) == {'archive': 2, 'per_app:a': 5}
+
+
+def test_acquire_and_release(app, limiter):
+    semaphores = {'archive': 2}
+    assert limiter.acquire(semaphores, 't1')
+    assert limiter.acquire(semaphores, 't2')
+    assert not limiter.acquire(semaphores, 't3')
+    # taking a lease that the task holds renews it
+    assert limiter.acquire(semaphores, 't1')
+    limiter.release(app, ['t1'])
+    assert limiter.acquire(semaphores, 't3')
+
+
+def test_acquire_takes_all_the_leases_or_none(limiter):
+    assert limiter.acquire({'archive': 2}, 't1')
+    assert limiter.acquire({'archive': 2}, 't2')
+    assert not limiter.acquire({'per_app:a': 5, 'archive': 2}, 't3')
+    assert limiter.semaphores_col.find_one({'_id': 'per_app:a'})['holders'] == []
+
+
+def test_limits_are_validated(app):
+    with pytest.raises(AssertionError):
+        ConcurrencyLimiter(app.backend.database, [{'name': 'x', 'max_concurrent': 0}])
+    with pytest.raises(AssertionError):
+        ConcurrencyLimiter(app.backend.database, [{'name': 'x', 'max_concurrent': 1, 'per': ['user']}])
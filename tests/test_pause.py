@@ -0,0 +1,36 @@
+import celery.states
+
+from sca_rhythm import Workflow
+
+STEPS = [
+    {'name': 'a', 'task': 'tasks.a'},
+    {'name': 'b', 'task': 'tasks.b'},
+    {'name': 'c', 'task': 'tasks.c', 'fuse': True},
+]
+
+
+def test_a_step_that_succeeds_after_a_pause_does_not_continue_the_workflow(app):
+    # running c would fail, it is not fused
+    app.tasks['tasks.c'] = None
+    wf = Workflow(app, steps=STEPS, name='test', app_id='app')
+    wf.on_step_success((1,), 'a', 'a-task')
+    task_id = app.sent[-1]['task_id']
+    # b's task started, ex: fused in the worker of a, where it cannot be terminated
+    wf.wf_col.update_one({'_id': wf.workflow['_id']}, {'$set': {
+        'steps.1.task_runs': [{'task_id': task_id}],
+        'steps.1.status': celery.states.STARTED,
+        '_status': celery.states.STARTED,
+    }})
+    assert wf.pause()['revoked_step']['name'] == 'b'
+    assert app.control.revoked == [task_id]
+
+    n_sent = len(app.sent)
+    wf.on_step_success((2,), 'b', task_id, queue='celery')
+    assert len(app.sent) == n_sent
+    assert [step['status'] for step in wf.workflow['steps']] == \
+           [celery.states.SUCCESS, celery.states.SUCCESS, celery.states.REVOKED]
+    assert wf.workflow['_status'] == celery.states.REVOKED
+
+    assert wf.resume()['restarted_step']['name'] == 'c'
+    assert app.sent[-1]['kwargs']['step'] == 'c'
+    assert app.sent[-1]['args'] == [2]
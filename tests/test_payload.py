@@ -0,0 +1,58 @@
+import os
+
+import pytest
+from celery import Celery
+
+from sca_rhythm import Workflow, WorkflowTask
+from sca_rhythm.payload import LocalPayloadStore, is_ref
+
+STEPS = [{'name': 'a', 'task': 'tasks.listing'}, {'name': 'b', 'task': 'tasks.listing'}]
+LISTING = list(range(100))
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = LocalPayloadStore(str(tmp_path))
+    monkeypatch.setattr(Workflow, 'PAYLOAD_STORE', store)
+    monkeypatch.setattr(Workflow, 'PAYLOAD_THRESHOLD_BYTES', 10)
+    return store
+
+
+@pytest.fixture
+def listing():
+    celery_app = Celery('test', set_as_current=False)
+
+    @celery_app.task(base=WorkflowTask, bind=True, name='tasks.listing')
+    def listing(self, n, **kwargs):
+        return list(range(n)),
+
+    return listing
+
+
+def stored_files(store):
+    return [name for _, _, names in os.walk(store.directory) for name in names]
+
+
+def test_direct_calls_return_the_output(store, listing):
+    assert listing(100) == (LISTING,)
+    assert listing.apply(args=(100,)).get() == (LISTING,)
+    assert stored_files(store) == []
+
+
+def test_the_used_outputs_of_the_workflow_tasks_are_offloaded(app, store, listing):
+    wf = Workflow(app, steps=STEPS, name='test', app_id='app')
+    kwargs = {'workflow_id': wf.workflow['_id']}
+    # the task runs in a worker, after before_start loaded its workflow
+    listing.workflow = wf
+    listing.push_request(called_directly=False)
+    try:
+        retval = listing(100, step='a', **kwargs)
+        assert is_ref(retval[0])
+        assert store.resolve(retval[0]) == LISTING
+        # the output of the last step is not used
+        assert listing(100, step='b', **kwargs) == (LISTING,)
+    finally:
+        listing.pop_request()
+    # a direct call after a run in the worker
+    assert listing(100, step='a', **kwargs) == (LISTING,)
+    assert len(stored_files(store)) == 1
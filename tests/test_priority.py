@@ -0,0 +1,55 @@
+import datetime
+
+from sca_rhythm.priority import (MAX_PRIORITY, AgingPriority, DeadlinePriority, NormalizedPositionPriority,
+                                 PositionPriority, clamp_priority, simulate)
+
+NOW = datetime.datetime(2024, 1, 1, 12)
+
+
+def workflow(n_steps=3, age_sec=0, **fields):
+    return {
+        'created_at': NOW - datetime.timedelta(seconds=age_sec),
+        'steps': [{'name': f'step{i}'} for i in range(n_steps)],
+        **fields
+    }
+
+
+def test_clamp_priority():
+    assert clamp_priority(-1) == 0
+    assert clamp_priority(3.6) == 4
+    assert clamp_priority(20) == MAX_PRIORITY
+
+
+def test_position_priorities():
+    wf = workflow(n_steps=3)
+    assert PositionPriority().priority(wf, wf['steps'][1], 2, NOW) == 2
+    assert NormalizedPositionPriority().priority(wf, wf['steps'][2], 3, NOW) == MAX_PRIORITY
+    assert NormalizedPositionPriority().priority(workflow(n_steps=30), {}, 3, NOW) < 1
+
+
+def test_aging_priority():
+    policy = AgingPriority(sec_per_level=60)
+    young, old = workflow(n_steps=9), workflow(n_steps=9, age_sec=300)
+    assert policy.priority(old, {}, 1, NOW) - policy.priority(young, {}, 1, NOW) == 5
+
+
+def test_deadline_priority():
+    policy = DeadlinePriority(horizon_sec=600)
+    wf = workflow(n_steps=10)
+    assert policy.priority(wf, {}, 1, NOW) == NormalizedPositionPriority().priority(wf, {}, 1, NOW)
+    due = workflow(n_steps=10, deadline=NOW + datetime.timedelta(seconds=300))
+    assert policy.priority(due, {}, 1, NOW) == MAX_PRIORITY / 2
+    late = workflow(n_steps=10, deadline=NOW - datetime.timedelta(seconds=1))
+    assert clamp_priority(policy.priority(late, {}, 1, NOW)) == MAX_PRIORITY
+
+
+def test_deadline_sec_per_app_id():
+    policy = DeadlinePriority(deadline_sec={'app': 60})
+    assert policy.deadline(workflow(app_id='app')) == NOW + datetime.timedelta(seconds=60)
+    assert policy.deadline(workflow(app_id='other')) is None
+
+
+def test_deadlines_cut_the_tail_latency_of_the_short_workflows():
+    position = simulate(PositionPriority(), n_workflows=500, n_workers=4, load=0.9)
+    deadline = simulate(DeadlinePriority(horizon_sec=600), n_workflows=500, n_workers=4, load=0.9)
+    assert deadline['short']['p99'] <= position['short']['p99']
@@ -0,0 +1,48 @@
+import celery.states
+
+from sca_rhythm import Workflow, _step_dependencies
+
+PENDING, STARTED, SUCCESS, FAILURE, REVOKED, RETRY = (
+    celery.states.PENDING, celery.states.STARTED, celery.states.SUCCESS, celery.states.FAILURE,
+    celery.states.REVOKED, celery.states.RETRY
+)
+
+# a -> (b, c) -> d
+DAG = [
+    {'name': 'a', 'task': 'tasks.a'},
+    {'name': 'b', 'task': 'tasks.b', 'depends_on': ['a']},
+    {'name': 'c', 'task': 'tasks.c', 'depends_on': ['a']},
+    {'name': 'd', 'task': 'tasks.d', 'depends_on': ['b', 'c']},
+]
+
+
+def status(statuses, steps):
+    dependencies = _step_dependencies(steps)
+    return Workflow._summarize_status(Workflow._frontier(statuses, dependencies), dependencies)
+
+
+def test_step_dependencies():
+    assert _step_dependencies([{'name': 'a'}, {'name': 'b'}, {'name': 'c'}]) == [[], [0], [1]]
+    assert _step_dependencies(DAG) == [[], [0], [0], [1, 2]]
+
+
+def test_frontier_of_linear_steps():
+    dependencies = [[], [0], [1]]
+    assert Workflow._frontier([SUCCESS, STARTED, PENDING], dependencies) == [(1, STARTED)]
+    assert Workflow._frontier([SUCCESS, SUCCESS, SUCCESS], dependencies) == []
+
+
+def test_frontier_of_parallel_steps():
+    dependencies = _step_dependencies(DAG)
+    assert Workflow._frontier([SUCCESS, STARTED, FAILURE, PENDING], dependencies) == [(1, STARTED), (2, FAILURE)]
+    assert Workflow._frontier([SUCCESS, SUCCESS, SUCCESS, PENDING], dependencies) == [(3, PENDING)]
+
+
+def test_summarize_status():
+    assert status([PENDING] * 4, DAG) == PENDING
+    assert status([STARTED, PENDING, PENDING, PENDING], DAG) == STARTED
+    # the workflow is running while it waits on a step that has not been sent yet
+    assert status([SUCCESS, SUCCESS, STARTED, PENDING], DAG) == STARTED
+    assert status([SUCCESS, STARTED, FAILURE, PENDING], DAG) == FAILURE
+    assert status([SUCCESS, REVOKED, RETRY, PENDING], DAG) == REVOKED
+    assert status([SUCCESS] * 4, DAG) == SUCCESS
@@ -0,0 +1,73 @@
+"""
+on_step_start updates the workflow with arrayFilters, which mongomock does not emulate: these tests run against the
+MongoDB server at SCA_RHYTHM_MONGO_URL (see tests/conftest.py).
+"""
+import celery.states
+
+from sca_rhythm import Workflow
+
+STEPS = [{'name': 'a', 'task': 'tasks.a'}, {'name': 'b', 'task': 'tasks.b'}]
+
+
+def stored(wf):
+    return wf.wf_col.find_one({'_id': wf.workflow['_id']})
+
+
+def test_start_marks_the_step_started(mongo_app):
+    wf = Workflow(mongo_app, steps=STEPS, name='test', app_id='app')
+    wf.on_step_start('a', 'a-task')
+    doc = stored(wf)
+    assert doc['_status'] == celery.states.STARTED
+    assert doc['steps'][0]['status'] == celery.states.STARTED
+    assert 'status' not in doc['steps'][1]
+    assert [run['task_id'] for run in doc['steps'][0]['task_runs']] == ['a-task']
+    assert doc['version'] == 1
+    assert wf.workflow == doc
+    assert Workflow.from_task_id(mongo_app, 'a-task').workflow['_id'] == wf.workflow['_id']
+
+
+def test_a_resubmitted_task_is_not_added_again(mongo_app):
+    wf = Workflow(mongo_app, steps=STEPS, name='test', app_id='app')
+    wf.on_step_start('a', 'a-task')
+    wf.on_step_start('a', 'a-task')
+    wf.on_step_start('a', 'a-retry')
+    assert [run['task_id'] for run in stored(wf)['steps'][0]['task_runs']] == ['a-task', 'a-retry']
+
+
+def test_start_marks_the_chunk_started(mongo_app):
+    steps = [{'name': 'list', 'task': 'tasks.list'}, {'name': 'checksum', 'task': 'tasks.checksum',
+                                                      'map': {'chunk_size': 2}}]
+    wf = Workflow(mongo_app, steps=steps, name='test', app_id='app')
+    wf.on_step_success(([1, 2, 3],), 'list', 'list-task')
+    chunks = wf.workflow['steps'][1]['chunks']
+
+    wf.on_step_start('checksum', chunks[1]['task_id'], chunk=1)
+    step = stored(wf)['steps'][1]
+    assert step['status'] == celery.states.STARTED
+    assert [chunk.get('status') for chunk in step['chunks']] == [None, celery.states.STARTED]
+    assert step['task_runs'] == [{'date_start': step['task_runs'][0]['date_start'],
+                                  'task_id': chunks[1]['task_id'], 'chunk': 1}]
+
+
+def test_older_task_runs_are_moved_out(mongo_app, monkeypatch):
+    monkeypatch.setattr(Workflow, 'MAX_INLINE_TASK_RUNS', 2)
+    wf = Workflow(mongo_app, steps=STEPS, name='test', app_id='app')
+    for k in range(4):
+        wf.on_step_start('a', f'run{k}')
+    step = stored(wf)['steps'][0]
+    assert [run['task_id'] for run in step['task_runs']] == ['run2', 'run3']
+    assert step['spilled_task_runs'] == 2
+    assert [run['_id'] for run in wf.task_runs_col.find({'workflow_id': wf.workflow['_id']}).sort('run_idx')] == \
+           ['run0', 'run1']
+
+
+def test_normalized_task_runs_replace_the_previous_run(mongo_app, monkeypatch):
+    monkeypatch.setattr(Workflow, 'NORMALIZE_TASK_RUNS', True)
+    wf = Workflow(mongo_app, steps=STEPS, name='test', app_id='app')
+    for k in range(3):
+        wf.on_step_start('a', f'run{k}')
+    step = stored(wf)['steps'][0]
+    assert [run['task_id'] for run in step['task_runs']] == ['run2']
+    assert step['spilled_task_runs'] == 2
+    runs = list(wf.task_runs_col.find({'workflow_id': wf.workflow['_id']}).sort('run_idx'))
+    assert [(run['_id'], run['run_idx']) for run in runs] == [('run0', 0), ('run1', 1), ('run2', 2)]
@@ -0,0 +1,95 @@
+import threading
+
+import celery.states
+
+from sca_rhythm import CHUNK_OUTPUTS_KEY, Workflow
+
+MAP_STEPS = [
+    {'name': 'list', 'task': 'tasks.list'},
+    {'name': 'checksum', 'task': 'tasks.checksum', 'map': {'chunk_size': 2}},
+    {'name': 'report', 'task': 'tasks.report'},
+]
+
+
+def map_workflow(app, n_items):
+    wf = Workflow(app, steps=MAP_STEPS, name='test', app_id='app')
+    wf.on_step_success((list(range(n_items)),), 'list', 'list-task')
+    return wf
+
+
+def test_last_step_may_return_none(app):
+    wf = Workflow(app, steps=[{'name': 'a', 'task': 'tasks.a'}, {'name': 'b', 'task': 'tasks.b'}],
+                  name='test', app_id='app')
+    wf.on_step_success((1,), 'a', 'a-task')
+    assert app.sent[-1]['args'] == [1]
+    wf.on_step_success(None, 'b', app.sent[-1]['task_id'])
+    assert wf.workflow['_status'] == celery.states.SUCCESS
+
+
+def test_steps_of_the_caller_are_not_modified(app):
+    map_workflow(app, 5)
+    assert MAP_STEPS[1] == {'name': 'checksum', 'task': 'tasks.checksum', 'map': {'chunk_size': 2}}
+
+
+def test_map_step_is_split_in_chunks(app):
+    wf = map_workflow(app, 5)
+    chunks = wf.workflow['steps'][1]['chunks']
+    assert [(c['start'], c['end']) for c in chunks] == [(0, 2), (2, 4), (4, 5)]
+    assert [m['args'] for m in app.sent] == [[[0, 1]], [[2, 3]], [[4]]]
+    assert [m['kwargs']['chunk'] for m in app.sent] == [0, 1, 2]
+
+
+def test_concurrent_chunks_complete_the_step_once(app):
+    wf = map_workflow(app, 120)
+    chunks = wf.workflow['steps'][1]['chunks']
+    # every task has its own workflow object, loaded before the others ended
+    workflows = [Workflow(app, wf.workflow['_id']) for _ in chunks]
+    errors = []
+
+    def run(k):
+        try:
+            workflows[k].on_step_success(([k],), 'checksum', chunks[k]['task_id'], chunk=k)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(len(chunks))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    wf.refresh()
+    assert wf.workflow['steps'][1]['status'] == celery.states.SUCCESS
+    assert all('output' not in chunk for chunk in wf.workflow['steps'][1]['chunks'])
+    report = [m for m in app.sent if m['kwargs']['step'] == 'report']
+    assert len(report) == 1
+    assert report[0]['args'] == [{CHUNK_OUTPUTS_KEY: 1}]
+    assert wf.gather_chunk_outputs(report[0]['args'][0]) == [[k] for k in range(len(chunks))]
+
+
+def test_failed_chunk_is_restarted_and_the_stale_task_ignored(app):
+    wf = map_workflow(app, 4)
+    chunks = wf.workflow['steps'][1]['chunks']
+    wf.on_step_failure('checksum', chunks[0]['task_id'], chunk=0)
+    wf.on_step_success(([1],), 'checksum', chunks[1]['task_id'], chunk=1)
+    assert wf.workflow['_status'] == celery.states.FAILURE
+
+    assert wf.resume()['restarted_step']['chunks'] == [0]
+    new_task_id = wf.workflow['steps'][1]['chunks'][0]['task_id']
+    wf.on_step_success(([0],), 'checksum', chunks[0]['task_id'], chunk=0)
+    assert wf.workflow['steps'][1]['chunks'][0].get('status') != celery.states.SUCCESS
+
+    wf.on_step_success(([0],), 'checksum', new_task_id, chunk=0)
+    assert wf.workflow['steps'][1]['status'] == celery.states.SUCCESS
+    assert wf.gather_chunk_outputs(wf.workflow['steps'][2]['dispatch']['args'][0]) == [[0], [1]]
+
+
+def test_resume_completes_a_map_step_whose_chunks_succeeded(app):
+    wf = map_workflow(app, 2)
+    chunk = wf.workflow['steps'][1]['chunks'][0]
+    # the worker of the last chunk stopped before it completed the step
+    wf.chunk_outputs_col.insert_one({'_id': chunk['task_id'], 'output': [0]})
+    wf.wf_col.update_one({'_id': wf.workflow['_id']}, {'$set': {'steps.1.chunks.0.status': celery.states.SUCCESS}})
+    assert wf.resume()['restarted_step']['name'] == 'report'
+    assert wf.workflow['steps'][1]['status'] == celery.states.SUCCESS
@@ -0,0 +1,69 @@
+import datetime
+
+import celery.states
+
+from sca_rhythm import Workflow
+
+START = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def test_backfill_parses_the_date_done_of_the_taskmeta(app):
+    task_runs_col = app.backend.database.get_collection('workflow_task_runs')
+    task_runs_col.insert_many([{'_id': f't{k}', 'workflow_id': 'wf', 'date_start': START} for k in range(4)])
+    app.backend.collection.insert_many([
+        # the mongo result backend stores date_done as an ISO string by default (format_date)
+        {'_id': 't0', 'status': celery.states.SUCCESS, 'date_done': '2024-01-01T12:00:01.500000'},
+        {'_id': 't1', 'status': celery.states.SUCCESS, 'date_done': '2024-01-01T12:00:02'},
+        {'_id': 't2', 'status': celery.states.FAILURE, 'date_done': START + datetime.timedelta(seconds=3)},
+        {'_id': 't3', 'status': celery.states.STARTED},
+    ])
+
+    assert Workflow.backfill_task_runs(app, ['wf']) == 3
+    runs = {run['_id']: run for run in task_runs_col.find()}
+    assert [runs[f't{k}'].get('duration_sec') for k in range(4)] == [1.5, 2, 3, None]
+    assert all(isinstance(runs[f't{k}']['date_done'], datetime.datetime) for k in range(3))
+    assert runs['t2']['status'] == celery.states.FAILURE
+    # the runs are not updated again
+    assert Workflow.backfill_task_runs(app, ['wf']) == 0
+
+
+def test_task_instance_date_done_is_decoded():
+    decoded = Workflow._decode_task_instance({'_id': 't0', 'date_done': '2024-01-01T12:00:01.500000'})
+    assert decoded['date_done'] == START + datetime.timedelta(seconds=1.5)
+    decoded = Workflow._decode_task_instance({'_id': 't0', 'date_done': START})
+    assert decoded['date_done'] == START
+
+
+def workflow_with_history(app):
+    wf = Workflow(app, steps=[{'name': 'a', 'task': 'tasks.a'}], name='test', app_id='app')
+    task_ids = [f'run{k}' for k in range(5)]
+    # the first 3 runs were moved out of the workflow document
+    wf.task_runs_col.insert_many([
+        {'_id': task_id, 'task_id': task_id, 'workflow_id': wf.workflow['_id'], 'step': 'a', 'run_idx': k}
+        for k, task_id in enumerate(task_ids[:3])
+    ])
+    wf.wf_col.update_one({'_id': wf.workflow['_id']}, {'$set': {
+        'steps.0.task_runs': [{'task_id': task_id} for task_id in task_ids[3:]],
+        'steps.0.spilled_task_runs': 3,
+    }})
+    app.backend.collection.insert_many([{'_id': task_id, 'status': celery.states.FAILURE} for task_id in task_ids])
+    wf.refresh()
+    return wf
+
+
+def test_embellished_prev_task_runs_include_the_moved_runs(app, monkeypatch):
+    monkeypatch.setattr(Workflow, 'TASK_RUNS_PAGE_SIZE', 2)
+    wf = workflow_with_history(app)
+    step = wf.get_embellished_workflow(prev_task_runs=True)['steps'][0]
+    assert step['last_task_run']['_id'] == 'run4'
+    assert [run['_id'] for run in step['prev_task_runs']] == ['run0', 'run1', 'run2', 'run3']
+
+    [emb] = Workflow.embellish_many(app, [wf.workflow['_id']], prev_task_runs=True)
+    assert [run['_id'] for run in emb['steps'][0]['prev_task_runs']] == ['run0', 'run1', 'run2', 'run3']
+
+
+def test_embellished_inline_prev_task_runs(app):
+    wf = workflow_with_history(app)
+    step = wf.get_embellished_workflow(prev_task_runs=True, inline_prev_task_runs=True)['steps'][0]
+    assert [run['_id'] for run in step['prev_task_runs']] == ['run3']
+    assert step['spilled_task_runs'] == 3